@@ -1,31 +1,35 @@
 #!/usr/bin/env python3
 
 import json
+import time
 from datetime import datetime
 
 from .defaults import AppDefaults
 from .applebooks import AppleBooks
+from .coordinator import RunCoordinator
 from .api import ApiConnect
+from .api.defaults import ApiDefaults
+from .api.errors import ApiServerError, ApiUnreachableError
+from .api.retry import RetryQueue
+from .merkle import MerkleTree, diff
+from .metrics import Metrics, MetricsServer
+from .mirror import Mirror
+from .pipeline import Pipeline
+from .progress import Progress
+from .spool import Spool
 from .utilities import Utilities
 from .errors import ApplicationError
-from .testing import dummy_annotations
+from .testing import DummyReader
 
 
 """
 TODO: Make a method for raw data backup. Have it dump to somewhere where we can
 easily retrieve it. Maybe have this attach to our backup script somehow?
 
-TODO: Add EpubCFI We might want to move to a source-centric model so we can
-sort things based on book/sources.
-
 NOTE: The places we need to focus on are mainly the hlts.api, hlts.data this
 app. We should try and get clear communication and feedback between the two
 endpoints.
 
-TODO: Add a function here that downloads user .htls files. If we see we are
-getting timeout errors. We can probably build a communication system thats similar
-to the chunking
-
 TODO: Add a way to append a temporary collection to the import. Anything that
 is refreshed or added will get in a way "collection stamped" so you can see what
 was added or refreshed today. "added-10121990" or "refreshed-10121990"
@@ -44,6 +48,8 @@ class App:
         self.args = args
 
         self.utils = Utilities(self)
+        self.progress = Progress()
+        self.metrics = Metrics()
 
         self._build_directories()
 
@@ -59,36 +65,156 @@ class App:
         self.config = Config(self)
 
         self.api = ApiConnect(self)
+        self.retry_queue = RetryQueue(self)
         self.applebooks = AppleBooks(self)
+        self.mirror = Mirror(self)
+        self.spool = Spool(self)
+
+        self.coordinator = RunCoordinator(self)
+
+        self.offline = False
+        # Set once the run got past confirmation, see `results`.
+        self.synced = False
 
     def run(self):
+        """ Run the sync and export metrics afterwards, whether it succeeded
+        or not. With `--metrics-port` the metrics can be scraped while the
+        sync is running.
+
+        Only one sync runs at a time, see `coordinator.py`. Searching only
+        reads the mirror so it doesn't wait for anything. """
+
+        if self.args.reader == "search":
+            self.search()
+            return
+
+        if not self.coordinator.acquire(
+            self.args.reader, getattr(self.args, "if_running", "attach"), self._work()
+        ):
+            return
+
+        server = None
+
+        if getattr(self.args, "metrics_port", None):
+            server = MetricsServer(self.metrics, self.args.metrics_port).start()
+            print(f"Serving metrics on http://127.0.0.1:{server.port}/metrics")
+
+        started = time.monotonic()
+        success = False
+
+        try:
+            self._run()
+            success = True
+        finally:
+            self.export_metrics(time.monotonic() - started, success)
+
+            if server is not None:
+                server.stop()
+
+            self.coordinator.release("finished" if success else "failed", self.results())
+
+    def results(self):
+        """ Summary of the run shared with invocations that attach to it. """
+
+        return {
+            "synced": self.synced,
+            "imported": self.api.acks.summary(),
+            "failed": len(self.retry_queue.failed),
+            "offline": self.offline,
+        }
+
+    def _work(self) -> dict:
+        """ The arguments that decide what a run does. An overlapping run is
+        only attached to when they're the same. """
+
+        ignored = ("setup", "yes", "if_running", "metrics_port")
+
+        work = {key: value for key, value in vars(self.args).items() if key not in ignored}
+
+        # As it will read back from the run file.
+        return json.loads(json.dumps(work))
+
+    def export_metrics(self, duration, success):
+
+        metrics = self.metrics
+
+        for name, phase in self.progress.phases.items():
+            metrics.stage_duration.set(phase.elapsed, stage=name)
+
+        metrics.last_run_duration.set(duration)
+        metrics.last_run_timestamp.set(time.time())
+        metrics.last_run_success.set(int(success))
+
+        try:
+            metrics.write_textfile(self.config.metrics_textfile)
+        except OSError as error:
+            self.logger.error(f"Could not write metrics: {repr(error)}")
+
+    def _run(self):
 
         print(f"\nConnecting to {self.config.url_base}...")
 
-        if self.api.verify_key():
+        try:
+            verified = self.api.verify_key()
+        except ApiUnreachableError:
+            self._go_offline()
+            verified = True
+
+        if verified and not self.offline:
+            self.drain_spool()
+
+        if self.args.reader == "drain":
+            self.handle_api_response()
+            self.synced = True
+            return
+
+        if self.args.reader == "download":
+            if verified and not self.offline:
+                self.download()
+                self.synced = True
+            return
+
+        if verified and self.args.reader == "dummy":
+            self.run_dummy()
+            return
 
-            if self.args.reader == "dummy":
-                self._adding_annotations = dummy_annotations(
-                    count=50, id_prefix="TEST0", passage="Inital run."
-                )
-                self._refreshing_annotations = dummy_annotations(
-                    count=50, id_prefix="TEST0", passage="Inital run."
-                )
+        if verified and getattr(self.args, "pipeline", False):
+            self.run_pipeline()
+            return
+
+        if verified:
 
             if self.args.reader == "applebooks":
                 self.applebooks.manage()
                 self._adding_annotations = self.applebooks.adding_annotations
                 self._refreshing_annotations = self.applebooks.refreshing_annotations
+                self._trashing_ids = self.applebooks.trashing_ids
+
+                if self.applebooks.collapsed_ids:
+                    print(
+                        f"Collapsed {len(self.applebooks.collapsed_ids)} near-duplicate "
+                        f"annotations. See {AppDefaults.log_file} for details."
+                    )
 
             elif self.args.reader == "kindle":
                 # self.kindle.manage()
                 self._adding_annotations = []
                 self._refreshing_annotations = []
+                self._trashing_ids = []
+
+            if getattr(self.args, "reconcile", False):
+                self.reconcile()
 
             if self.user_confirm():
                 self.handle_api_import()
                 self.handle_api_response()
 
+                # Anything that could still go through is picked up again on
+                # the next run, permanent rejections aren't retried forever.
+                if self.args.reader == "applebooks" and not self.retry_queue.outstanding:
+                    self.applebooks.commit_deleted()
+                    self.applebooks.commit_snapshot()
+
     def _build_directories(self):
 
         # Create app root_dir directory.
@@ -99,66 +225,419 @@ class App:
         """
         num_add = len(self._adding_annotations)
         num_refresh = len(self._refreshing_annotations)
+        num_trash = len(self._trashing_ids)
 
-        confirm = input(
-            f"Confirm to add:{num_add} refresh:{num_refresh} annotations? [y/N]: "
+        return self._confirm(
+            f"Confirm to add:{num_add} refresh:{num_refresh} trash:{num_trash} "
+            "annotations? [y/N]: "
         )
 
-        if confirm.lower().strip() != "y":
-            print("Confirmation cancelled.")
-            return False
+    def _confirm(self, prompt):
+
+        if not getattr(self.args, "yes", False):
+
+            confirm = input(prompt)
+
+            if confirm.lower().strip() != "y":
+                print("Confirmation cancelled.")
+                return False
+
+        self.synced = True
 
         return True
 
-    def handle_api_import(self):
-        """ TODO: Clean and DRY this code. We want to make this useable for
-        any kind of data thats being sent. We're gonna add kindle highlights to
-        this app so it needs to work with that too.
+    def run_pipeline(self):
+        """ Read, transform and upload Apple Books annotations concurrently.
+        See `pipeline.py`. Uploads start as soon as the first source has been
+        routed so confirmation has to be given up front, before anything has
+        been counted per bucket. """
+
+        applebooks = self.applebooks
+
+        applebooks.prepare()
+
+        total = applebooks.db.count_annotations()
+        trashing = [{"id": id_} for id_ in applebooks.trashing_ids]
+
+        self.progress.finish()
+
+        if not self._confirm(
+            f"Confirm to sync {total} annotations and trash:{len(trashing)} "
+            "as they are read? [y/N]: "
+        ):
+            return
+
+        workers = getattr(self.args, "workers", 1)
+
+        self.progress.start("sync", total + len(trashing))
+
+        pipeline = Pipeline(maxsize=AppDefaults.pipeline_queue_size)
+
+        batches = pipeline.source("read", applebooks.read_batches())
+        transformed = pipeline.stage(
+            "transform",
+            batches,
+            lambda batches: applebooks.transformer.map(batches, workers=workers),
+        )
+        chunks = pipeline.stage(
+            "route", transformed, lambda routed: self._chunk(applebooks.route(routed), trashing)
+        )
+        pipeline.sink("upload", chunks, self._upload, workers=AppDefaults.pipeline_uploaders)
+
+        self._run_pipeline(pipeline)
+
+        counts = applebooks.routed_counts
+
+        print(
+            " ".join(f"{bucket}:{count}" for bucket, count in counts.items()),
+            f"trash:{len(trashing)}",
+        )
+
+        if counts["collapsed"]:
+            print(
+                f"Collapsed {counts['collapsed']} near-duplicate annotations. "
+                f"See {AppDefaults.log_file} for details."
+            )
+
+        self.handle_api_response()
+
+        if not self.retry_queue.outstanding:
+            applebooks.commit_deleted()
+            applebooks.commit_snapshot()
+
+    def run_dummy(self):
+        """ Generate dummy annotations and send them through the same upload
+        path as a real sync. Meant for load testing an hlts server, see
+        `DummyReader` and `python3 run.py dummy --help`. """
+
+        args = self.args
+
+        reader = DummyReader(
+            count=args.count,
+            refresh_ratio=args.refresh_ratio,
+            passage_size=tuple(args.passage_size),
+            notes_size=tuple(args.notes_size),
+            distribution=args.size_distribution,
+            tags=args.tags,
+            collections=args.collections,
+            sources=args.sources,
+            seed=args.seed,
+        )
+
+        if not self._confirm(f"Confirm to send {len(reader)} dummy annotations? [y/N]: "):
+            return
+
+        def generate():
+            for method, chunk in reader.chunks():
+                self.metrics.annotations_read.inc(len(chunk), reader="dummy")
+                yield method, chunk
+
+        self.progress.start("upload", len(reader))
+
+        pipeline = Pipeline(maxsize=AppDefaults.pipeline_queue_size)
+
+        chunks = pipeline.source("generate", generate())
+        pipeline.sink("upload", chunks, self._upload, workers=args.uploaders)
+
+        self._run_pipeline(pipeline)
+
+        self.handle_api_response()
+
+    def _run_pipeline(self, pipeline):
+
+        try:
+            pipeline.run()
+        finally:
+            self.progress.finish()
+
+            for name, error in pipeline.errors:
+                self.logger.error(f"Pipeline stage {name} failed: {repr(error)}")
+
+            for name, duration in pipeline.durations.items():
+                self.metrics.stage_duration.set(duration, stage=f"pipeline_{name}")
 
-        QUESTION: Maybe compact it so that we have only one progress bar?
+    def _chunk(self, routed, trashing, chunk_size=100):
+        """ Pack the routed stream into `(method, chunk)` for the uploaders.
+        Buckets that aren't sent yield `(None, annotations)` so progress still
+        accounts for them. Trashes go last. """
+
+        pending = {"add": [], "refresh": []}
+
+        for bucket, annotations in routed:
+
+            if bucket not in pending:
+                yield None, annotations
+                continue
+
+            pending[bucket].extend(annotations)
+
+            while len(pending[bucket]) >= chunk_size:
+                yield bucket, pending[bucket][:chunk_size]
+                del pending[bucket][:chunk_size]
+
+        for method, annotations in pending.items():
+            if annotations:
+                yield method, annotations
+
+        for chunk in self.utils.chunk_data(trashing, chunk_size):
+            yield "trash", chunk
+
+    def _upload(self, item):
+
+        method, chunk = item
+
+        if method is not None:
+            self.retry_queue.add(chunk, method, self._send(chunk, method))
+
+        self.progress.advance(len(chunk))
+
+    def handle_api_import(self):
+        """ Send everything in one pass with a single progress line covering
+        adds, refreshes and trashes.
 
         NOTE: This data chunking is a temporary fix until we get proper
         background tasks running.
         """
 
-        # Add annotations.
-        if self._adding_annotations:
+        trashing = [{"id": id_} for id_ in self._trashing_ids]
+
+        jobs = [
+            ("add", self._adding_annotations),
+            ("refresh", self._refreshing_annotations),
+            ("trash", trashing),
+        ]
+
+        total = sum(len(data) for _, data in jobs)
+
+        if not total:
+            return
+
+        print(
+            f"Sending add:{len(self._adding_annotations)} "
+            f"refresh:{len(self._refreshing_annotations)} "
+            f"trash:{len(trashing)} annotations..."
+        )
+
+        self.progress.start("upload", total)
+
+        for method, data in jobs:
+
+            for chunk in self.utils.chunk_data(data):
+
+                self.retry_queue.add(chunk, method, self._send(chunk, method))
+                self.progress.advance(len(chunk))
+
+        self.progress.finish()
+
+    def _send(self, chunk, method):
+        """ Send a chunk to the server and return its `import_failed`. Once
+        the server is unreachable the chunk and every one after it is spooled
+        to disk for a later run. """
+
+        if self.offline:
+            self.spool.append(chunk, method)
+            return []
+
+        try:
+            return self._deliver(chunk, method)
+        except ApiUnreachableError:
+            self._go_offline()
+            self.spool.append(chunk, method)
+            return []
+
+    def _deliver(self, chunk, method):
+        """ Import a chunk and record what went through. Returns the
+        failures that still need handling. """
+
+        failures = self.api.import_annotations(chunk, method)
+        failures = self.retry_queue.drop_resolved(failures, method)
+
+        self._record(chunk, method, failures)
+
+        return failures
+
+    def _record(self, chunk, method, failures):
+        """ Update the mirror with whatever the server didn't report as
+        failed so it only holds what actually made it upstream. """
+
+        failed_ids = {failure.get("id") for failure in failures if isinstance(failure, dict)}
+
+        synced = [item for item in chunk if item["id"] not in failed_ids]
+
+        self.metrics.annotations_sent.inc(len(synced), method=method)
+
+        # Dummy annotations would only clutter searches.
+        if self.args.reader == "dummy":
+            return
+
+        if method == "trash":
+            self.mirror.mark_trashed(item["id"] for item in synced)
+        else:
+            self.mirror.update(synced)
 
-            chunked_data = self.utils.chunk_data(self._adding_annotations)
-            number_of_chunks = len(chunked_data)
+    def _go_offline(self):
 
-            print(f"Adding {len(self._adding_annotations)} annotations...")
-            self.utils.print_progress(0, number_of_chunks)
+        self.offline = True
 
-            for count, chunk in enumerate(chunked_data):
+        print(
+            f"\nWARNING: {self.config.url_base} is unreachable. "
+            f"Spooling annotations to {AppDefaults.spool_dir}."
+        )
+
+    def drain_spool(self):
+        """ Send everything spooled by previous runs. Segments are only
+        removed once all their chunks have been sent or given up on. """
+
+        segments, batches = self.spool.drain(batch_size=AppDefaults.spool_batch_size)
+
+        if not batches:
+            return
+
+        total = sum(len(chunk) for _, chunk in batches)
+
+        print(f"Draining {total} spooled annotations...")
+        self.progress.start("drain", total)
+
+        for method, chunk in batches:
+
+            try:
+                failures = self._drain_batch(chunk, method)
+            except ApiUnreachableError:
+                self.progress.finish()
+                self._go_offline()
+                return
+
+            self.retry_queue.add(chunk, method, failures)
+            self.progress.advance(len(chunk))
+
+        self.progress.finish()
+        self.spool.remove(segments)
+
+    def _drain_batch(self, chunk, method):
+        """ Deliver one spooled batch the same way `_send` does. The key was
+        just verified so a 5xx is a problem with this batch, not the server
+        being down. It's retried up to `spool_max_attempts` times and then
+        given up on, otherwise a batch the server always chokes on would
+        send every run offline and spool everything behind it. """
+
+        for attempt in range(1, AppDefaults.spool_max_attempts + 1):
+
+            try:
+                return self._deliver(chunk, method)
+            except ApiServerError as error:
+                reason = str(error)
+
+            if attempt < AppDefaults.spool_max_attempts:
+                time.sleep(ApiDefaults.retry_backoff * 2 ** attempt)
+
+        self.logger.warning(
+            f"Gave up draining {len(chunk)} spooled annotations: {reason} "
+            f"See {AppDefaults.failures_file}."
+        )
+        self.retry_queue.give_up(chunk, method, f"Gave up draining: {reason}", attempt)
+
+        return []
+
+    def reconcile(self):
+        """ Narrow the upload down to annotations that are missing or
+        different on the server by comparing Merkle trees. See `merkle.py`.
+
+        The local tree is what the server should hold once this run is done:
+        everything the mirror has synced, trashed annotations included, with
+        this run's changes on top. Annotations that are ignored or skipped
+        now but were synced before still match their server copy. """
 
-                self.api.import_annotations(chunk, "add")
-                self.utils.print_progress(count + 1, number_of_chunks)
+        if self.offline:
+            print("Server unreachable. Skipping reconciliation, sending everything.")
+            return
 
-        # Refresh annotations.
-        if self._refreshing_annotations:
+        depth = ApiDefaults.tree_depth
 
-            chunked_data = self.utils.chunk_data(self._refreshing_annotations)
-            number_of_chunks = len(chunked_data)
+        expected = {annotation["id"]: annotation for annotation in self.mirror.all_annotations()}
 
-            print(f"Refreshing {len(self._refreshing_annotations)} annotations...")
-            self.utils.print_progress(0, number_of_chunks)
+        for id_ in self._trashing_ids:
+            if id_ in expected:
+                expected[id_]["metadata"]["in_trash"] = True
 
-            for count, chunk in enumerate(chunked_data):
+        for annotation in self._adding_annotations + self._refreshing_annotations:
+            expected[annotation["id"]] = annotation
 
-                self.api.import_annotations(chunk, "refresh")
-                self.utils.print_progress(count + 1, number_of_chunks)
+        local = MerkleTree.from_annotations(expected.values(), depth=depth)
+
+        try:
+            changed, remote_only = diff(
+                local,
+                remote_hashes=lambda prefixes: self.api.tree_hashes(prefixes, depth),
+                remote_entries=lambda prefixes: self.api.tree_leaves(prefixes, depth),
+            )
+        except ApiUnreachableError:
+            self._go_offline()
+            return
+
+        changed = set(changed)
+
+        self._adding_annotations = [
+            annotation for annotation in self._adding_annotations if annotation["id"] in changed
+        ]
+        self._refreshing_annotations = [
+            annotation
+            for annotation in self._refreshing_annotations
+            if annotation["id"] in changed
+        ]
+        # Trashes the server already has are dropped too. Ids the mirror
+        # doesn't know aren't in the tree so they're sent as before.
+        self._trashing_ids = [
+            id_ for id_ in self._trashing_ids if id_ in changed or id_ not in expected
+        ]
+
+        summary = (
+            f"Reconciled: {len(changed)} annotations differ from the server, "
+            f"{len(remote_only)} only exist on the server."
+        )
+
+        print(summary)
+        self.logger.info(summary)
+
+    def download(self):
+
+        print(f"Downloading annotations to {AppDefaults.download_dir}...")
+
+        hlts_file = self.api.download(AppDefaults.download_dir, per_page=self.args.per_page)
+
+        print(f"Saved {hlts_file}")
+
+    def search(self):
+
+        results = self.mirror.search(
+            self.args.query, source=self.args.source, limit=self.args.limit
+        )
+
+        for result in results:
+            print(f"\n{result['source_name']} - {result['source_author']}")
+            print(f"  {result['passage']}")
+            if result["notes"]:
+                print(f"  Notes: {result['notes']}")
+            print(f"  [{result['id']}] modified:{result['modified']}")
+
+        print(f"\nFound {len(results)} annotations.")
 
     def handle_api_response(self):
         """ WIP: Placeholder function to handle API responses.
         """
-        if self.api.had_failures:
-            self.logger.warning(self.api.import_failed)
+        self.retry_queue.run(self._send)
+
+        if self.retry_queue.failed:
+            self.retry_queue.persist(AppDefaults.failures_file)
+            self.logger.warning(
+                f"{len(self.retry_queue.failed)} annotations failed to import. "
+                f"See {AppDefaults.failures_file}."
+            )
             print(
-                "WARNING: Encountered import failures. Please check logs for details."
+                f"WARNING: {len(self.retry_queue.failed)} annotations could not be "
+                f"imported. See {AppDefaults.failures_file} for details."
             )
 
-        self.logger.info(self.api.import_succeeded)
+        self.logger.info(f"Imported {self.api.import_succeeded}")
 
 
 class Logger:
@@ -223,6 +702,17 @@ class Config:
                     # Apple Books
                     self.applebooks_collections = _config["applebooks"]["collections"]
                     self.applebooks_colors = _config["applebooks"]["colors"]
+                    self.applebooks_rules = _config["applebooks"].get("rules", [])
+                    self.applebooks_dedup = _config["applebooks"].get(
+                        "dedup", {"policy": "off", "threshold": 0.9}
+                    )
+                    # Rate limits
+                    self.rate_limits = _config.get("rate_limits", {})
+                    self.ack = _config.get("ack", ApiDefaults.ack)
+                    # Metrics
+                    self.metrics_textfile = _config.get(
+                        "metrics_textfile", str(AppDefaults.metrics_file)
+                    )
                 except KeyError as error:
                     self._config_load_error(error)
                     self._set_default_config()
@@ -274,6 +764,13 @@ class Config:
             "pink": True,
             "purple": True,
         }
+        self.applebooks_rules = []
+        self.applebooks_dedup = {"policy": "off", "threshold": 0.9}
+
+        self.rate_limits = {}
+        self.ack = ApiDefaults.ack
+
+        self.metrics_textfile = str(AppDefaults.metrics_file)
 
     def _save_config(self):
 
@@ -304,7 +801,12 @@ class Config:
                     "pink": self.applebooks_colors["pink"],
                     "purple": self.applebooks_colors["purple"],
                 },
+                "rules": self.applebooks_rules,
+                "dedup": self.applebooks_dedup,
             },
+            "rate_limits": self.rate_limits,
+            "ack": self.ack,
+            "metrics_textfile": self.metrics_textfile,
         }
 
         return _config
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
 import json
+import pathlib
 import requests
+from time import perf_counter
 
+from .ack import Acknowledgments
 from .defaults import ApiDefaults
-from .errors import ApiError
+from .encoder import Encoder
+from .errors import ApiError, ApiServerError, ApiUnreachableError
+from .limiter import RateLimiter
 
 
 class ApiConnect:
@@ -16,8 +21,21 @@ class ApiConnect:
         self.url_base = self.app.config.url_base
         self.api_key = self.app.config.api_key
 
-        self._import_succeeded = []
-        self._import_failed = []
+        rate_limit = self.app.config.rate_limits.get(self.url_base, {})
+
+        self.limiter = RateLimiter.for_url(
+            self.url_base,
+            requests_per_second=rate_limit.get(
+                "requests_per_second", ApiDefaults.requests_per_second
+            ),
+            bytes_per_second=rate_limit.get(
+                "bytes_per_second", ApiDefaults.bytes_per_second
+            ),
+        )
+
+        self.encoder = Encoder()
+
+        self.acks = Acknowledgments(getattr(self.app.config, "ack", ApiDefaults.ack))
 
         self.headers = {
             "Content-Type": "application/json",
@@ -28,28 +46,21 @@ class ApiConnect:
         self.url_verify = f"{self.url_base}{ApiDefaults.url_verify}"
         self.url_refresh = f"{self.url_base}{ApiDefaults.url_refresh}"
         self.url_add = f"{self.url_base}{ApiDefaults.url_add}"
-
-        self.url_errors = [
-            f"{self.url_base}/api/error500",
-            f"{self.url_base}/api/error400",
-            f"{self.url_base}/api/error401",
-            f"{self.url_base}/api/error403",
-            f"{self.url_base}/api/error404",
-            f"{self.url_base}/api/error405",
-        ]
+        self.url_trash = f"{self.url_base}{ApiDefaults.url_trash}"
+        self.url_export = f"{self.url_base}{ApiDefaults.url_export}"
+        self.url_tree = f"{self.url_base}{ApiDefaults.url_tree}"
+        self.url_leaves = f"{self.url_base}{ApiDefaults.url_leaves}"
 
     def verify_key(self):
 
-        try:
-            get = requests.get(self.url_verify, headers=self.headers)
-            get.raise_for_status()
-        except Exception as exception:
-            ApiError(repr(exception), self.app)
+        get = self._request("GET", self.url_verify)
 
         # API key verified.
         if get.status_code == 200:
             return True
 
+        ApiError(f"{get.status_code} - Could not verify API key.", self.app)
+
         return False
 
     def import_annotations(self, data, method):
@@ -58,42 +69,274 @@ class ApiConnect:
             url = self.url_refresh
         elif method == "add":
             url = self.url_add
+        elif method == "trash":
+            url = self.url_trash
         else:
             raise ApiError("Unrecognized API import method.", self.app)
 
-        data = json.dumps(data)
+        # Bytes are sent as is, requests doesn't copy them again.
+        data = self.encoder.encode_chunk(data)
+
+        start = perf_counter()
+
+        post = self._request("POST", url, data=data, params=self.acks.params, stream=True)
 
         try:
-            post = requests.post(url, data=data, headers=self.headers)
-            post.raise_for_status()
-        except Exception as exception:
-            ApiError(repr(exception), self.app)
+            if post.status_code != 201:
+                error = post.json().get("error")
+                raise ApiError(error, self.app)
+
+            # Parse the body as it's read, see `ack.py`.
+            post.raw.decode_content = True
+            import_failed = self.acks.parse(method, post.raw)
+        finally:
+            post.close()
+
+        self.app.metrics.chunk_latency.observe(perf_counter() - start, method=method)
+        self.app.metrics.import_failures.inc(len(import_failed), method=method)
+
+        return import_failed
+
+    def tree_hashes(self, prefixes: list, depth: int) -> dict:
+        """ Ask the server for the Merkle hash of each id prefix. See
+        `app/merkle.py`. """
+        return self._post_sync(self.url_tree, prefixes, depth)["hashes"]
+
+    def tree_leaves(self, prefixes: list, depth: int) -> dict:
+        """ Ask the server for the {id: content hash} entries of each leaf
+        bucket. """
+        return self._post_sync(self.url_leaves, prefixes, depth)["entries"]
+
+    def _post_sync(self, url, prefixes, depth):
+
+        data = self.encoder.encode_chunk({"prefixes": prefixes, "depth": depth})
+
+        post = self._request("POST", url, data=data)
 
         response = post.json()
 
-        if post.status_code != 201:
-            error = response.get("error")
-            raise ApiError(error, self.app)
+        if post.status_code != 200:
+            raise ApiError(response.get("error"), self.app)
 
-        data = response.get("data")
-        import_failed = data.get("import_failed")
-        import_succeeded = data.get("import_succeeded")
+        return response["data"]
 
-        self._import_failed.extend(import_failed)
-        self._import_succeeded.append(import_succeeded)
+    def download(self, directory: pathlib.Path, per_page=ApiDefaults.per_page):
+        """ Download all of the user's annotations page by page into
+        `directory` and combine them into a single .hlts file.
 
-    @property
-    def had_failures(self):
-        return bool(self._import_failed)
+        Each page is streamed straight to disk and kept as a cache. On the
+        next download every cached page is revalidated with If-None-Match so
+        unchanged pages aren't transferred again. A page that was cut off
+        half way is resumed with a Range request. """
 
-    @property
-    def import_failed(self):
-        """ Using json.dumps() to pretty print the dictionary.
-        """
-        return json.dumps(self._import_failed, indent=4)
+        self.app.utils.make_dir(path=directory)
+
+        index_file = directory / "index.json"
+
+        try:
+            with open(index_file, "r") as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = {}
+
+        if index.get("per_page") != per_page:
+            # Page boundaries moved, none of the cached pages line up.
+            index = {"per_page": per_page, "pages": {}}
+
+        pages = []
+        page = 1
+        total_pages = None
+
+        self.app.progress.start("download")
+
+        while total_pages is None or page <= total_pages:
+
+            page_file = directory / f"page-{page:06d}.json"
+
+            response_pages = self._download_page(page, per_page, page_file, index, index_file)
+
+            pages.append(page_file)
+
+            if response_pages is not None:
+                total_pages = response_pages
+                self.app.progress.set_total(total_pages)
+            elif page_file.stat().st_size <= 2:
+                # No page count from the server. An empty list ends it.
+                break
+
+            self.app.progress.advance(1)
+            page += 1
+
+        self.app.progress.finish()
+
+        # Drop cached pages beyond the end, the library may have shrunk.
+        for stale in directory.glob("page-*.json"):
+            if stale not in pages:
+                stale.unlink()
+                index["pages"].pop(stale.stem, None)
+
+        self._save_index(index, index_file)
+
+        return self._combine_pages(pages, directory / f"{ApiDefaults.export_name}.hlts")
+
+    def _download_page(self, page, per_page, page_file, index, index_file):
+        """ Stream one page to `page_file`. Returns the total number of pages
+        if the server sent one. """
+
+        part_file = page_file.with_suffix(".part")
+
+        cached = index["pages"].get(page_file.stem, {})
+
+        headers = {}
+
+        if part_file.exists() and cached.get("etag"):
+            # Resume where the last run was cut off, if the page hasn't
+            # changed since.
+            headers["Range"] = f"bytes={part_file.stat().st_size}-"
+            headers["If-Range"] = cached["etag"]
+        elif page_file.exists() and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+
+        response = self._request(
+            "GET",
+            self.url_export,
+            params={"page": page, "per_page": per_page},
+            headers=headers,
+            stream=True,
+        )
+
+        with response:
+
+            if response.status_code == 304:
+                total_pages = response.headers.get("X-Total-Pages")
+                return int(total_pages) if total_pages else cached.get("pages")
+
+            if response.status_code not in (200, 206):
+                raise ApiError(
+                    f"{response.status_code} - Could not download page {page}.", self.app
+                )
+
+            total_pages = response.headers.get("X-Total-Pages")
+            total_pages = int(total_pages) if total_pages else None
+
+            index["pages"][page_file.stem] = {
+                "etag": response.headers.get("ETag"),
+                "pages": total_pages,
+            }
+
+            # Saved before streaming so an interrupted page can be resumed.
+            self._save_index(index, index_file)
+
+            mode = "ab" if response.status_code == 206 else "wb"
+
+            try:
+                with open(part_file, mode) as f:
+                    for block in response.iter_content(chunk_size=ApiDefaults.stream_chunk_size):
+                        f.write(block)
+                        self.app.progress.add_bytes(len(block))
+            except requests.RequestException as exception:
+                raise ApiUnreachableError(repr(exception), self.app)
+
+        part_file.replace(page_file)
+
+        return total_pages
+
+    @staticmethod
+    def _save_index(index, index_file):
+        with open(index_file, "w") as f:
+            json.dump(index, f)
+
+    def _combine_pages(self, pages, hlts_file):
+        """ Write every page into one JSON list holding one page in memory at
+        a time. """
+
+        with open(hlts_file, "w") as f:
+
+            f.write("[")
+
+            first = True
+
+            for page_file in pages:
+
+                with open(page_file, "r") as page:
+                    annotations = json.load(page)
+
+                for annotation in annotations:
+                    if not first:
+                        f.write(",")
+                    json.dump(annotation, f)
+                    first = False
+
+            f.write("]")
+
+        return hlts_file
+
+    def _request(self, method, url, data=None, params=None, headers=None, stream=False):
+        """ Send a rate limited request. 429 and 503 responses are retried
+        after `Retry-After`, or an exponential backoff if the server didn't
+        send one, up to `ApiDefaults.max_retries` times.
+
+        Raise ApiUnreachableError when the request can be retried later
+        i.e. connection errors, timeouts and 5xx responses, the latter as
+        its subclass ApiServerError. Other responses are returned as is. """
+
+        size = len(data) if data else 0
+
+        for attempt in range(ApiDefaults.max_retries + 1):
+
+            self.limiter.acquire(size)
+
+            self.app.progress.request_started()
+
+            try:
+                response = requests.request(
+                    method,
+                    url,
+                    data=data,
+                    params=params,
+                    headers={**self.headers, **(headers or {})},
+                    stream=stream,
+                )
+            except (requests.ConnectionError, requests.Timeout) as exception:
+                self.app.metrics.requests.inc(status="unreachable")
+                raise ApiUnreachableError(repr(exception), self.app)
+            except requests.RequestException as exception:
+                self.app.metrics.requests.inc(status="error")
+                raise ApiError(repr(exception), self.app)
+            finally:
+                self.app.progress.request_finished()
+
+            self.app.progress.add_bytes(size)
+
+            self.app.metrics.bytes_sent.inc(size)
+            self.app.metrics.requests.inc(status=response.status_code)
+
+            if response.status_code not in (429, 503):
+                break
+
+            response.close()
+
+            self.app.metrics.retries.inc(status=response.status_code)
+
+            retry_after = self.limiter.parse_retry_after(
+                response.headers.get("Retry-After"),
+                default=ApiDefaults.retry_backoff * 2 ** attempt,
+            )
+
+            self.limiter.backoff(retry_after)
+
+            self.app.logger.warning(
+                f"{response.status_code} - {url} Retrying in {retry_after:.1f}s."
+            )
+
+        if response.status_code >= 500 or response.status_code == 429:
+            raise ApiServerError(f"{response.status_code} - {url}", self.app)
+
+        self.limiter.recover()
+
+        return response
 
     @property
     def import_succeeded(self):
-        """ Using json.dumps() to pretty print the dictionary.
-        """
-        return json.dumps(self._import_succeeded, indent=4)
+        """ Number of annotations acknowledged per method. """
+        return json.dumps(self.acks.summary(), separators=(",", ":"))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import json
+import threading
+from collections import Counter
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+"""
+Import acknowledgments. A full acknowledgment echoes every imported
+annotation back in `import_succeeded` which for large chunks is bigger than
+the request. The client asks for less with `?ack=`:
+
+    ids     {"data": {"import_succeeded": ["id", ...], "import_failed": [...]}}
+    counts  {"data": {"import_succeeded": 100, "import_failed": [...]}}
+    full    {"data": {"import_succeeded": [{...}, ...], "import_failed": [...]}}
+
+Failures are always sent in full, they're needed for retrying. Servers that
+don't know `ack` answer with a full acknowledgment and that's fine too, every
+shape is reduced to a count per method. Nothing reads the acknowledged ids so
+they aren't kept, a long run would otherwise grow with every annotation.
+"""
+
+
+modes = ("ids", "counts", "full")
+
+
+class Acknowledgments:
+    """ What the server acknowledged over a whole run, kept as a counter per
+    method instead of the response dicts. """
+
+    def __init__(self, mode="counts"):
+
+        if mode not in modes:
+            raise ValueError(f"Unknown ack mode: {mode}")
+
+        self.mode = mode
+
+        self.succeeded = Counter()
+
+        # Responses are parsed by every upload thread.
+        self._lock = threading.Lock()
+
+    @property
+    def params(self) -> dict:
+        return {} if self.mode == "full" else {"ack": self.mode}
+
+    def parse(self, method, stream) -> list:
+        """ Read an import response from the file-like `stream`, record what
+        succeeded and return `import_failed`. With ijson installed the body
+        is parsed as it arrives and the succeeded part is never built in
+        memory. """
+
+        if ijson is None:
+            count, failed = self._parse_whole(json.load(stream))
+        else:
+            count, failed = self._parse_stream(stream)
+
+        with self._lock:
+            self.succeeded[method] += count
+
+        return failed
+
+    @staticmethod
+    def _parse_stream(stream):
+
+        count = 0
+        failed = []
+        builder = None
+
+        for prefix, event, value in ijson.parse(stream, use_float=True):
+
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == "data.import_failed.item" and event in ("end_map", "end_array"):
+                    failed.append(builder.value)
+                    builder = None
+
+            elif prefix == "data.import_failed.item":
+                if event in ("start_map", "start_array"):
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                else:
+                    failed.append(value)
+
+            elif prefix == "data.import_succeeded" and event == "number":
+                count += int(value)
+
+            elif prefix == "data.import_succeeded.item":
+                if event in ("start_map", "start_array", "string", "number"):
+                    count += 1
+
+        return count, failed
+
+    @staticmethod
+    def _parse_whole(response):
+
+        data = response.get("data") or {}
+
+        succeeded = data.get("import_succeeded") or 0
+
+        count = len(succeeded) if isinstance(succeeded, list) else int(succeeded)
+
+        return count, data.get("import_failed") or []
+
+    def summary(self) -> dict:
+        return {method: count for method, count in self.succeeded.items()}
@@ -6,3 +6,46 @@ class ApiDefaults:
     url_verify = "/api/verify_api_key"
     url_refresh = "/api/import/refresh"
     url_add = "/api/import/add"
+    url_trash = "/api/import/trash"
+    url_export = "/api/export"
+    url_tree = "/api/sync/tree"
+    url_leaves = "/api/sync/leaves"
+
+    # Downloads
+    per_page = 1000
+    stream_chunk_size = 64 * 1024
+    export_name = "annotations"
+
+    # Rate limiting. Overridden per url_base by "rate_limits" in config.json.
+    # A rate of 0 means unlimited, until the server pushes back with 429/503.
+    requests_per_second = 0
+    bytes_per_second = 0
+    max_retries = 5
+    retry_backoff = 1.0
+
+    # Reconciliation
+    tree_depth = 3
+
+    # What import responses echo back: "ids", "counts" or "full". See `ack.py`.
+    ack = "counts"
+
+    # Per-item import failures. See `retry.py`.
+    item_max_attempts = 4
+    item_retry_backoff = 1.0
+    item_retry_batch_size = 100
+    transient_statuses = (408, 409, 423, 425, 429, 500, 502, 503, 504)
+    transient_errors = (
+        "timeout",
+        "timed out",
+        "locked",
+        "busy",
+        "deadlock",
+        "try again",
+        "temporarily",
+        "unavailable",
+        "rate limit",
+    )
+    # A trash of something that's already gone upstream, e.g. deleted on the
+    # web, is as good as done.
+    resolved_trash_statuses = (404, 410)
+    resolved_trash_errors = ("not found",)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Encoder:
+    """ Turns chunks of annotations into request bodies. The body is built
+    as bytes exactly once so it can be handed to requests without another
+    copy.
+
+    orjson is used when it's installed, otherwise a single compact stdlib
+    JSONEncoder is reused for every chunk. Both encode the whole chunk in C.
+    The stdlib one escapes non-ASCII so its output is already bytes-ready,
+    which is faster than emitting UTF-8 and transcoding it.
+    Stitching pre-encoded fragments (source objects, the constant tail of
+    `metadata`) together in Python was measured to be slower than either,
+    see `python3 -m app.benchmarks encode`. """
+
+    def __init__(self, fast=True):
+
+        self.fast = bool(fast and orjson)
+
+        self._json = json.JSONEncoder(separators=(",", ":"), ensure_ascii=True)
+
+    @property
+    def name(self):
+        return "orjson" if self.fast else "json"
+
+    def encode_chunk(self, chunk: list) -> bytes:
+
+        if self.fast:
+            return orjson.dumps(chunk)
+
+        return self._json.encode(chunk).encode("ascii")
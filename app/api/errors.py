@@ -6,3 +6,19 @@ from ..errors import ApplicationError
 class ApiError(ApplicationError):
     def __init__(self, message, app=None):
         super().__init__(message, app)
+
+
+class ApiUnreachableError(ApiError):
+    """ The server couldn't be reached or answered with a 5xx. The request
+    is safe to retry later. """
+
+    def __init__(self, message, app=None):
+        super().__init__(message, app)
+
+
+class ApiServerError(ApiUnreachableError):
+    """ The server was reached but answered with a 5xx, or kept answering
+    429. """
+
+    def __init__(self, message, app=None):
+        super().__init__(message, app)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+class TokenBucket:
+    """ Classic token bucket. `rate` tokens are added per second up to
+    `capacity`. A `rate` of 0 disables the bucket. """
+
+    def __init__(self, rate: float, capacity: float = None):
+
+        self.rate = rate
+        self.capacity = capacity or rate
+
+        self._fixed_capacity = capacity
+
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1) -> None:
+
+        if not self.rate:
+            return
+
+        # Never ask for more than the bucket can hold or we'd wait forever.
+        tokens = min(tokens, self.capacity)
+
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def set_rate(self, rate: float) -> None:
+
+        with self._lock:
+            self._refill()
+            self.rate = rate
+            if not self._fixed_capacity:
+                self.capacity = max(self.capacity, rate)
+            self._tokens = min(self._tokens, self.capacity)
+
+    def _refill(self):
+
+        now = time.monotonic()
+
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class RateLimiter:
+    """ Limits requests per second and bytes per second to a single server.
+    Limiters are shared per `url_base` through `for_url` so every ApiConnect
+    talking to the same instance draws from the same buckets.
+
+    When the server pushes back with 429/503 the rates are halved and all
+    requests pause until `Retry-After` has passed. Each successful request
+    then adds back a tenth of the configured rate until it's fully
+    recovered.
+
+    Without a configured request rate nothing is limited until the first
+    push back. The rate seen over the last `window` seconds then becomes the
+    one that's halved and recovered, and once fully recovered requests are
+    unlimited again. """
+
+    _registry = {}
+    _registry_lock = threading.Lock()
+
+    min_factor = 1 / 16
+    recovery_step = 0.1
+    window = 1.0
+
+    def __init__(self, requests_per_second: float = 0, bytes_per_second: float = 0):
+
+        self.requests_per_second = requests_per_second
+        self.bytes_per_second = bytes_per_second
+
+        self._requests = TokenBucket(requests_per_second)
+        self._bytes = TokenBucket(bytes_per_second)
+
+        self._factor = 1.0
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+        # Rate limited to after a push back when none is configured.
+        self._ceiling = 0.0
+        self._sent = deque()
+
+    @classmethod
+    def for_url(cls, url_base: str, requests_per_second=0, bytes_per_second=0):
+
+        with cls._registry_lock:
+            try:
+                return cls._registry[url_base]
+            except KeyError:
+                limiter = cls._registry[url_base] = cls(
+                    requests_per_second, bytes_per_second
+                )
+                return limiter
+
+    def acquire(self, size: int = 0) -> None:
+
+        pause = self._paused_until - time.monotonic()
+
+        if pause > 0:
+            time.sleep(pause)
+
+        self._requests.acquire(1)
+        self._bytes.acquire(size)
+
+        if not self.requests_per_second:
+            now = time.monotonic()
+            with self._lock:
+                self._sent.append(now)
+                while self._sent[0] < now - self.window:
+                    self._sent.popleft()
+
+    def backoff(self, retry_after: float) -> None:
+
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            if not self.requests_per_second and not self._ceiling:
+                self._ceiling = max(1.0, len(self._sent) / self.window)
+            self._set_factor(max(self.min_factor, self._factor / 2))
+
+    def recover(self) -> None:
+
+        if self._factor >= 1.0:
+            return
+
+        with self._lock:
+            self._set_factor(min(1.0, self._factor + self.recovery_step))
+
+    def _set_factor(self, factor):
+
+        self._factor = factor
+
+        requests_per_second = self.requests_per_second
+
+        if not requests_per_second:
+            if factor >= 1.0:
+                self._ceiling = 0.0
+            requests_per_second = self._ceiling
+
+        self._requests.set_rate(requests_per_second * factor)
+        self._bytes.set_rate(self.bytes_per_second * factor)
+
+    @staticmethod
+    def parse_retry_after(value, default: float) -> float:
+        """ Retry-After is either a number of seconds or an HTTP date. """
+
+        if not value:
+            return default
+
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return default
+
+        return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
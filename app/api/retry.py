@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import threading
+from datetime import datetime
+
+from .defaults import ApiDefaults
+from ..errors import ApplicationError
+
+
+class RetryQueue:
+    """ Second chance for annotations the server reported in
+    `import_failed`.
+
+    Every failure is classified as transient or permanent by `classify`.
+    Transient ones are held back by method and, once the upload is done,
+    re-sent in rounds with exponential backoff. Each round packs whatever is
+    still pending from every chunk into full `batch_size` chunks so a few
+    failures scattered over the whole run cost a couple of requests, not
+    a rerun. After `max_attempts` they're given up on.
+
+    Permanent failures, and transient ones that were given up on, are
+    appended to a JSON-lines file with the reason so they can be looked at
+    and re-sent by hand. Only the latter are `outstanding`, permanent ones
+    won't go through on the next run either so they don't hold it back.
+
+    Trashing something the server no longer has isn't a failure at all, see
+    `drop_resolved`. """
+
+    def __init__(
+        self,
+        app,
+        max_attempts=ApiDefaults.item_max_attempts,
+        backoff=ApiDefaults.item_retry_backoff,
+        batch_size=ApiDefaults.item_retry_batch_size,
+    ):
+
+        self.app = app
+
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.batch_size = batch_size
+
+        # {method: {id: (item, attempts, reason)}}
+        self._pending = {}
+        self.failed = []
+
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(items) for items in self._pending.values())
+
+    @property
+    def outstanding(self) -> bool:
+        """ True if anything is still pending or was given up on after
+        transient failures, i.e. a later run could still get it through. """
+        return bool(len(self)) or any(record["transient"] for record in self.failed)
+
+    @staticmethod
+    def drop_resolved(failures, method) -> list:
+        """ `failures` without trashes the server answered with "not found".
+        The annotation is already gone upstream. """
+
+        if method != "trash":
+            return failures
+
+        def resolved(failure):
+
+            if not isinstance(failure, dict):
+                return False
+
+            status = failure.get("status") or failure.get("code")
+
+            if isinstance(status, int):
+                return status in ApiDefaults.resolved_trash_statuses
+
+            error = str(failure.get("error") or failure.get("message") or "").lower()
+
+            return any(words in error for words in ApiDefaults.resolved_trash_errors)
+
+        return [failure for failure in failures if not resolved(failure)]
+
+    @staticmethod
+    def classify(failure) -> str:
+        """ "transient" if re-sending the same annotation could succeed,
+        otherwise "permanent". Uses the failure's status code if it has one,
+        else looks for tell-tale words in its error message. """
+
+        if not isinstance(failure, dict) or not failure.get("id"):
+            return "permanent"
+
+        status = failure.get("status") or failure.get("code")
+
+        if isinstance(status, int):
+            return "transient" if status in ApiDefaults.transient_statuses else "permanent"
+
+        error = str(failure.get("error") or failure.get("message") or "").lower()
+
+        if any(word in error for word in ApiDefaults.transient_errors):
+            return "transient"
+
+        return "permanent"
+
+    @staticmethod
+    def reason(failure) -> str:
+
+        if not isinstance(failure, dict):
+            return repr(failure)
+
+        return str(failure.get("error") or failure.get("message") or failure)
+
+    def add(self, chunk, method, failures, attempts=1) -> None:
+        """ Queue the items of `chunk` named in `failures`. """
+
+        if not failures:
+            return
+
+        items = {item["id"]: item for item in chunk}
+
+        with self._lock:
+
+            for failure in failures:
+
+                id_ = failure.get("id") if isinstance(failure, dict) else None
+                item = items.get(id_)
+                reason = self.reason(failure)
+
+                if item is None or self.classify(failure) == "permanent":
+                    self._fail(method, id_, item, attempts, reason)
+                elif attempts >= self.max_attempts:
+                    self._fail(
+                        method, id_, item, attempts, f"Gave up: {reason}", transient=True
+                    )
+                else:
+                    self._pending.setdefault(method, {})[id_] = (item, attempts, reason)
+
+    def give_up(self, chunk, method, reason, attempts) -> None:
+        """ Record every item of `chunk` as failed without retrying it. The
+        server never said what was wrong with them so a later run could
+        still get them through. """
+
+        with self._lock:
+            for item in chunk:
+                self._fail(method, item.get("id"), item, attempts, reason, transient=True)
+
+    def run(self, send) -> None:
+        """ Retry everything pending. `send(chunk, method)` returns that
+        chunk's `import_failed` and is expected to spool the chunk itself
+        if the server is unreachable. """
+
+        total = len(self)
+
+        if not total:
+            return
+
+        print(f"Retrying {total} annotations that failed to import...")
+
+        self.app.progress.start("retry", total)
+
+        round_ = 0
+
+        while len(self):
+
+            time.sleep(self.backoff * 2 ** round_)
+            round_ += 1
+
+            with self._lock:
+                pending, self._pending = self._pending, {}
+
+            for method, items in pending.items():
+
+                items = list(items.values())
+
+                for x in range(0, len(items), self.batch_size):
+
+                    batch = items[x : x + self.batch_size]
+                    chunk = [item for item, _, _ in batch]
+
+                    self.app.metrics.item_retries.inc(len(chunk), method=method)
+
+                    failures = send(chunk, method)
+
+                    attempts = {item["id"]: count + 1 for item, count, _ in batch}
+
+                    requeued = len(self)
+
+                    for failure in failures:
+                        id_ = failure.get("id") if isinstance(failure, dict) else None
+                        self.add(chunk, method, [failure], attempts=attempts.get(id_, 1))
+
+                    # Whatever wasn't queued again is done with, one way or
+                    # the other.
+                    self.app.progress.advance(len(chunk) - (len(self) - requeued))
+
+        self.app.progress.finish()
+
+    def persist(self, path) -> None:
+        """ Append every failure we've given up on to `path`. """
+
+        if not self.failed:
+            return
+
+        try:
+            with open(path, "a") as f:
+                for record in self.failed:
+                    f.write(json.dumps(record) + "\n")
+        except OSError as error:
+            raise ApplicationError(f"{error.filename} - {error.strerror}", self.app)
+
+    def _fail(self, method, id_, item, attempts, reason, transient=False):
+
+        self.failed.append(
+            {
+                "date": datetime.utcnow().isoformat(),
+                "method": method,
+                "id": id_,
+                "attempts": attempts,
+                "reason": reason,
+                "transient": transient,
+                "annotation": item,
+            }
+        )
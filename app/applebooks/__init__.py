@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
-import re
 import json
+import time
 import psutil
 import pathlib
 import sqlite3
@@ -10,6 +10,11 @@ from datetime import datetime
 
 from .defaults import AppleBooksDefaults
 from .errors import AppleBooksError
+from .cfi import SourceIndex, cfi_key
+from .dedup import Deduplicator
+from .routing import Router
+from .snapshot import SnapshotDiffer, fingerprint
+from .transform import Transformer
 
 
 home = Path.home()
@@ -22,17 +27,198 @@ class AppleBooks:
 
         self.app = app
 
+        self.router = Router.from_config(self.app.config)
+        self.transformer = Transformer.from_config(self.app.config)
+        self.deduplicator = Deduplicator.from_config(self.app.config)
+
         self._build_directories()
 
     def manage(self):
 
+        self.prepare()
+        self._build_annotations()
+        self._sort_annotations()
+        self._dedup_annotations()
+        self._count_routed()
+
+        self.app.progress.finish()
+
+    def prepare(self):
+        """ Snapshot the Books databases and read the sources and deleted
+        annotations. Everything else reads from the snapshot. """
+
         if self._applebooks_running():
             raise AppleBooksError("Apple Books currently running.", self.app)
 
+        self.app.progress.start("read")
+
         self._copy_databases()
         self._query_applebooks_db()
-        self._build_annotations()
-        self._sort_annotations()
+        self._query_deleted()
+
+        if getattr(self.app.args, "changed", False):
+            self._diff_snapshot()
+
+    def read_batches(self):
+        """ Yield batches of raw annotations with their source attached. """
+
+        sources = self._index_sources()
+
+        for batch in self.db.iter_annotations(AppleBooksDefaults.batch_size):
+            self.app.metrics.annotations_read.inc(len(batch), reader="applebooks")
+            yield self._attach_sources(batch, sources)
+
+    def route(self, transformed):
+        """ Pipelined counterpart of `_build_annotations`, `_sort_annotations`
+        and `_dedup_annotations`. Takes the `(batch, payloads)` stream from
+        `Transformer.map` and yields `(bucket, annotations)` per source,
+        where `bucket` is a Router bucket or "collapsed".
+
+        `annotation_query` is ordered by asset id so all of a source's
+        annotations arrive together. Each source is held back only until the
+        next one starts, sorted into reading order, routed and deduplicated
+        on its own, so memory is bounded by the largest book rather than the
+        library. """
+
+        self._counts = dict.fromkeys(self.router.buckets + ("unsorted", "collapsed"), 0)
+
+        source_id = None
+        bucket = []
+
+        for batch, payloads in transformed:
+
+            for raw_annotation, payload in zip(batch, payloads):
+
+                annotation = Annotation(self.app, raw_annotation, payload)
+
+                if annotation.source_id != source_id and bucket:
+                    yield from self._route_source(bucket)
+                    bucket = []
+
+                source_id = annotation.source_id
+                bucket.append(annotation)
+
+        if bucket:
+            yield from self._route_source(bucket)
+
+    def _route_source(self, annotations):
+
+        sources = SourceIndex(annotations)
+
+        bins = {}
+
+        rank = self.router.rank
+
+        for annotation in sources.annotations():
+
+            bucket = self.router.bucket(
+                rank(
+                    annotation._color,
+                    annotation._applebooks_collections,
+                    annotation.tags,
+                    annotation.data.get("author"),
+                )
+            )
+            bins.setdefault(bucket, []).append(annotation)
+
+        if self.deduplicator.enabled:
+            for bucket in AppleBooksDefaults.sent_buckets:
+                kept, collapsed = self._dedup(bins.get(bucket, []))
+                if collapsed:
+                    bins[bucket] = kept
+                    bins.setdefault("collapsed", []).extend(collapsed)
+
+        for bucket, annotations in bins.items():
+            self.app.metrics.annotations_routed.inc(len(annotations), bucket=bucket)
+            if bucket in self._counts:
+                self._counts[bucket] += len(annotations)
+            yield bucket, [annotation.serialize() for annotation in annotations]
+
+    def _dedup(self, annotations):
+        """ Deduplicate the annotations of one bucket and log what was
+        collapsed. Returns `(kept, collapsed)` annotations. """
+
+        groups = self.deduplicator.run(SourceIndex(annotations))
+
+        if not groups:
+            return annotations, []
+
+        collapsed = set()
+
+        for kept, others in groups:
+            collapsed.update(annotation.id for annotation in others)
+            self.app.logger.info(
+                f"Collapsed {[annotation.id for annotation in others]} into {kept.id} "
+                f"({self.deduplicator.policy})."
+            )
+
+        return (
+            [annotation for annotation in annotations if annotation.id not in collapsed],
+            [annotation for annotation in annotations if annotation.id in collapsed],
+        )
+
+    @property
+    def routed_counts(self):
+        """ Annotations per bucket seen by `route`. """
+        return self._counts
+
+    def commit_deleted(self):
+        """ Call once trashing has succeeded upstream so the next run only
+        looks at annotations deleted after this one. """
+        self.app.mirror.set_state(AppleBooksDefaults.deleted_since_key, self._deleted_since)
+
+    def commit_snapshot(self):
+        """ Keep the snapshot that was just synced as the baseline the next
+        `--changed` run is diffed against. Only call this once everything was
+        accepted upstream, otherwise failed annotations wouldn't show up as
+        changed next time. """
+
+        baseline_dir = AppleBooksDefaults.local_baseline_dir
+        staging_dir = baseline_dir.with_name(f"{baseline_dir.name}.tmp")
+
+        self.app.utils.delete_dir(path=staging_dir)
+        self.app.utils.copy_dir(src=AppleBooksDefaults.local_db_dir, dest=staging_dir)
+
+        with open(staging_dir / AppleBooksDefaults.local_baseline_file.name, "w") as f:
+            json.dump({"taken": time.time(), "config": fingerprint(self.app.config)}, f)
+
+        self.app.utils.delete_dir(path=baseline_dir)
+        staging_dir.rename(baseline_dir)
+
+    def _diff_snapshot(self):
+        """ Restrict this run to annotations whose rows, or whose source's
+        rows, differ from the baseline. See `snapshot.py`. Without a usable
+        baseline everything is sent. """
+
+        try:
+            with open(AppleBooksDefaults.local_baseline_file, "r") as f:
+                baseline = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            baseline = {}
+
+        if not baseline:
+            print("No previous sync to compare with, sending everything.")
+            return
+
+        if baseline.get("config") != fingerprint(self.app.config):
+            print("Routing settings changed since the previous sync, sending everything.")
+            return
+
+        differ = SnapshotDiffer(
+            AppleBooksDefaults.local_baseline_dir, AppleBooksDefaults.local_db_dir
+        )
+
+        changes = differ.diff(whole_sources=self.deduplicator.enabled)
+
+        self.db.ids = changes["annotations"]
+
+        self.app.logger.info(
+            f"Snapshot diff: {changes['rows']} annotation rows added or changed, "
+            f"{len(changes['sources'])} sources changed, "
+            f"{len(self.db.ids)} annotations to send."
+        )
+
+        print(f"{len(self.db.ids)} annotations changed since the previous sync.")
 
     def _applebooks_running(self):
         """ Check to see if AppleBooks is currently running.
@@ -64,6 +250,18 @@ class AppleBooks:
         # Create local_root_dir
         self.app.utils.make_dir(path=AppleBooksDefaults.local_root_dir)
 
+    def _copy_databases(self):
+        """ Copy AppleBooks database directories to Local Data directories.
+
+        This used to happen when AppleBooks was instantiated, which let an
+        overlapping run delete the snapshot from under another one. It now
+        only happens while holding the run lock. Today's snapshot is reused
+        if Books hasn't written to its databases since it was taken. """
+
+        if self._snapshot_is_current():
+            self.app.logger.info(f"Reusing snapshot in {AppleBooksDefaults.local_db_dir}.")
+            return
+
         # Delete local_day_dir. Just in case app is run more than once a day.
         self.app.utils.delete_dir(path=AppleBooksDefaults.local_day_dir)
 
@@ -71,8 +269,7 @@ class AppleBooks:
         for path in [AppleBooksDefaults.local_day_dir, AppleBooksDefaults.local_db_dir]:
             self.app.utils.make_dir(path=path)
 
-    def _copy_databases(self):
-        """ Copy AppleBooks database directories to Local Data directories. """
+        taken = time.time()
 
         # Copy directory containing BKLibrary###.sqlite files.
         self.app.utils.copy_dir(
@@ -84,40 +281,147 @@ class AppleBooks:
             src=AppleBooksDefaults.src_aeannotation_dir,
             dest=AppleBooksDefaults.local_aeannotation_dir)
 
+        with open(AppleBooksDefaults.local_snapshot_file, "w") as f:
+            json.dump({"taken": taken}, f)
+
+    def _snapshot_is_current(self):
+
+        try:
+            with open(AppleBooksDefaults.local_snapshot_file, "r") as f:
+                taken = json.load(f)["taken"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return False
+
+        try:
+            modified = [
+                path.stat().st_mtime
+                for directory in (
+                    AppleBooksDefaults.src_bklibrary_dir,
+                    AppleBooksDefaults.src_aeannotation_dir,
+                )
+                for path in directory.iterdir()
+            ]
+        except FileNotFoundError:
+            return False
+
+        return bool(modified) and max(modified) < taken
+
     def _query_applebooks_db(self):
 
         self.db = ConnectToAppleBooksDB(self.app)
 
         self._raw_sources = self.db.query_sources()
-        self._raw_annotations = self.db.query_annotations()
+
+        self.app.progress.advance(len(self._raw_sources))
+
+    def _query_deleted(self):
+        """ Find annotations deleted in Books since the last sync. Only those
+        the mirror knows we sent upstream need to be trashed on the server.
+        """
+
+        since = self.app.mirror.get_state(AppleBooksDefaults.deleted_since_key, 0.0)
+
+        raw_deleted = self.db.query_deleted(since)
+
+        self._trashing = self.app.mirror.known_ids(row["id"] for row in raw_deleted)
+        self._deleted_since = max((row["modified"] for row in raw_deleted), default=since)
 
     def _build_annotations(self):
-        """ TODO: Document what this code is doing and how it's doing it."""
+        """ Attach source name, author and Apple Books collections to every
+        raw annotation, then run the batches through the Transformer which
+        parses notes, normalizes passages and converts dates.
+
+        Raw annotations are streamed from the database in batches. Passing
+        `--workers` runs the Transformer in a process pool. """
 
         self._annotations = []
 
-        for raw_annotation in self._raw_annotations:
+        batches = self.read_batches()
+
+        workers = getattr(self.app.args, "workers", 1)
 
-            for raw_source in self._raw_sources:
+        self.app.progress.start("transform", self.db.count_annotations())
 
-                if raw_annotation["source_id"] == raw_source["id"]:
+        for batch, payloads in self.transformer.map(batches, workers=workers):
 
-                    """ TODO: Not sure what this if block is checking. """
-                    if not raw_annotation.get("source") \
-                       and not raw_annotation.get("author"):
-                        raw_annotation["source"] = raw_source["name"]
-                        raw_annotation["author"] = raw_source["author"]
+            self.app.progress.advance(len(batch))
 
-                    try:
-                        raw_annotation["applebooks_collections"]
-                    except KeyError:
-                        raw_annotation["applebooks_collections"] = []
-                    finally:
-                        raw_annotation["applebooks_collections"].append(raw_source["books_collection"])
+            for raw_annotation, payload in zip(batch, payloads):
+
+                annotation = Annotation(self.app, raw_annotation, payload)
+
+                self._annotations.append(annotation)
+
+        # Order everything book by book in reading order. Routing keeps this
+        # order so uploads and exports come out the same way.
+        self.sources = SourceIndex(self._annotations)
+        self._annotations = list(self.sources.annotations())
+
+    def _index_sources(self):
+        """ Group source rows by asset id. A book in more than one collection
+        shows up once per collection in `source_query`. """
+
+        sources = {}
+
+        for raw_source in self._raw_sources:
+
+            source = sources.setdefault(
+                raw_source["id"], (raw_source["name"], raw_source["author"], [])
+            )
+            source[2].append(raw_source["books_collection"])
+
+        return sources
+
+    @staticmethod
+    def _attach_sources(batch, sources):
+        """ `source_query` only returns books in a user collection. The
+        annotations of any other book get no source and route to
+        "unsorted". """
 
-            annotation = Annotation(self.app, raw_annotation)
+        for raw_annotation in batch:
 
-            self._annotations.append(annotation)
+            name, author, collections = sources.get(
+                raw_annotation["source_id"], (None, None, [])
+            )
+
+            raw_annotation["source"] = name
+            raw_annotation["author"] = author
+            raw_annotation["applebooks_collections"] = list(collections)
+
+        return batch
+
+    def _dedup_annotations(self):
+        """ Collapse near-duplicate highlights per source according to the
+        configured dedup policy. See `dedup.py`. Runs after routing and only
+        within the buckets that are sent, so a highlight that's sent is
+        never collapsed into one that's skipped or ignored. """
+
+        self._collapsed = set()
+
+        if not self.deduplicator.enabled:
+            return
+
+        sent = [self._adding, self._refreshing]
+
+        self.app.progress.start("dedup", sum(len(bucket) for bucket in sent))
+
+        for bucket in sent:
+            kept, collapsed = self._dedup(bucket)
+            bucket[:] = kept
+            self._collapsed.update(annotation.id for annotation in collapsed)
+            self.app.progress.advance(len(kept) + len(collapsed))
+
+        if not self._collapsed:
+            return
+
+        self._annotations = [
+            annotation
+            for annotation in self._annotations
+            if annotation.id not in self._collapsed
+        ]
+        self.sources = SourceIndex(self._annotations)
+
+        self.app.logger.info(f"Collapsed {len(self._collapsed)} near-duplicate annotations.")
 
     def _sort_annotations(self):
         """ If an annotation contains two conflicting "applebooks_collections", it
@@ -126,10 +430,8 @@ class AppleBooks:
         down the line to "add". Everything else that remains is placed into
         "unsorted" which acts as a catch-all if no collections are specified.
 
-        TODO: Clean variable names here. It's kinda messy and confusing. Also,
-        will anything ever make it into the "unsorted" bin with our current
-        setup?
-        """
+        The actual decision is made by `Router` which is compiled once from
+        the Config. See `routing.py` for the optional per-rule routing. """
 
         self._adding = []
         self._refreshing = []
@@ -137,31 +439,42 @@ class AppleBooks:
         self._skipping = []
         self._unsorted = []
 
-        abc_config = self.app.utils.to_lowercase(self.app.config.applebooks_collections)
+        # Indexed by Router rank.
+        bins = [
+            self._skipping,
+            self._ignoring,
+            self._refreshing,
+            self._adding,
+            self._unsorted,
+        ]
 
-        adding_collection = abc_config.get("add", "")
-        refreshing_collection = abc_config.get("refresh", "")
-        ignoring_collection = abc_config.get("ignore", "")
+        rank = self.router.rank
 
         for annotation in self._annotations:
 
-            applebooks_collections = self.app.utils.to_lowercase(annotation._applebooks_collections)
-
-            if annotation.is_skipped:
-                self._skipping.append(annotation)
-                continue
-
-            if ignoring_collection in applebooks_collections:
-                self._ignoring.append(annotation)
-
-            elif refreshing_collection in applebooks_collections:
-                self._refreshing.append(annotation)
+            bins[
+                rank(
+                    annotation._color,
+                    annotation._applebooks_collections,
+                    annotation.tags,
+                    annotation.data.get("author"),
+                )
+            ].append(annotation)
+
+    def _count_routed(self):
+
+        bins = {
+            "skip": self._skipping,
+            "ignore": self._ignoring,
+            "refresh": self._refreshing,
+            "add": self._adding,
+            "unsorted": self._unsorted,
+        }
 
-            elif adding_collection in applebooks_collections:
-                self._adding.append(annotation)
+        for bucket, annotations in bins.items():
+            self.app.metrics.annotations_routed.inc(len(annotations), bucket=bucket)
 
-            else:
-                self._unsorted.append(annotation)
+        self.app.metrics.annotations_routed.inc(len(self._collapsed), bucket="collapsed")
 
     @property
     def data(self):
@@ -190,6 +503,8 @@ class AppleBooks:
                 "ignore": len(self.ignoring_annotations),
                 "skip": len(self.skipping_annotations),
                 "unsorted": len(self.unsorted_annotations),
+                "trash": len(self.trashing_ids),
+                "collapsed": len(self.collapsed_ids),
             }
         }
 
@@ -223,6 +538,14 @@ class AppleBooks:
     def unsorted_annotations(self):
         return self._to_multiple_dict(self._unsorted)
 
+    @property
+    def trashing_ids(self):
+        return self._trashing
+
+    @property
+    def collapsed_ids(self):
+        return self._collapsed
+
     def export_to_json(self, directory, filename):
         with open(directory / filename, 'w') as f:
             json.dump(self.data, f, indent=4)
@@ -230,86 +553,40 @@ class AppleBooks:
 
 class Annotation:
 
-    def __init__(self, app, data: dict):
+    def __init__(self, app, data: dict, serialized: dict = None):
+        """ `serialized` is the Transformer output for `data`. It's passed in
+        when the annotation was transformed in bulk, otherwise it's computed
+        here. """
 
         self.app = app
         self.data = data
 
-        self._process_passage()
-        self._process_notes()
+        if serialized is None:
+            serialized = self.app.applebooks.transformer.serialize(data)
 
-    def _process_passage(self):
+        self._serialized = serialized
 
-        passage = self.data["passage"]
-
-        self._passage = passage.replace("\n", "\n\n")
-
-    def _process_notes(self):
-        """ TODO: This whole method is really hard to understand. Can we
-        possibly simplify it in any way?
-        """
-
-        _notes = self.data["notes"]
-
-        prefix_tag = self.app.config.prefix_tag
-        prefix_collection = self.app.config.prefix_collection
-
-        re_prefix_tag = re.compile(prefix_tag)
-        re_tag_pattern = re.compile(self._re_pattern(prefix_tag))
-        re_prefix_collection = re.compile(prefix_collection)
-        re_collection_pattern = re.compile(self._re_pattern(prefix_collection))
-
-        if _notes:
-
-            # Extract tags from notes.
-            tags = re.findall(re_tag_pattern, _notes)
-            tags = [tag.strip() for tag in tags]
-            tags = [re.sub(re_prefix_tag, "", tag) for tag in tags]
-
-            # Extract collections from notes.
-            collections = re.findall(re_collection_pattern, _notes)
-            collections = [collection.strip() for collection in collections]
-            collections = [re.sub(re_prefix_collection, "", collection) for collection in collections]
-
-            # Remove tags from notes.
-            notes = re.sub(re_tag_pattern, "", _notes)
-            notes = re.sub(re_collection_pattern, "", notes)
-            notes = notes.strip()
-
-        else:
-
-            notes = ""
-            tags = []
-            collections = []
-
-        self._notes = notes
-        self._tags = tags
-        self._collections = collections
-
-    def _re_pattern(self, prefix):
-        return f"\B{prefix}[^{prefix}\s]+\s?"
-
-    def _convert_date(self, epoch: float) -> str:
-        """ Converts Epoch to ISO861"""
-
-        seconds_since_epoch = float(epoch) + AppleBooksDefaults.ns_time_interval_since_1970
-
-        date = datetime.utcfromtimestamp(seconds_since_epoch)
-        date = date.isoformat()
-
-        return date
+        self.location_key = cfi_key(data.get("location"))
 
     @property
     def id(self):
         return self.data["id"]
 
+    @property
+    def source_id(self):
+        return self.data["source_id"]
+
+    @property
+    def location(self):
+        return self.data.get("location")
+
     @property
     def passage(self):
-        return self._passage
+        return self._serialized["passage"]
 
     @property
     def notes(self):
-        return self._notes
+        return self._serialized["notes"]
 
     @property
     def source_name(self):
@@ -321,19 +598,19 @@ class Annotation:
 
     @property
     def tags(self):
-        return self._tags
+        return self._serialized["tags"]
 
     @property
     def collections(self):
-        return self._collections
+        return self._serialized["collections"]
 
     @property
     def created(self):
-        return self._convert_date(self.data["created"])
+        return self._serialized["metadata"]["created"]
 
     @property
     def modified(self):
-        return self._convert_date(self.data["modified"])
+        return self._serialized["metadata"]["modified"]
 
     @property
     def _color(self):
@@ -341,51 +618,43 @@ class Annotation:
 
     @property
     def _applebooks_collections(self):
-        return self.data["applebooks_collections"]
+        return self.data.get("applebooks_collections", [])
+
+    def merge(self, others):
+        """ Fold the notes, tags and collections of `others` into this
+        annotation. The serialized dict is shared so it's replaced, not
+        modified in place. """
+
+        annotations = [self] + others
+
+        notes = "\n\n".join(
+            dict.fromkeys(annotation.notes for annotation in annotations if annotation.notes)
+        )
+        tags = list(dict.fromkeys(tag for annotation in annotations for tag in annotation.tags))
+        collections = list(
+            dict.fromkeys(
+                collection
+                for annotation in annotations
+                for collection in annotation.collections
+            )
+        )
+
+        self._serialized = {
+            **self._serialized,
+            "notes": notes,
+            "tags": tags,
+            "collections": collections,
+        }
 
     @property
     def is_skipped(self):
         """ Skip annotations based on User Config. """
 
-        color = self._color
-
-        if color == 0 and self.app.config.applebooks_colors["underline"]:
-            return False
-        if color == 1 and self.app.config.applebooks_colors["green"]:
-            return False
-        if color == 2 and self.app.config.applebooks_colors["blue"]:
-            return False
-        if color == 3 and self.app.config.applebooks_colors["yellow"]:
-            return False
-        if color == 4 and self.app.config.applebooks_colors["pink"]:
-            return False
-        if color == 5 and self.app.config.applebooks_colors["purple"]:
-            return False
-
-        return True
+        return not self.app.applebooks.router.color_enabled(self._color)
 
     def serialize(self):
-
-        data = {
-            "id": self.id,
-            "passage": self.passage,
-            "notes": self.notes,
-            "source": {
-                "name": self.source_name,
-                "author": self.source_author,
-            },
-            "tags": self.tags,
-            "collections": self.collections,
-            "metadata": {
-                "created": self.created,
-                "modified": self.modified,
-                "origin": AppleBooksDefaults.origin,
-                "is_protected": False,
-                "in_trash": False,
-            }
-        }
-
-        return data
+        """ The returned dict is shared, treat it as read-only. """
+        return self._serialized
 
 
 class ConnectToAppleBooksDB:
@@ -394,6 +663,9 @@ class ConnectToAppleBooksDB:
 
         self.app = app
 
+        # Restricts annotation reads to these ids when set.
+        self.ids = None
+
     def query_sources(self):
 
         bklibrary_sqlite = self._get_sqlite(AppleBooksDefaults.local_bklibrary_dir)
@@ -414,6 +686,68 @@ class ConnectToAppleBooksDB:
 
         return data
 
+    def count_annotations(self) -> int:
+
+        aeannotation_sqlite = self._get_sqlite(AppleBooksDefaults.local_aeannotation_dir)
+
+        connection = self._connect_to_db(aeannotation_sqlite)
+
+        with connection:
+            query = self._annotation_query(connection).strip().rstrip(";")
+            cursor = connection.execute(f"SELECT COUNT(*) as count FROM ({query});")
+            data = cursor.fetchone()
+
+        return data["count"]
+
+    def query_deleted(self, since: float):
+
+        aeannotation_sqlite = self._get_sqlite(AppleBooksDefaults.local_aeannotation_dir)
+
+        connection = self._connect_to_db(aeannotation_sqlite)
+
+        with connection:
+            cursor = connection.execute(AppleBooksDefaults.deleted_annotation_query, (since,))
+            data = cursor.fetchall()
+
+        return data
+
+    def iter_annotations(self, batch_size):
+        """ Yield annotation rows in lists of up to `batch_size` rows instead
+        of fetching the whole table at once. """
+
+        aeannotation_sqlite = self._get_sqlite(AppleBooksDefaults.local_aeannotation_dir)
+
+        connection = self._connect_to_db(aeannotation_sqlite)
+
+        try:
+            cursor = connection.execute(self._annotation_query(connection))
+
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield batch
+        finally:
+            connection.close()
+
+    def _annotation_query(self, connection) -> str:
+        """ `annotation_query`, or when `ids` is set, the part of it that's
+        in `ids`, still ordered by source. """
+
+        if self.ids is None:
+            return AppleBooksDefaults.annotation_query
+
+        connection.execute("CREATE TEMP TABLE IF NOT EXISTS only_ids (id TEXT PRIMARY KEY)")
+        connection.execute("DELETE FROM only_ids")
+        connection.executemany("INSERT INTO only_ids VALUES (?)", ((id_,) for id_ in self.ids))
+
+        query = AppleBooksDefaults.annotation_query.strip().rstrip(";")
+
+        return (
+            f"SELECT * FROM ({query}) WHERE id IN (SELECT id FROM only_ids) "
+            "ORDER BY source_id;"
+        )
+
     def _get_sqlite(self, path: pathlib.Path) -> pathlib.Path:
         """ Glob full database path.
         """
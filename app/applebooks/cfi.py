@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+import re
+
+
+"""
+EPUB Canonical Fragment Identifiers. Apple Books stores the position of an
+annotation as a CFI e.g.
+
+    epubcfi(/6/24[chapter-3]!/4/2/16,/1:0,/1:112)
+
+Every step (/24) is an index into the children of the previous node and the
+trailing :N is a character offset. Reading order is therefore the order of
+the step indices compared one by one, which is exactly how Python compares
+tuples. `cfi_key` parses a CFI once into such a tuple so annotations can be
+sorted by position without parsing the string on every comparison.
+
+via. http://idpf.org/epub/linking/cfi/epub-cfi.html
+"""
+
+
+# Anything that's unparseable sorts after everything that is.
+UNKNOWN = (float("inf"),)
+
+# Assertions [...], which may contain ^-escaped characters, plus temporal
+# ~N and spatial @X:Y offsets. None of them affect position in the text.
+_re_ignored = re.compile(r"\[(?:\^.|[^\]])*\]|~[\d.]+|@[\d.]+:[\d.]+")
+_re_token = re.compile(r"([/:])(\d+)|!")
+
+
+def cfi_key(cfi) -> tuple:
+
+    if not cfi:
+        return UNKNOWN
+
+    cfi = cfi.strip()
+
+    if cfi.startswith("epubcfi(") and cfi.endswith(")"):
+        cfi = cfi[8:-1]
+
+    cfi = _re_ignored.sub("", cfi)
+
+    # A range is "parent,start,end". Its position is where it starts.
+    parts = cfi.split(",")
+    path = parts[0] + parts[1] if len(parts) == 3 else parts[0]
+
+    key = tuple(int(number) for _, number in _re_token.findall(path) if number)
+
+    if not key or not path.startswith("/"):
+        return UNKNOWN
+
+    return key
+
+
+class SourceIndex:
+    """ Annotations grouped per source, each bucket sorted by reading
+    position. Iterating the index yields sources in the order they were
+    first seen. """
+
+    def __init__(self, annotations):
+
+        self._sources = {}
+
+        for annotation in annotations:
+            self._sources.setdefault(annotation.source_id, []).append(annotation)
+
+        for bucket in self._sources.values():
+            bucket.sort(key=lambda annotation: annotation.location_key)
+
+    def __iter__(self):
+        return iter(self._sources.items())
+
+    def __len__(self):
+        return len(self._sources)
+
+    def __getitem__(self, source_id):
+        return self._sources[source_id]
+
+    def annotations(self):
+        """ Every annotation, book by book, in reading order. """
+        for bucket in self._sources.values():
+            yield from bucket
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import re
+from collections import Counter, defaultdict
+
+from .errors import AppleBooksError
+
+
+class Deduplicator:
+    """ Collapses overlapping highlights of the same passage. Re-highlighting
+    or extending a passage in Books creates a new annotation with a new UUID
+    so without this we'd upload every version of it.
+
+    Passages are compared per source using sets of hashed character
+    shingles. Candidates come from an inverted index of shingles so we never
+    compare every pair in a book. Shingles shared by more than
+    `max_postings` passages are too common to be useful and are skipped when
+    looking for candidates. A passage is a duplicate of another when at
+    least `threshold` of the shorter one's shingles appear in the longer
+    one. That covers both near-identical and contained passages.
+
+    Containment isn't transitive, two unrelated passages can both contain a
+    third. So groups aren't merged pairwise. Passages are visited longest
+    first and each joins the first kept passage that contains it, or is kept
+    itself. Passages with fewer than `min_shingles` shingles, a word or two,
+    are contained in too much to say anything and are never collapsed.
+
+    Only annotations that are sent are deduplicated, after routing and
+    within a single bucket. Otherwise a highlight that is sent could be
+    collapsed into one that's skipped or ignored and never be uploaded.
+
+    Each group of duplicates is collapsed to one annotation by `policy`:
+
+        newest  - keep the most recently modified annotation.
+        longest - keep the longest passage.
+        merge   - keep the longest passage and merge in the notes, tags and
+                  collections of the others.
+    """
+
+    policies = ("off", "newest", "longest", "merge")
+
+    shingle_size = 8
+    min_shingles = 12
+    max_postings = 50
+
+    _re_whitespace = re.compile(r"\s+")
+
+    def __init__(self, policy="off", threshold=0.9):
+
+        if policy not in self.policies:
+            raise AppleBooksError(f"Unknown dedup policy: {policy}")
+
+        self.policy = policy
+        self.threshold = threshold
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**config.applebooks_dedup)
+
+    @property
+    def enabled(self):
+        return self.policy != "off"
+
+    def run(self, sources) -> list:
+        """ Deduplicate every bucket of a SourceIndex. Returns what was
+        collapsed as `(kept, [dropped, ...])` per group of duplicates.
+        Nothing is kept between calls, the caller reports and drops them. """
+
+        collapsed = []
+
+        for _, bucket in sources:
+            for group in self._groups(bucket):
+                collapsed.append(self._resolve(group))
+
+        return collapsed
+
+    def _groups(self, bucket):
+
+        if len(bucket) < 2:
+            return []
+
+        signatures = [self._shingles(annotation.passage) for annotation in bucket]
+
+        frequency = Counter(shingle for signature in signatures for shingle in signature)
+
+        order = sorted(range(len(bucket)), key=lambda index: -len(bucket[index].passage))
+        rank = {index: position for position, index in enumerate(order)}
+
+        # Shingle to the kept passages holding it.
+        postings = defaultdict(list)
+        groups = {}
+
+        for index in order:
+
+            signature = signatures[index]
+
+            if len(signature) < self.min_shingles:
+                continue
+
+            shingles = [
+                shingle for shingle in signature if frequency[shingle] <= self.max_postings
+            ]
+
+            candidates = {kept for shingle in shingles for kept in postings[shingle]}
+
+            for kept in sorted(candidates, key=rank.get):
+                shared = len(signature & signatures[kept])
+                if shared >= self.threshold * min(len(signature), len(signatures[kept])):
+                    groups[kept].append(bucket[index])
+                    break
+            else:
+                groups[index] = [bucket[index]]
+                for shingle in shingles:
+                    postings[shingle].append(index)
+
+        return [group for group in groups.values() if len(group) > 1]
+
+    def _resolve(self, group):
+
+        if self.policy == "newest":
+            kept = max(group, key=lambda annotation: annotation.data["modified"])
+        else:
+            kept = max(group, key=lambda annotation: len(annotation.passage))
+
+        others = [annotation for annotation in group if annotation is not kept]
+
+        if self.policy == "merge":
+            kept.merge(others)
+
+        return kept, others
+
+    def _shingles(self, passage: str) -> frozenset:
+
+        text = self._re_whitespace.sub(" ", passage.lower()).strip()
+
+        size = self.shingle_size
+
+        if len(text) <= size:
+            return frozenset([hash(text)])
+
+        return frozenset(hash(text[x : x + size]) for x in range(len(text) - size + 1))
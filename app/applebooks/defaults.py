@@ -16,11 +16,25 @@ class AppleBooksDefaults:
     local_db_dir = local_day_dir / "db"
     local_bklibrary_dir = local_db_dir / "BKLibrary"
     local_aeannotation_dir = local_db_dir / "AEAnnotation"
+    local_snapshot_file = local_db_dir / "snapshot.json"
+    # Copy of the last snapshot that was synced successfully. See snapshot.py.
+    local_baseline_dir = local_root_dir / "baseline"
+    local_baseline_file = local_baseline_dir / "baseline.json"
 
     # Misc
     origin = "apple_books"
     ns_time_interval_since_1970 = 978307200.0
     current_version = "Books v1.6 (1636.1)"
+    batch_size = 1000
+    deleted_since_key = "applebooks_deleted_since"
+
+    # Routing
+    # ZANNOTATIONSTYLE values in order i.e. 0 = underline, 1 = green...
+    colors = ("underline", "green", "blue", "yellow", "pink", "purple")
+    # Buckets in order of precedence. Anything unmatched is "unsorted".
+    buckets = ("skip", "ignore", "refresh", "add")
+    # Buckets that are sent upstream, and so deduplicated.
+    sent_buckets = ("add", "refresh")
 
     # Queries
     annotation_query = """
@@ -30,6 +44,7 @@ class AppleBooksDefaults:
             ZANNOTATIONSELECTEDTEXT as passage,
             ZANNOTATIONNOTE as notes,
             ZANNOTATIONSTYLE as color,
+            ZANNOTATIONLOCATION as location,
             ZANNOTATIONCREATIONDATE as created,
             ZANNOTATIONMODIFICATIONDATE as modified
 
@@ -41,6 +56,19 @@ class AppleBooksDefaults:
         ORDER BY ZANNOTATIONASSETID;
     """
 
+    deleted_annotation_query = """
+        SELECT
+            ZANNOTATIONUUID as id,
+            ZANNOTATIONMODIFICATIONDATE as modified
+
+        FROM ZAEANNOTATION
+
+        WHERE ZANNOTATIONDELETED = 1
+            AND ZANNOTATIONMODIFICATIONDATE > ?
+
+        ORDER BY ZANNOTATIONMODIFICATIONDATE;
+    """
+
     source_query = """
         SELECT
             ZBKCOLLECTIONMEMBER.ZASSETID as id,
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+import sys
+
+from .defaults import AppleBooksDefaults
+from .errors import AppleBooksError
+
+
+class Router:
+    """ Decides which bucket an annotation is sorted into. Everything that
+    depends on the user's Config is compiled once here so routing a single
+    annotation is a handful of dict lookups and bit operations.
+
+    Buckets are resolved in order of precedence: skip > ignore > refresh >
+    add > unsorted. Whichever matching collection or rule has the strongest
+    bucket wins.
+
+    Rules are optional and read from `config.applebooks_rules`:
+
+        {"bucket": "ignore", "collection": "Reference"}
+        {"bucket": "refresh", "color": ["pink", "purple"], "tag": "quote"}
+        {"bucket": "skip", "author": "Anonymous"}
+
+    Every condition present in a rule must match for the rule to apply. """
+
+    buckets = AppleBooksDefaults.buckets
+    unsorted = len(buckets)
+
+    def __init__(self, collections: dict, colors: dict, rules: list = None):
+
+        self._lowered = {}
+
+        self.color_mask = self._compile_colors(colors)
+        self._collection_ranks = self._compile_collections(collections)
+        self._rules = self._compile_rules(rules or [])
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            collections=config.applebooks_collections,
+            colors=config.applebooks_colors,
+            rules=config.applebooks_rules,
+        )
+
+    def route(self, color, collections, tags=(), author="") -> str:
+        return self.bucket(self.rank(color, collections, tags, author))
+
+    def bucket(self, rank) -> str:
+
+        if rank == self.unsorted:
+            return "unsorted"
+
+        return self.buckets[rank]
+
+    def rank(self, color, collections, tags=(), author="") -> int:
+
+        if not self.color_enabled(color):
+            return 0
+
+        rank = self.unsorted
+
+        collection_ranks = self._collection_ranks
+
+        for collection in collections:
+            collection_rank = collection_ranks.get(self.lower(collection), rank)
+            if collection_rank < rank:
+                rank = collection_rank
+
+        # Rules are sorted by rank so we stop at the first one that can't win.
+        for rule in self._rules:
+            if rule[0] >= rank:
+                break
+            if self._rule_matches(rule, color, collections, tags, author):
+                rank = rule[0]
+                break
+
+        return rank
+
+    def color_enabled(self, color) -> bool:
+
+        if color is None:
+            return False
+
+        return bool(self.color_mask >> color & 1)
+
+    def lower(self, value: str) -> str:
+        """ Lowercase and intern a string, caching the result. Annotations
+        share a small set of collection, tag and author names so this avoids
+        calling `str.lower` on every annotation. """
+
+        try:
+            return self._lowered[value]
+        except KeyError:
+            lowered = self._lowered[value] = sys.intern(value.lower())
+            return lowered
+
+    def _rule_matches(self, rule, color, collections, tags, author) -> bool:
+
+        _, collection, color_mask, tag, rule_author = rule
+
+        if color_mask is not None and not color_mask >> color & 1:
+            return False
+
+        if collection is not None and collection not in {
+            self.lower(c) for c in collections
+        }:
+            return False
+
+        if tag is not None and tag not in {self.lower(t) for t in tags}:
+            return False
+
+        if rule_author is not None and rule_author != self.lower(author or ""):
+            return False
+
+        return True
+
+    def _compile_colors(self, colors: dict) -> int:
+
+        mask = 0
+
+        for bit, name in enumerate(AppleBooksDefaults.colors):
+            if colors.get(name):
+                mask |= 1 << bit
+
+        return mask
+
+    def _compile_collections(self, collections: dict) -> dict:
+        """ Map each lowercased collection name to the rank of its bucket. If
+        the same collection is configured for more than one bucket the
+        strongest one wins. Empty names never match. """
+
+        ranks = {}
+
+        for rank, bucket in enumerate(self.buckets):
+
+            name = collections.get(bucket, "")
+
+            if not name:
+                continue
+
+            ranks.setdefault(self.lower(name), rank)
+
+        return ranks
+
+    def _compile_rules(self, rules: list) -> list:
+
+        compiled = []
+
+        for rule in rules:
+
+            try:
+                rank = self.buckets.index(rule["bucket"])
+            except (KeyError, ValueError):
+                raise AppleBooksError(f"Invalid routing rule: {rule}")
+
+            colors = rule.get("color")
+            color_mask = None
+
+            if colors is not None:
+                if isinstance(colors, str):
+                    colors = [colors]
+                color_mask = self._compile_colors({name: True for name in colors})
+
+            collection = rule.get("collection")
+            tag = rule.get("tag")
+            author = rule.get("author")
+
+            compiled.append(
+                (
+                    rank,
+                    self.lower(collection) if collection else None,
+                    color_mask,
+                    self.lower(tag) if tag else None,
+                    self.lower(author) if author else None,
+                )
+            )
+
+        compiled.sort(key=lambda rule: rule[0])
+
+        return compiled
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+import re
+import json
+import sqlite3
+import hashlib
+import pathlib
+from contextlib import contextmanager
+
+from .defaults import AppleBooksDefaults
+from .errors import AppleBooksError
+
+
+"""
+Row-level diff of two snapshots of the Books databases, the one that was
+last synced successfully (the baseline) and today's.
+
+Annotation modification dates don't cover everything that changes how an
+annotation is routed. Moving a book into the "refresh" collection only adds a
+row to BKLibrary's ZBKCOLLECTIONMEMBER. So instead of trusting dates both
+`source_query` and `annotation_query` are run against each snapshot, every
+row is reduced to (id, source id, hash of the whole row) and the two sides
+are compared with EXCEPT in SQLite:
+
+    SELECT * FROM current_rows EXCEPT SELECT * FROM baseline_rows
+
+A changed source row, in either direction, marks every annotation of that
+source as affected. A changed annotation row marks the annotation itself.
+
+Both sides run the same queries, less their ORDER BY. The baseline is
+ATTACHed to the connection and shadowed by temp views named after its
+tables. Unqualified names resolve to the temp schema first so the same query
+text reads the baseline.
+"""
+
+
+class SnapshotDiffer:
+    def __init__(self, baseline_dir, current_dir):
+
+        self.baseline_dir = pathlib.Path(baseline_dir)
+        self.current_dir = pathlib.Path(current_dir)
+
+    def diff(self, whole_sources=False) -> dict:
+        """ Returns the ids of the annotations in the current snapshot that
+        need to be sent again, the source ids whose rows changed and how many
+        annotation rows were added or changed.
+
+        With `whole_sources` any change to an annotation, including its
+        deletion, marks its whole source instead. Deduplication works per
+        source so it can change which of its neighbours is kept. """
+
+        sources = self.changed_sources()
+
+        connection = self._open("AEAnnotation")
+
+        try:
+            self._hash_query(
+                connection, AppleBooksDefaults.annotation_query, removed=whole_sources
+            )
+
+            connection.execute("CREATE TEMP TABLE changed_sources (id TEXT PRIMARY KEY)")
+            connection.executemany(
+                "INSERT INTO changed_sources VALUES (?)", ((id_,) for id_ in sources)
+            )
+
+            query = """
+                SELECT id FROM added
+                UNION
+                SELECT id FROM current_rows
+                WHERE source_id IN (SELECT id FROM changed_sources)
+            """
+
+            if whole_sources:
+                query += """
+                    UNION
+                    SELECT id FROM current_rows
+                    WHERE source_id IN (
+                        SELECT source_id FROM added UNION SELECT source_id FROM removed
+                    )
+                """
+
+            annotations = {row[0] for row in connection.execute(query)}
+
+            rows = connection.execute("SELECT COUNT(*) FROM added").fetchone()[0]
+
+        finally:
+            connection.close()
+
+        return {"annotations": annotations, "sources": sources, "rows": rows}
+
+    def changed_sources(self) -> set:
+
+        connection = self._open("BKLibrary")
+
+        try:
+            self._hash_query(connection, AppleBooksDefaults.source_query, key="id")
+
+            return {
+                row[0]
+                for row in connection.execute(
+                    "SELECT source_id FROM added UNION SELECT source_id FROM removed"
+                )
+            }
+
+        finally:
+            connection.close()
+
+    def _hash_query(self, connection, query, key="source_id", removed=True):
+        """ Fill `current_rows` and `baseline_rows` with `(id, source_id,
+        hash)` for every row `query` returns on either side, then `added`
+        with the rows only the current side has and, if asked for, `removed`
+        with the rows only the baseline has. `key` is the column holding the
+        source id. """
+
+        # EXCEPT doesn't care about order and sorting every row on both
+        # sides was most of the work.
+        query = re.sub(r"\s+ORDER BY[^;()]*;?\s*$", "", query)
+
+        columns = [
+            column[0]
+            for column in connection.execute(f"SELECT * FROM ({query}) LIMIT 0").description
+        ]
+
+        projection = (
+            f"SELECT id, {key} AS source_id, "
+            f"row_hash({', '.join(columns)}) AS hash FROM ({query})"
+        )
+
+        connection.execute(f"CREATE TEMP TABLE current_rows AS {projection}")
+
+        with _shadowed(connection):
+            connection.execute(f"CREATE TEMP TABLE baseline_rows AS {projection}")
+
+        connection.execute(
+            "CREATE TEMP TABLE added AS "
+            "SELECT * FROM current_rows EXCEPT SELECT * FROM baseline_rows"
+        )
+
+        if removed:
+            connection.execute(
+                "CREATE TEMP TABLE removed AS "
+                "SELECT * FROM baseline_rows EXCEPT SELECT * FROM current_rows"
+            )
+
+    def _open(self, name) -> sqlite3.Connection:
+
+        current = self._get_sqlite(self.current_dir / name)
+        baseline = self._get_sqlite(self.baseline_dir / name)
+
+        try:
+            connection = sqlite3.connect(str(current))
+            connection.execute("ATTACH DATABASE ? AS baseline", (str(baseline),))
+        except sqlite3.Error as error:
+            raise AppleBooksError(f"SQLite Error: {repr(error)}")
+
+        connection.create_function("row_hash", -1, _row_hash)
+
+        return connection
+
+    @staticmethod
+    def _get_sqlite(path: pathlib.Path) -> pathlib.Path:
+
+        try:
+            return next(path.glob("*.sqlite"))
+        except StopIteration:
+            raise AppleBooksError(f"Couldn't find AppleBooks database @ {path}.")
+
+
+@contextmanager
+def _shadowed(connection):
+    """ Temp views over every table of the attached baseline for the
+    duration of a `with` block. """
+
+    tables = [
+        row[0]
+        for row in connection.execute(
+            "SELECT name FROM baseline.sqlite_master "
+            "WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+        )
+    ]
+
+    for table in tables:
+        connection.execute(f'CREATE TEMP VIEW "{table}" AS SELECT * FROM baseline."{table}"')
+
+    try:
+        yield
+    finally:
+        for table in tables:
+            connection.execute(f'DROP VIEW IF EXISTS temp."{table}"')
+
+
+def _row_hash(*values) -> int:
+    """ Both sides of a diff are hashed by the same process so Python's own,
+    per-process salted, hash will do. It's several times faster than a
+    digest of the row and 64 bits make a collision between two versions of
+    the same row negligible. Never store these. """
+    return hash(values)
+
+
+def fingerprint(config) -> str:
+    """ Hash of the settings that decide how a row turns into a routed
+    annotation. A diff against a baseline synced with other settings would
+    miss annotations whose routing changed, so it isn't used. """
+
+    settings = [
+        config.prefix_tag,
+        config.prefix_collection,
+        config.applebooks_collections,
+        config.applebooks_colors,
+        config.applebooks_rules,
+        config.applebooks_dedup,
+    ]
+
+    encoded = json.dumps(settings, sort_keys=True, separators=(",", ":"))
+
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import os
+import re
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from .defaults import AppleBooksDefaults
+
+
+class Transformer:
+    """ Turns raw annotation rows into the dicts we send to the API. This is
+    the CPU-bound part of a sync: note parsing, passage normalization and
+    date conversion.
+
+    It only holds the compiled note patterns so it can be pickled and sent
+    to worker processes. Both `Annotation` and the process pool go through
+    `serialize` so serial and parallel output are always identical. """
+
+    def __init__(self, prefix_tag: str, prefix_collection: str):
+
+        self.prefix_tag = prefix_tag
+        self.prefix_collection = prefix_collection
+
+        self._re_prefix_tag = re.compile(prefix_tag)
+        self._re_tag_pattern = re.compile(self._re_pattern(prefix_tag))
+        self._re_prefix_collection = re.compile(prefix_collection)
+        self._re_collection_pattern = re.compile(self._re_pattern(prefix_collection))
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.prefix_tag, config.prefix_collection)
+
+    def __call__(self, batch: list) -> list:
+        return [self.serialize(raw_annotation) for raw_annotation in batch]
+
+    def map(self, batches, workers=1):
+        """ Yield `(batch, payloads)` for every batch of raw rows, in order.
+
+        With `workers` set to 1 everything runs in this process. Otherwise
+        batches are farmed out to a process pool of `workers` processes, or
+        one per CPU if `workers` is 0 or None. At most two batches per worker
+        are in flight so memory stays bounded on large libraries. """
+
+        if workers == 1:
+            for batch in batches:
+                yield batch, self(batch)
+            return
+
+        workers = workers or os.cpu_count() or 1
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+
+            pending = deque()
+
+            for batch in batches:
+
+                pending.append((batch, executor.submit(self, batch)))
+
+                if len(pending) >= workers * 2:
+                    batch, future = pending.popleft()
+                    yield batch, future.result()
+
+            while pending:
+                batch, future = pending.popleft()
+                yield batch, future.result()
+
+    def serialize(self, raw_annotation: dict) -> dict:
+
+        notes, tags, collections = self.process_notes(raw_annotation["notes"])
+
+        data = {
+            "id": raw_annotation["id"],
+            "passage": self.process_passage(raw_annotation["passage"]),
+            "notes": notes,
+            "source": {
+                "name": raw_annotation["source"],
+                "author": raw_annotation["author"],
+            },
+            "tags": tags,
+            "collections": collections,
+            "metadata": {
+                "created": self.convert_date(raw_annotation["created"]),
+                "modified": self.convert_date(raw_annotation["modified"]),
+                "origin": AppleBooksDefaults.origin,
+                "is_protected": False,
+                "in_trash": False,
+            }
+        }
+
+        return data
+
+    def process_passage(self, passage: str) -> str:
+        return passage.replace("\n", "\n\n")
+
+    def process_notes(self, notes: str) -> tuple:
+        """ Split `notes` into the remaining note text and the tags and
+        collections that were written inline with their prefixes. i.e. with
+        the default prefixes "Great line #quote @favorites" becomes
+        ("Great line", ["quote"], ["favorites"]). """
+
+        if not notes:
+            return "", [], []
+
+        # Extract tags from notes.
+        tags = self._re_tag_pattern.findall(notes)
+        tags = [self._re_prefix_tag.sub("", tag.strip()) for tag in tags]
+
+        # Extract collections from notes.
+        collections = self._re_collection_pattern.findall(notes)
+        collections = [
+            self._re_prefix_collection.sub("", collection.strip())
+            for collection in collections
+        ]
+
+        # Remove tags and collections from notes.
+        notes = self._re_tag_pattern.sub("", notes)
+        notes = self._re_collection_pattern.sub("", notes)
+        notes = notes.strip()
+
+        return notes, tags, collections
+
+    @staticmethod
+    def convert_date(epoch: float) -> str:
+        """ Converts Epoch to ISO861"""
+
+        seconds_since_epoch = float(epoch) + AppleBooksDefaults.ns_time_interval_since_1970
+
+        date = datetime.utcfromtimestamp(seconds_since_epoch)
+        date = date.isoformat()
+
+        return date
+
+    @staticmethod
+    def _re_pattern(prefix):
+        return rf"\B{prefix}[^{prefix}\s]+\s?"
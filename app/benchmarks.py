@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+
+import sys
+import json
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from .api.encoder import Encoder
+from .applebooks.cfi import SourceIndex, cfi_key
+from .applebooks.defaults import AppleBooksDefaults
+from .applebooks.routing import Router
+from .applebooks.snapshot import SnapshotDiffer
+from .applebooks.transform import Transformer
+
+
+"""
+Micro-benchmarks for the hot paths of the sync. None of these touch the
+network or the real Apple Books databases.
+
+Run: python3 -m app.benchmarks <name> [--count N]
+"""
+
+
+def _report(name, count, elapsed):
+    print(f"{name}: {count:,} items in {elapsed:.3f}s ({count / elapsed:,.0f}/s)")
+
+
+def bench_routing(count=1_000_000, seed=0):
+
+    rng = random.Random(seed)
+
+    router = Router(
+        collections={"add": "To Sync", "refresh": "Refresh", "ignore": "Ignore"},
+        colors={
+            "underline": False,
+            "green": True,
+            "blue": True,
+            "yellow": True,
+            "pink": True,
+            "purple": True,
+        },
+        rules=[
+            {"bucket": "ignore", "author": "Anonymous"},
+            {"bucket": "refresh", "color": ["pink"], "tag": "quote"},
+        ],
+    )
+
+    collection_choices = [
+        [],
+        ["To Sync"],
+        ["Refresh"],
+        ["IGNORE"],
+        ["to sync", "Refresh"],
+        ["Fiction"],
+    ]
+    tag_choices = [[], ["quote"], ["idea", "Quote"]]
+    author_choices = ["Jane Doe", "John Doe", "Anonymous"]
+
+    annotations = [
+        (
+            rng.randrange(6),
+            rng.choice(collection_choices),
+            rng.choice(tag_choices),
+            rng.choice(author_choices),
+        )
+        for _ in range(count)
+    ]
+
+    counts = {}
+    rank = router.rank
+
+    start = perf_counter()
+    for color, collections, tags, author in annotations:
+        r = rank(color, collections, tags, author)
+        counts[r] = counts.get(r, 0) + 1
+    elapsed = perf_counter() - start
+
+    _report("routing", count, elapsed)
+    print({router.bucket(r): n for r, n in sorted(counts.items())})
+
+
+def synthetic_raw_annotations(count, seed=0, batch_size=1000):
+    """ Yield batches of joined raw annotation rows shaped like the output of
+    `AppleBooks._attach_sources`. """
+
+    rng = random.Random(seed)
+
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "elit"]
+
+    batch = []
+
+    for num in range(count):
+
+        passage = " ".join(rng.choice(words) for _ in range(rng.randint(5, 60)))
+        notes = rng.choice(
+            [None, "", "A thought.", "Great line #quote @favorites", "#a #b @c\nmore"]
+        )
+
+        batch.append(
+            {
+                "source_id": f"SRC-{num % 500}",
+                "id": f"ID-{seed}-{num}",
+                "passage": passage.replace(" sit ", "\nsit "),
+                "notes": notes,
+                "color": rng.randrange(6),
+                "created": 500000000.0 + num,
+                "modified": 600000000.0 + num,
+                "source": f"Source {num % 500}",
+                "author": f"Author {num % 50}",
+                "applebooks_collections": [],
+            }
+        )
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+def bench_transform(count=200_000, seed=0, workers=0):
+
+    transformer = Transformer(prefix_tag="#", prefix_collection="@")
+
+    start = perf_counter()
+    serial = [
+        payloads
+        for _, payloads in transformer.map(synthetic_raw_annotations(count, seed))
+    ]
+    elapsed = perf_counter() - start
+    _report("transform (serial)", count, elapsed)
+
+    start = perf_counter()
+    parallel = [
+        payloads
+        for _, payloads in transformer.map(
+            synthetic_raw_annotations(count, seed), workers=workers
+        )
+    ]
+    elapsed = perf_counter() - start
+    _report("transform (parallel)", count, elapsed)
+
+    assert serial == parallel, "Serial and parallel output differ."
+
+
+class SyntheticAnnotation:
+
+    __slots__ = ("source_id", "location", "location_key")
+
+    def __init__(self, source_id, location):
+        self.source_id = source_id
+        self.location = location
+        self.location_key = None
+
+
+def synthetic_cfi(rng):
+
+    spine = rng.randrange(2, 80) * 2
+    path = "/".join(str(rng.randrange(1, 40) * 2) for _ in range(rng.randint(1, 4)))
+    start = rng.randrange(0, 500)
+
+    return (
+        f"epubcfi(/6/{spine}[chapter-{spine}]!/4/{path},"
+        f"/1:{start},/1:{start + rng.randrange(1, 300)})"
+    )
+
+
+def bench_cfi(count=1_000_000, seed=0):
+
+    rng = random.Random(seed)
+
+    annotations = [
+        SyntheticAnnotation(f"SRC-{rng.randrange(500)}", synthetic_cfi(rng))
+        for _ in range(count)
+    ]
+
+    start = perf_counter()
+    for annotation in annotations:
+        annotation.location_key = cfi_key(annotation.location)
+    _report("cfi parse", count, perf_counter() - start)
+
+    start = perf_counter()
+    ordered = sorted(
+        annotations, key=lambda annotation: (annotation.source_id, annotation.location_key)
+    )
+    _report("sort (precomputed keys)", count, perf_counter() - start)
+
+    start = perf_counter()
+    index = SourceIndex(annotations)
+    grouped = list(index.annotations())
+    _report(f"group into {len(index)} sources", count, perf_counter() - start)
+
+    assert len(ordered) == len(grouped) == count
+
+
+def synthetic_library(directory, count, seed=0, sources=500):
+    """ Write a BKLibrary and an AEAnnotation database with just the tables
+    and columns `source_query` and `annotation_query` read. """
+
+    rng = random.Random(seed)
+
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "elit"]
+
+    (directory / "BKLibrary").mkdir(parents=True)
+    (directory / "AEAnnotation").mkdir(parents=True)
+
+    library = sqlite3.connect(str(directory / "BKLibrary" / "BKLibrary-1.sqlite"))
+
+    library.executescript(
+        """
+        CREATE TABLE ZBKCOLLECTION (Z_PK INTEGER PRIMARY KEY, ZCOLLECTIONID TEXT, ZTITLE TEXT);
+        CREATE TABLE ZBKCOLLECTIONMEMBER (Z_PK INTEGER PRIMARY KEY, ZASSETID TEXT, ZCOLLECTION INTEGER);
+        CREATE TABLE ZBKLIBRARYASSET (Z_PK INTEGER PRIMARY KEY, ZASSETID TEXT, ZTITLE TEXT, ZAUTHOR TEXT);
+        INSERT INTO ZBKCOLLECTION VALUES
+            (1, 'All_Collection_ID', 'All'),
+            (2, 'Books_Collection_ID', 'Books'),
+            (3, 'C-3', 'To Sync'),
+            (4, 'C-4', 'Refresh'),
+            (5, 'C-5', 'Fiction');
+        """
+    )
+
+    for num in range(sources):
+        library.execute(
+            "INSERT INTO ZBKLIBRARYASSET (ZASSETID, ZTITLE, ZAUTHOR) VALUES (?, ?, ?)",
+            (f"SRC-{num}", f"Source {num}", f"Author {num % 50}"),
+        )
+        library.executemany(
+            "INSERT INTO ZBKCOLLECTIONMEMBER (ZASSETID, ZCOLLECTION) VALUES (?, ?)",
+            [(f"SRC-{num}", collection) for collection in (1, 2, 3 + num % 3)],
+        )
+
+    library.commit()
+    library.close()
+
+    annotations = sqlite3.connect(str(directory / "AEAnnotation" / "AEAnnotation_v10.sqlite"))
+
+    annotations.execute(
+        """
+        CREATE TABLE ZAEANNOTATION (
+            Z_PK INTEGER PRIMARY KEY,
+            ZANNOTATIONASSETID TEXT,
+            ZANNOTATIONUUID TEXT,
+            ZANNOTATIONSELECTEDTEXT TEXT,
+            ZANNOTATIONNOTE TEXT,
+            ZANNOTATIONSTYLE INTEGER,
+            ZANNOTATIONLOCATION TEXT,
+            ZANNOTATIONCREATIONDATE REAL,
+            ZANNOTATIONMODIFICATIONDATE REAL,
+            ZANNOTATIONDELETED INTEGER
+        )
+        """
+    )
+
+    annotations.executemany(
+        """
+        INSERT INTO ZAEANNOTATION (
+            ZANNOTATIONASSETID, ZANNOTATIONUUID, ZANNOTATIONSELECTEDTEXT,
+            ZANNOTATIONNOTE, ZANNOTATIONSTYLE, ZANNOTATIONLOCATION,
+            ZANNOTATIONCREATIONDATE, ZANNOTATIONMODIFICATIONDATE, ZANNOTATIONDELETED
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0)
+        """,
+        (
+            (
+                f"SRC-{num % sources}",
+                f"ID-{seed}-{num}",
+                " ".join(rng.choice(words) for _ in range(rng.randint(5, 60))),
+                rng.choice([None, "A thought.", "Great line #quote @favorites"]),
+                rng.randrange(6),
+                synthetic_cfi(rng),
+                500000000.0 + num,
+                600000000.0 + num,
+            )
+            for num in range(count)
+        ),
+    )
+
+    annotations.commit()
+    annotations.close()
+
+
+def synthetic_delta(directory, count, seed=0, edits=0.001):
+    """ A day's worth of changes: `edits` of the annotations edited, a few
+    added and deleted, and one book moved from "To Sync" to "Refresh" which
+    doesn't touch any annotation row. Returns the ids that have to be sent
+    again. """
+
+    rng = random.Random(seed + 1)
+
+    library = sqlite3.connect(str(directory / "BKLibrary" / "BKLibrary-1.sqlite"))
+    library.execute(
+        "UPDATE ZBKCOLLECTIONMEMBER SET ZCOLLECTION = 4 WHERE ZASSETID = 'SRC-0' AND ZCOLLECTION = 3"
+    )
+    library.commit()
+    library.close()
+
+    annotations = sqlite3.connect(str(directory / "AEAnnotation" / "AEAnnotation_v10.sqlite"))
+
+    moved = {
+        row[0]
+        for row in annotations.execute(
+            "SELECT ZANNOTATIONUUID FROM ZAEANNOTATION WHERE ZANNOTATIONASSETID = 'SRC-0'"
+        )
+    }
+
+    edited = {f"ID-{seed}-{num}" for num in rng.sample(range(count), max(1, int(count * edits)))}
+
+    annotations.executemany(
+        "UPDATE ZAEANNOTATION SET ZANNOTATIONNOTE = 'Edited.', "
+        "ZANNOTATIONMODIFICATIONDATE = ZANNOTATIONMODIFICATIONDATE + 86400 "
+        "WHERE ZANNOTATIONUUID = ?",
+        ((id_,) for id_ in edited),
+    )
+
+    added = {f"ID-{seed}-new-{num}" for num in range(10)}
+
+    annotations.executemany(
+        "INSERT INTO ZAEANNOTATION (ZANNOTATIONASSETID, ZANNOTATIONUUID, "
+        "ZANNOTATIONSELECTEDTEXT, ZANNOTATIONSTYLE, ZANNOTATIONCREATIONDATE, "
+        "ZANNOTATIONMODIFICATIONDATE, ZANNOTATIONDELETED) "
+        "VALUES ('SRC-1', ?, 'A new highlight.', 1, 700000000.0, 700000000.0, 0)",
+        ((id_,) for id_ in added),
+    )
+
+    deleted = {f"ID-{seed}-{num}" for num in rng.sample(range(count), 10)} - edited
+
+    annotations.executemany(
+        "UPDATE ZAEANNOTATION SET ZANNOTATIONDELETED = 1 WHERE ZANNOTATIONUUID = ?",
+        ((id_,) for id_ in deleted),
+    )
+
+    annotations.commit()
+    annotations.close()
+
+    return (moved | edited | added) - deleted
+
+
+def bench_snapshot(count=200_000, seed=0):
+    """ Finding what changed since yesterday with `SnapshotDiffer` against
+    reading and transforming the whole library. """
+
+    transformer = Transformer(prefix_tag="#", prefix_collection="@")
+
+    with tempfile.TemporaryDirectory() as tmp:
+
+        baseline = Path(tmp) / "baseline"
+        current = Path(tmp) / "current"
+
+        synthetic_library(baseline, count, seed)
+        shutil.copytree(str(baseline), str(current))
+
+        expected = synthetic_delta(current, count, seed)
+
+        start = perf_counter()
+        rows = 0
+        connection = sqlite3.connect(str(current / "AEAnnotation" / "AEAnnotation_v10.sqlite"))
+        connection.row_factory = sqlite3.Row
+        cursor = connection.execute(AppleBooksDefaults.annotation_query)
+        while True:
+            batch = [
+                {**row, "source": "", "author": "", "applebooks_collections": []}
+                for row in cursor.fetchmany(AppleBooksDefaults.batch_size)
+            ]
+            if not batch:
+                break
+            transformer(batch)
+            rows += len(batch)
+        connection.close()
+        _report("full read + transform", rows, perf_counter() - start)
+
+        start = perf_counter()
+        changes = SnapshotDiffer(baseline, current).diff()
+        elapsed = perf_counter() - start
+        _report("snapshot diff", rows, elapsed)
+        print(
+            f"  {len(changes['annotations']):,} annotations and "
+            f"{len(changes['sources'])} sources changed"
+        )
+
+        assert changes["annotations"] == expected, "Diff missed or invented changes."
+
+        start = perf_counter()
+        changes = SnapshotDiffer(baseline, current).diff(whole_sources=True)
+        _report("snapshot diff (whole sources)", rows, perf_counter() - start)
+        print(f"  {len(changes['annotations']):,} annotations to send")
+
+
+def bench_encode(count=200_000, seed=0, chunk_size=100):
+
+    transformer = Transformer(prefix_tag="#", prefix_collection="@")
+
+    chunks = [
+        transformer(batch)
+        for batch in synthetic_raw_annotations(count, seed, batch_size=chunk_size)
+    ]
+
+    encoders = [
+        ("json.dumps baseline", lambda chunk: json.dumps(chunk).encode("utf-8")),
+        ("json", Encoder(fast=False).encode_chunk),
+    ]
+
+    if Encoder().fast:
+        encoders.append(("orjson", Encoder().encode_chunk))
+    else:
+        print("encode (orjson): not installed, skipped.")
+
+    for name, encode in encoders:
+
+        size = 0
+        start = perf_counter()
+        for chunk in chunks:
+            size += len(encode(chunk))
+        elapsed = perf_counter() - start
+
+        _report(f"encode ({name})", count, elapsed)
+        print(f"  {size / elapsed / 1024 / 1024:,.1f} MB/s")
+
+        for chunk in chunks[:50]:
+            assert json.loads(encode(chunk)) == chunk
+
+
+benchmarks = {
+    "cfi": bench_cfi,
+    "encode": bench_encode,
+    "routing": bench_routing,
+    "snapshot": bench_snapshot,
+    "transform": bench_transform,
+}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("name", choices=sorted(benchmarks), help="Benchmark to run.")
+    parser.add_argument("--count", type=int, help="Number of synthetic items.")
+
+    args = parser.parse_args()
+
+    kwargs = {"count": args.count} if args.count else {}
+
+    benchmarks[args.name](**kwargs)
+    sys.exit()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import threading
+from datetime import datetime
+
+from .defaults import AppDefaults
+from .errors import ApplicationError
+
+
+class RunCoordinator:
+    """ Makes sure only one sync runs at a time. Overlapping runs e.g. cron
+    and a manual run would otherwise delete each other's Apple Books snapshot
+    and upload the same chunks twice.
+
+    The lock is an advisory `flock` on `lock_file`, which the kernel releases
+    when the holder exits however it exits. What the holder is doing is kept
+    in `run_file`: its reader, pid, when it started and a heartbeat it
+    refreshes every `heartbeat_interval` seconds. When it's done it records
+    how it went and what it sent.
+
+    A second invocation does one of the following while a run is active:
+
+        attach - wait for it and, if it was doing the same work and got as
+                 far as syncing, report its results instead of repeating
+                 the work. Otherwise run after it.
+        wait   - wait for it and then run.
+        fail   - give up straight away.
+
+    A holder whose pid is gone, or whose heartbeat is older than
+    `stale_after`, is stale. Its lock file is replaced so the next run isn't
+    blocked forever by a hung process. """
+
+    heartbeat_interval = 10.0
+    stale_after = 300.0
+    poll_interval = 0.5
+
+    policies = ("attach", "wait", "fail")
+
+    def __init__(self, app, lock_file=AppDefaults.lock_file, run_file=AppDefaults.run_file):
+
+        self.app = app
+        self.lock_file = lock_file
+        self.run_file = run_file
+
+        self.run_id = None
+
+        self._fd = None
+        self._record = None
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self, reader, policy="attach", args=None) -> bool:
+        """ Returns True once this process holds the lock and should run,
+        False if it shouldn't run at all. `args` are what decide the work
+        done besides the reader, e.g. `--count` or `--changed`. """
+
+        if policy not in self.policies:
+            raise ApplicationError(f"Unknown policy: {policy}", self.app)
+
+        holder = None
+
+        while not self._try_lock():
+
+            if holder is None:
+
+                holder = self._read() or {}
+
+                print(
+                    f"Another {holder.get('reader', '')} run (pid {holder.get('pid')}) "
+                    f"has been running since {holder.get('started')}."
+                )
+
+                if policy == "fail":
+                    return False
+
+                print("Waiting for it to finish...")
+
+            current = self._read() or {}
+
+            if self._is_stale(current):
+                self._break(current)
+                continue
+
+            time.sleep(self.poll_interval)
+
+        previous = self._read()
+
+        if previous and previous.get("status") == "running":
+            # Whoever wrote this lost the lock without finishing.
+            self.app.logger.warning(
+                f"Previous {previous.get('reader')} run (pid {previous.get('pid')}) "
+                f"started {previous.get('started')} didn't finish."
+            )
+            previous = None
+
+        if policy == "attach" and holder and previous and previous.get("id") == holder.get("id"):
+
+            if (
+                previous.get("reader") == reader
+                and previous.get("args") == args
+                and previous.get("status") == "finished"
+                and previous.get("results", {}).get("synced")
+            ):
+                self._unlock()
+                self._attach(previous)
+                return False
+
+            print("It wasn't running the same sync or didn't get to syncing, running now.")
+
+        self._start(reader, args)
+
+        return True
+
+    def release(self, status, results=None) -> None:
+
+        if self._fd is None:
+            return
+
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+
+        self._record.update(
+            {
+                "status": status,
+                "finished": datetime.now().isoformat(),
+                "results": results or {},
+            }
+        )
+        self._write(self._record)
+
+        self._unlock()
+
+    def _attach(self, previous):
+
+        results = previous.get("results", {})
+
+        print(
+            f"Attached to the {previous['reader']} run started {previous['started']} "
+            f"(pid {previous['pid']}). It finished at {previous['finished']}."
+        )
+        print(
+            f"Imported {json.dumps(results.get('imported', {}))}, "
+            f"failed:{results.get('failed', 0)}."
+        )
+
+        self.app.logger.info(f"Attached to run {previous['id']}: {json.dumps(results)}")
+
+    def _start(self, reader, args):
+
+        self.run_id = uuid.uuid4().hex
+
+        now = datetime.now().isoformat()
+
+        self._record = {
+            "id": self.run_id,
+            "reader": reader,
+            "args": args,
+            "pid": os.getpid(),
+            "status": "running",
+            "started": now,
+            "heartbeat": time.time(),
+        }
+        self._write(self._record)
+
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+
+    def _beat(self):
+
+        while not self._stop.wait(self.heartbeat_interval):
+            self._record["heartbeat"] = time.time()
+            try:
+                self._write(self._record)
+            except OSError:
+                pass
+
+    def _try_lock(self) -> bool:
+
+        fd = os.open(str(self.lock_file), os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+
+        # The file may have been replaced by `_break` between opening and
+        # locking it, in which case we locked an orphan.
+        try:
+            current = os.stat(str(self.lock_file))
+        except FileNotFoundError:
+            current = None
+
+        if current is None or current.st_ino != os.fstat(fd).st_ino:
+            os.close(fd)
+            return False
+
+        self._fd = fd
+
+        return True
+
+    def _unlock(self):
+
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+
+        self._fd = None
+
+    def _is_stale(self, holder) -> bool:
+
+        if holder.get("status") != "running":
+            return False
+
+        pid = holder.get("pid")
+
+        if pid and not self._pid_alive(pid):
+            return True
+
+        return time.time() - holder.get("heartbeat", time.time()) > self.stale_after
+
+    def _break(self, holder):
+        """ Replace the lock file of the stale `holder`. Every waiter may
+        find it stale at once, so they break it one at a time behind a
+        second lock and only if the run file still names `holder` as
+        running. Otherwise a late waiter would unlink the lock of whoever
+        took over in the meantime and run alongside it. """
+
+        with open(f"{self.lock_file}.break", "a") as f:
+
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+            current = self._read() or {}
+
+            if current.get("id") != holder.get("id") or not self._is_stale(current):
+                return
+
+            self.app.logger.warning(
+                f"Breaking stale lock of {holder.get('reader')} run (pid {holder.get('pid')}), "
+                f"last heartbeat {time.time() - holder.get('heartbeat', 0):.0f}s ago."
+            )
+            print(f"Run (pid {holder.get('pid')}) looks stuck, taking over.")
+
+            current["status"] = "stale"
+            self._write(current)
+
+            try:
+                os.unlink(str(self.lock_file))
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _pid_alive(pid) -> bool:
+
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+
+        return True
+
+    def _read(self):
+
+        try:
+            with open(self.run_file, "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write(self, record):
+        """ Write atomically, other processes read this while we run. """
+
+        tmp = f"{self.run_file}.{os.getpid()}.tmp"
+
+        with open(tmp, "w") as f:
+            json.dump(record, f)
+
+        os.replace(tmp, str(self.run_file))
@@ -15,3 +15,14 @@ class AppDefaults:
     root_dir = home / ".hltsync"
     config_file = root_dir / "config.json"
     log_file = root_dir / "app.log"
+    mirror_file = root_dir / "mirror.sqlite"
+    spool_dir = root_dir / "spool"
+    spool_batch_size = 500
+    spool_max_attempts = 3
+    download_dir = root_dir / "downloads"
+    metrics_file = root_dir / "hltsync.prom"
+    failures_file = root_dir / "failures.jsonl"
+    lock_file = root_dir / "run.lock"
+    run_file = root_dir / "run.json"
+    pipeline_queue_size = 4
+    pipeline_uploaders = 2
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import sys
+import argparse
+from time import perf_counter
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from .api import ApiConnect
+from .api.errors import ApiError
+from .metrics import Metrics
+from .progress import Progress
+from .utilities import Utilities
+from .testing import MockHltsServer, DummyReader
+
+
+"""
+Drives ApiConnect's real upload path against a local MockHltsServer and
+reports throughput and tail latency.
+
+Run: python3 -m app.loadtest --count 20000 --concurrency 4 \\
+        --latency 0.01 0.05 --fault 429=0.02 --fault 504=0.005 \\
+        --size-distribution lognormal
+"""
+
+
+class LoadTestConfig:
+    def __init__(self, url_base, requests_per_second, bytes_per_second, ack="counts"):
+
+        self.url_base = url_base
+        self.api_key = ""
+        self.ack = ack
+        self.rate_limits = {
+            url_base: {
+                "requests_per_second": requests_per_second,
+                "bytes_per_second": bytes_per_second,
+            }
+        }
+
+
+class LoadTestLogger:
+    """ Collects log lines in memory instead of writing to app.log. """
+
+    def __init__(self):
+        self.lines = []
+
+    def info(self, info):
+        self.lines.append(f"INFO: {info}")
+
+    def warning(self, warning):
+        self.lines.append(f"WARNING: {warning}")
+
+    def error(self, error):
+        self.lines.append(f"ERROR: {error}")
+
+
+class LoadTestApp:
+    """ The bare minimum of App that ApiConnect needs. """
+
+    def __init__(self, url_base, requests_per_second=0, bytes_per_second=0, ack="counts"):
+
+        self.config = LoadTestConfig(url_base, requests_per_second, bytes_per_second, ack)
+        self.logger = LoadTestLogger()
+        self.progress = Progress()
+        self.metrics = Metrics()
+        self.utils = Utilities(self)
+
+        self.api = ApiConnect(self)
+
+
+def percentile(values, percent):
+
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+
+    return values[index]
+
+
+def run_load_test(
+    count=20000,
+    chunk_size=100,
+    concurrency=1,
+    requests_per_second=0,
+    bytes_per_second=0,
+    annotations=None,
+    ack="counts",
+    seed=0,
+    reader_options=None,
+    **server_options,
+):
+    """ Upload `count` annotations generated by `DummyReader`, or
+    `annotations` if given as adds, and return a dict of results.
+    `reader_options` are passed to DummyReader, e.g. its size ranges and
+    distribution, and `server_options` to MockHltsServer. `seed` seeds
+    both. """
+
+    with MockHltsServer(seed=seed, **server_options) as server:
+
+        app = LoadTestApp(server.url_base, requests_per_second, bytes_per_second, ack)
+
+        if annotations is None:
+            reader = DummyReader(
+                count=count, seed=seed, id_prefix="LOAD", **(reader_options or {})
+            )
+            chunks = list(reader.chunks(chunk_size))
+        else:
+            chunks = [("add", chunk) for chunk in app.utils.chunk_data(annotations, chunk_size)]
+
+        total = sum(len(chunk) for _, chunk in chunks)
+
+        latencies = []
+        errors = Counter()
+
+        def upload(item):
+
+            method, chunk = item
+
+            start = perf_counter()
+
+            try:
+                app.api.import_annotations(chunk, method)
+            except ApiError as error:
+                errors[type(error).__name__] += 1
+            else:
+                latencies.append(perf_counter() - start)
+
+            app.progress.advance(len(chunk))
+
+        app.progress.start("upload", total)
+
+        start = perf_counter()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(upload, chunks))
+
+        elapsed = perf_counter() - start
+
+        app.progress.finish()
+
+        statuses = Counter(request["status"] for request in server.requests)
+
+        results = {
+            "annotations": total,
+            "chunks": len(chunks),
+            "elapsed": elapsed,
+            "annotations_per_second": total / elapsed if elapsed else 0.0,
+            "requests": len(server.requests),
+            "bytes": sum(request["size"] for request in server.requests),
+            "statuses": dict(statuses),
+            "failed_chunks": dict(errors),
+            "stored": len(server.annotations),
+            "acknowledged": sum(app.api.acks.succeeded.values()),
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies, default=0.0),
+        }
+
+    return results
+
+
+def print_results(results):
+
+    print(f"\nAnnotations:  {results['annotations']:,} in {results['chunks']:,} chunks")
+    print(f"Elapsed:      {results['elapsed']:.2f}s")
+    print(f"Throughput:   {results['annotations_per_second']:,.0f} annotations/s")
+    print(f"Requests:     {results['requests']:,} ({results['bytes']:,} bytes)")
+    print(f"Statuses:     {results['statuses']}")
+    print(f"Failed:       {results['failed_chunks'] or 'none'}")
+    print(f"Stored:       {results['stored']:,} ({results['acknowledged']:,} acknowledged)")
+    print(
+        "Chunk latency: "
+        f"p50 {results['p50'] * 1000:.1f}ms  "
+        f"p90 {results['p90'] * 1000:.1f}ms  "
+        f"p99 {results['p99'] * 1000:.1f}ms  "
+        f"max {results['max'] * 1000:.1f}ms"
+    )
+
+
+def _fault(value):
+
+    status, probability = value.split("=")
+
+    return int(status), float(probability)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=20000)
+    parser.add_argument("--chunk-size", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--rps", type=float, default=0, help="Client requests/s.")
+    parser.add_argument("--bps", type=float, default=0, help="Client bytes/s.")
+    parser.add_argument(
+        "--latency", type=float, nargs="+", default=[0.0], help="Seconds or low high."
+    )
+    parser.add_argument(
+        "--fault",
+        type=_fault,
+        action="append",
+        default=[],
+        help="STATUS=PROBABILITY e.g. 429=0.05",
+    )
+    parser.add_argument("--retry-after", type=float, default=0.1)
+    parser.add_argument("--max-payload", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ack", choices=("ids", "counts", "full"), default="counts")
+    parser.add_argument(
+        "--refresh-ratio", type=float, default=0.0, help="Share sent as refreshes."
+    )
+    parser.add_argument(
+        "--passage-size", type=int, nargs=2, default=[20, 400], metavar=("LOW", "HIGH")
+    )
+    parser.add_argument(
+        "--notes-size", type=int, nargs=2, default=[0, 200], metavar=("LOW", "HIGH")
+    )
+    parser.add_argument(
+        "--size-distribution", choices=DummyReader.distributions, default="uniform"
+    )
+
+    args = parser.parse_args()
+
+    latency = args.latency[0] if len(args.latency) == 1 else tuple(args.latency[:2])
+
+    results = run_load_test(
+        count=args.count,
+        chunk_size=args.chunk_size,
+        concurrency=args.concurrency,
+        requests_per_second=args.rps,
+        bytes_per_second=args.bps,
+        latency=latency,
+        faults=dict(args.fault),
+        retry_after=args.retry_after,
+        max_payload=args.max_payload,
+        seed=args.seed,
+        ack=args.ack,
+        reader_options={
+            "refresh_ratio": args.refresh_ratio,
+            "passage_size": tuple(args.passage_size),
+            "notes_size": tuple(args.notes_size),
+            "distribution": args.size_distribution,
+        },
+    )
+
+    print_results(results)
+    sys.exit()
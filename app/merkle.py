@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import json
+import hashlib
+
+
+"""
+Merkle tree over annotation content hashes used to reconcile the local
+library with the server without re-sending everything.
+
+Both ends bucket annotations by the first `depth` hex characters of
+sha256(id). A leaf's hash covers the sorted (id, content hash) pairs in it
+and every other node hashes its 16 children in order. Comparing the trees
+top-down only descends into subtrees that differ, so finding the changed
+annotations takes O(changed * log n) hashes instead of a full re-upload.
+
+The server must compute `content_hash` exactly the same way.
+"""
+
+
+hex_digits = "0123456789abcdef"
+
+empty_hash = hashlib.sha256(b"").hexdigest()
+
+
+def content_hash(annotation: dict) -> str:
+    """ Hash of the parts of an annotation a user can change. """
+
+    source = annotation.get("source") or {}
+    metadata = annotation.get("metadata") or {}
+
+    projection = [
+        annotation["id"],
+        annotation.get("passage"),
+        annotation.get("notes"),
+        source.get("name"),
+        source.get("author"),
+        sorted(annotation.get("tags") or []),
+        sorted(annotation.get("collections") or []),
+        bool(metadata.get("in_trash")),
+    ]
+
+    encoded = json.dumps(projection, separators=(",", ":"), ensure_ascii=False)
+
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def bucket_of(id_: str, depth: int) -> str:
+    return hashlib.sha256(id_.encode("utf-8")).hexdigest()[:depth]
+
+
+class MerkleTree:
+    def __init__(self, hashes: dict, depth=3):
+        """ `hashes` maps annotation id to its content hash. """
+
+        self.depth = depth
+
+        self.leaves = {}
+
+        for id_, hash_ in hashes.items():
+            self.leaves.setdefault(bucket_of(id_, depth), {})[id_] = hash_
+
+        self._hashes = {}
+
+        for prefix, entries in self.leaves.items():
+            self._hashes[prefix] = self._hash_leaf(entries)
+
+        # Only non-empty subtrees are stored, anything missing is empty.
+        for level in range(depth - 1, -1, -1):
+            parents = {prefix[:level] for prefix in self._hashes if len(prefix) == level + 1}
+            for parent in parents:
+                self._hashes[parent] = self._hash_children(parent)
+
+    @classmethod
+    def from_annotations(cls, annotations, depth=3):
+        return cls(
+            {annotation["id"]: content_hash(annotation) for annotation in annotations},
+            depth=depth,
+        )
+
+    def hash(self, prefix: str) -> str:
+        return self._hashes.get(prefix, empty_hash)
+
+    def entries(self, prefix: str) -> dict:
+        return self.leaves.get(prefix, {})
+
+    @staticmethod
+    def children(prefix: str) -> list:
+        return [prefix + digit for digit in hex_digits]
+
+    def _hash_children(self, prefix):
+
+        digest = hashlib.sha256()
+
+        for child in self.children(prefix):
+            digest.update(self.hash(child).encode("ascii"))
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def _hash_leaf(entries):
+
+        digest = hashlib.sha256()
+
+        for id_ in sorted(entries):
+            digest.update(f"{id_}:{entries[id_]}\n".encode("utf-8"))
+
+        return digest.hexdigest()
+
+
+def diff(local: MerkleTree, remote_hashes, remote_entries) -> tuple:
+    """ Walk both trees from the root and return `(changed, remote_only)`.
+    `changed` are local ids that are missing or different upstream and
+    `remote_only` are ids only the server has.
+
+    `remote_hashes(prefixes)` returns {prefix: hash} and
+    `remote_entries(prefixes)` returns {prefix: {id: hash}} for leaves, so
+    each level of the tree is a single round trip. """
+
+    prefixes = [""]
+
+    for level in range(local.depth):
+
+        remote = remote_hashes(prefixes)
+
+        mismatched = [prefix for prefix in prefixes if remote.get(prefix) != local.hash(prefix)]
+
+        if not mismatched:
+            return [], []
+
+        prefixes = [child for prefix in mismatched for child in local.children(prefix)]
+
+    remote = remote_hashes(prefixes)
+
+    leaves = [prefix for prefix in prefixes if remote.get(prefix) != local.hash(prefix)]
+
+    changed = []
+    remote_only = []
+
+    remote = remote_entries(leaves) if leaves else {}
+
+    for prefix in leaves:
+
+        entries = remote.get(prefix, {})
+        local_entries = local.entries(prefix)
+
+        changed.extend(
+            id_ for id_, hash_ in local_entries.items() if entries.get(id_) != hash_
+        )
+        remote_only.extend(id_ for id_ in entries if id_ not in local_entries)
+
+    return changed, remote_only
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+import os
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+"""
+A small Prometheus-style metrics registry. Only what we need for the sync is
+implemented: counters, gauges and histograms with labels, rendered in the
+text exposition format.
+
+via. https://prometheus.io/docs/instrumenting/exposition_formats/
+
+After each run the registry is written to a textfile for node_exporter's
+textfile collector. Long-running syncs can also be scraped while they run
+with `--metrics-port`.
+"""
+
+
+class Metric:
+
+    type_ = None
+
+    def __init__(self, name, help_, labels=()):
+
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}, got {tuple(labels)}.")
+
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _format_labels(self, key, extra=()):
+
+        pairs = list(zip(self.labels, key)) + list(extra)
+
+        if not pairs:
+            return ""
+
+        escaped = (f'{label}="{_escape(value)}"' for label, value in pairs)
+
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self) -> list:
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_}"]
+
+        with self._lock:
+            for key in sorted(self._values):
+                lines.extend(self._render_value(key, self._values[key]))
+
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{self._format_labels(key)} {_format_number(value)}"]
+
+
+class Counter(Metric):
+
+    type_ = "counter"
+
+    def inc(self, amount=1, **labels):
+
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+
+    type_ = "gauge"
+
+    def set(self, value, **labels):
+
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels))
+
+
+class Histogram(Metric):
+
+    type_ = "histogram"
+
+    default_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name, help_, labels=(), buckets=default_buckets):
+
+        super().__init__(name, help_, labels)
+
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+
+        key = self._key(labels)
+
+        with self._lock:
+
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+
+            self._values[key] = (counts, total + value, count + 1)
+
+    def count(self, **labels):
+        return self._values.get(self._key(labels), (None, 0.0, 0))[2]
+
+    def _render_value(self, key, value):
+
+        counts, total, count = value
+
+        lines = [
+            f"{self.name}_bucket{self._format_labels(key, [('le', _format_number(bound))])} "
+            f"{bucket_count}"
+            for bound, bucket_count in zip(self.buckets, counts)
+        ]
+
+        lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', '+Inf')])} {count}")
+        lines.append(f"{self.name}_sum{self._format_labels(key)} {_format_number(total)}")
+        lines.append(f"{self.name}_count{self._format_labels(key)} {count}")
+
+        return lines
+
+
+class Registry:
+    def __init__(self):
+
+        self._metrics = {}
+
+    def counter(self, name, help_, labels=()) -> Counter:
+        return self._register(Counter(name, help_, labels))
+
+    def gauge(self, name, help_, labels=()) -> Gauge:
+        return self._register(Gauge(name, help_, labels))
+
+    def histogram(self, name, help_, labels=(), buckets=Histogram.default_buckets) -> Histogram:
+        return self._register(Histogram(name, help_, labels, buckets))
+
+    def _register(self, metric):
+
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered.")
+
+        self._metrics[metric.name] = metric
+
+        return metric
+
+    def render(self) -> str:
+
+        lines = []
+
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path) -> None:
+        """ Write atomically so the textfile collector never reads a half
+        written file. """
+
+        path = str(path)
+        tmp = f"{path}.{os.getpid()}.tmp"
+
+        with open(tmp, "w") as f:
+            f.write(self.render())
+
+        os.replace(tmp, path)
+
+
+class Metrics(Registry):
+    """ Everything a sync reports. Counters cover a single run since the
+    textfile is rewritten after every run. """
+
+    prefix = "hltsync"
+
+    def __init__(self):
+
+        super().__init__()
+
+        p = self.prefix
+
+        self.annotations_read = self.counter(
+            f"{p}_annotations_read_total", "Annotations read from a reader.", ["reader"]
+        )
+        self.annotations_routed = self.counter(
+            f"{p}_annotations_routed_total", "Annotations routed per bucket.", ["bucket"]
+        )
+        self.annotations_sent = self.counter(
+            f"{p}_annotations_sent_total", "Annotations sent upstream.", ["method"]
+        )
+        self.import_failures = self.counter(
+            f"{p}_import_failures_total",
+            "Annotations the server reported in import_failed.",
+            ["method"],
+        )
+        self.chunk_latency = self.histogram(
+            f"{p}_chunk_latency_seconds",
+            "Time to send one chunk including retries.",
+            ["method"],
+        )
+        self.requests = self.counter(
+            f"{p}_requests_total", "HTTP requests by status code.", ["status"]
+        )
+        self.retries = self.counter(
+            f"{p}_retries_total", "Requests retried after 429 or 503.", ["status"]
+        )
+        self.item_retries = self.counter(
+            f"{p}_item_retries_total",
+            "Annotations re-sent after a transient import failure.",
+            ["method"],
+        )
+        self.bytes_sent = self.counter(f"{p}_bytes_sent_total", "Request body bytes sent.")
+        self.stage_duration = self.gauge(
+            f"{p}_stage_duration_seconds", "Wall time of each stage of the last run.", ["stage"]
+        )
+        self.last_run_duration = self.gauge(
+            f"{p}_last_run_duration_seconds", "Wall time of the last run."
+        )
+        self.last_run_timestamp = self.gauge(
+            f"{p}_last_run_timestamp_seconds", "Unix time the last run finished."
+        )
+        self.last_run_success = self.gauge(
+            f"{p}_last_run_success", "1 if the last run finished without an error."
+        )
+
+
+class MetricsServer:
+    """ Serves a Registry on http://127.0.0.1:<port>/metrics from a daemon
+    thread. """
+
+    def __init__(self, registry, port, host="127.0.0.1"):
+
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = registry.render().encode("utf-8")
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_number(value) -> str:
+
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if value.is_integer():
+            return str(int(value)) if abs(value) < 1e15 else repr(value)
+        return repr(value)
+
+    return str(value)
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+from .defaults import AppDefaults
+from .errors import ApplicationError
+
+
+class Mirror:
+    """ Local SQLite record of every annotation that was successfully sent to
+    the server. This lets us answer "what did we sync for book X" without
+    hitting the API or re-parsing the Apple Books snapshot.
+
+    Writes may come from the upload threads of a pipelined run so they are
+    serialized on `_lock`. """
+
+    batch_size = 500
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS annotations (
+            rowid INTEGER PRIMARY KEY,
+            id TEXT NOT NULL UNIQUE,
+            source_name TEXT,
+            source_author TEXT,
+            passage TEXT,
+            notes TEXT,
+            tags TEXT,
+            collections TEXT,
+            created TEXT,
+            modified TEXT,
+            in_trash INTEGER DEFAULT 0,
+            synced TEXT
+        );
+
+        /*
+        * The UNIQUE constraint on `id` already gives us an index on id.
+        */
+        CREATE INDEX IF NOT EXISTS annotations_source
+            ON annotations (source_name);
+        CREATE INDEX IF NOT EXISTS annotations_modified
+            ON annotations (modified);
+
+        CREATE TABLE IF NOT EXISTS state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    schema_fts = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS annotations_fts USING fts5(
+            passage, notes, content='annotations', content_rowid='rowid'
+        );
+
+        CREATE TRIGGER IF NOT EXISTS annotations_ai AFTER INSERT ON annotations
+        BEGIN
+            INSERT INTO annotations_fts (rowid, passage, notes)
+            VALUES (new.rowid, new.passage, new.notes);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS annotations_ad AFTER DELETE ON annotations
+        BEGIN
+            INSERT INTO annotations_fts (annotations_fts, rowid, passage, notes)
+            VALUES ('delete', old.rowid, old.passage, old.notes);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS annotations_au
+        AFTER UPDATE OF passage, notes ON annotations
+        BEGIN
+            INSERT INTO annotations_fts (annotations_fts, rowid, passage, notes)
+            VALUES ('delete', old.rowid, old.passage, old.notes);
+            INSERT INTO annotations_fts (rowid, passage, notes)
+            VALUES (new.rowid, new.passage, new.notes);
+        END;
+    """
+
+    upsert_query = """
+        INSERT INTO annotations (
+            id, source_name, source_author, passage, notes, tags,
+            collections, created, modified, in_trash, synced
+        )
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET
+            source_name = excluded.source_name,
+            source_author = excluded.source_author,
+            passage = excluded.passage,
+            notes = excluded.notes,
+            tags = excluded.tags,
+            collections = excluded.collections,
+            created = excluded.created,
+            modified = excluded.modified,
+            in_trash = excluded.in_trash,
+            synced = excluded.synced;
+    """
+
+    def __init__(self, app, path=AppDefaults.mirror_file):
+
+        self.app = app
+        self.path = path
+
+        self.has_fts = True
+
+        self._lock = threading.Lock()
+
+        try:
+            self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+            self.connection.row_factory = sqlite3.Row
+            self.connection.executescript(self.schema)
+        except sqlite3.Error as error:
+            raise ApplicationError(f"SQLite Error: {repr(error)}", self.app)
+
+        try:
+            self.connection.executescript(self.schema_fts)
+        except sqlite3.OperationalError:
+            """ SQLite was built without FTS5. Searching falls back to LIKE
+            which is slower but still works offline. """
+            self.has_fts = False
+
+    def update(self, annotations: list) -> None:
+        """ Insert or update serialized annotations in batches of
+        `batch_size`. Expects the same dicts that are sent to the API. """
+
+        synced = datetime.utcnow().isoformat()
+
+        rows = (self._to_row(annotation, synced) for annotation in annotations)
+
+        try:
+            with self._lock, self.connection:
+                batch = []
+                for row in rows:
+                    batch.append(row)
+                    if len(batch) >= self.batch_size:
+                        self.connection.executemany(self.upsert_query, batch)
+                        batch = []
+                if batch:
+                    self.connection.executemany(self.upsert_query, batch)
+        except sqlite3.Error as error:
+            raise ApplicationError(f"SQLite Error: {repr(error)}", self.app)
+
+    def search(self, query: str, source=None, limit=20) -> list:
+
+        if self.has_fts:
+            sql = """
+                SELECT annotations.*
+                FROM annotations_fts
+                JOIN annotations ON annotations.rowid = annotations_fts.rowid
+                WHERE annotations_fts MATCH ?
+            """
+            params = [query]
+        else:
+            sql = """
+                SELECT annotations.*
+                FROM annotations
+                WHERE (passage LIKE ? OR notes LIKE ?)
+            """
+            params = [f"%{query}%", f"%{query}%"]
+
+        if source:
+            sql += " AND annotations.source_name = ?"
+            params.append(source)
+
+        sql += " ORDER BY rank LIMIT ?" if self.has_fts else " LIMIT ?"
+        params.append(limit)
+
+        try:
+            cursor = self.connection.execute(sql, params)
+        except sqlite3.OperationalError as error:
+            # Usually a malformed FTS5 query string.
+            raise ApplicationError(f"Search Error: {error}", self.app)
+
+        return [dict(row) for row in cursor.fetchall()]
+
+    def by_source(self, source: str) -> list:
+
+        cursor = self.connection.execute(
+            "SELECT * FROM annotations WHERE source_name = ? ORDER BY modified;",
+            (source,),
+        )
+
+        return [dict(row) for row in cursor.fetchall()]
+
+    def known_ids(self, ids) -> list:
+        """ Filter `ids` down to those we've synced and haven't trashed yet
+        i.e. the ones that still exist upstream. """
+
+        ids = list(ids)
+        known = []
+
+        # Stay well under SQLite's host parameter limit.
+        for x in range(0, len(ids), self.batch_size):
+            batch = ids[x : x + self.batch_size]
+            placeholders = ", ".join("?" * len(batch))
+            cursor = self.connection.execute(
+                f"""
+                SELECT id FROM annotations
+                WHERE in_trash = 0 AND id IN ({placeholders});
+                """,
+                batch,
+            )
+            known.extend(row["id"] for row in cursor.fetchall())
+
+        return known
+
+    def all_annotations(self) -> list:
+        """ Every synced annotation, trashed ones included, in the shape
+        they were sent in. """
+
+        cursor = self.connection.execute("SELECT * FROM annotations;")
+
+        return [self._from_row(row) for row in cursor]
+
+    def mark_trashed(self, ids) -> None:
+
+        rows = [(id_,) for id_ in ids]
+
+        try:
+            with self._lock, self.connection:
+                self.connection.executemany(
+                    "UPDATE annotations SET in_trash = 1 WHERE id = ?;", rows
+                )
+        except sqlite3.Error as error:
+            raise ApplicationError(f"SQLite Error: {repr(error)}", self.app)
+
+    def get_state(self, key, default=None):
+
+        row = self.connection.execute(
+            "SELECT value FROM state WHERE key = ?;", (key,)
+        ).fetchone()
+
+        if row is None:
+            return default
+
+        return json.loads(row["value"])
+
+    def set_state(self, key, value) -> None:
+
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?);",
+                (key, json.dumps(value)),
+            )
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def _to_row(annotation: dict, synced: str) -> tuple:
+
+        source = annotation.get("source", {})
+        metadata = annotation.get("metadata", {})
+
+        return (
+            annotation["id"],
+            source.get("name"),
+            source.get("author"),
+            annotation.get("passage"),
+            annotation.get("notes"),
+            json.dumps(annotation.get("tags", [])),
+            json.dumps(annotation.get("collections", [])),
+            metadata.get("created"),
+            metadata.get("modified"),
+            int(bool(metadata.get("in_trash"))),
+            synced,
+        )
+
+    @staticmethod
+    def _from_row(row: sqlite3.Row) -> dict:
+
+        return {
+            "id": row["id"],
+            "passage": row["passage"],
+            "notes": row["notes"],
+            "source": {"name": row["source_name"], "author": row["source_author"]},
+            "tags": json.loads(row["tags"] or "[]"),
+            "collections": json.loads(row["collections"] or "[]"),
+            "metadata": {
+                "created": row["created"],
+                "modified": row["modified"],
+                "in_trash": bool(row["in_trash"]),
+            },
+        }
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import queue
+import threading
+from time import monotonic
+
+
+"""
+Runs the stages of a sync concurrently instead of one after another. Each
+stage is a thread connected to the next by a bounded queue so a slow stage
+(usually the upload) blocks the ones before it instead of letting them pile
+everything up in memory.
+
+    pipeline = Pipeline(maxsize=4)
+    batches = pipeline.source("read", read_batches())
+    chunks = pipeline.stage("transform", batches, transform)
+    pipeline.sink("upload", chunks, upload, workers=2)
+    pipeline.run()
+
+The first error raised in any stage cancels the others and is re-raised by
+`run` once every thread has stopped.
+"""
+
+
+class Cancelled(Exception):
+    """ Raised inside a stage when the pipeline is being torn down. """
+
+
+# Marks the end of a queue. Consumers put it back so every worker sees it.
+_done = object()
+
+
+class Pipeline:
+
+    poll_interval = 0.1
+
+    def __init__(self, maxsize=4):
+
+        self.maxsize = maxsize
+
+        self.cancelled = threading.Event()
+        self.errors = []
+        self.durations = {}
+
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def source(self, name, iterable) -> queue.Queue:
+        """ Feed every item of `iterable` into a new queue. """
+
+        outbox = queue.Queue(self.maxsize)
+
+        def run():
+            try:
+                for item in iterable:
+                    self._put(outbox, item)
+            finally:
+                close = getattr(iterable, "close", None)
+                if close is not None:
+                    close()
+
+            self._put(outbox, _done)
+
+        self._start(name, run)
+
+        return outbox
+
+    def stage(self, name, inbox, func) -> queue.Queue:
+        """ `func` takes an iterator over `inbox` and yields items for the
+        next stage. Taking the whole stream rather than one item at a time
+        lets stages keep state e.g. grouping annotations per source. """
+
+        outbox = queue.Queue(self.maxsize)
+
+        def run():
+
+            results = func(self._iter(inbox))
+
+            try:
+                for item in results:
+                    self._put(outbox, item)
+            finally:
+                close = getattr(results, "close", None)
+                if close is not None:
+                    close()
+
+            self._put(outbox, _done)
+
+        self._start(name, run)
+
+        return outbox
+
+    def sink(self, name, inbox, func, workers=1) -> None:
+        """ Call `func(item)` for every item in `inbox` from `workers`
+        threads. """
+
+        for x in range(workers):
+
+            def run():
+                for item in self._iter(inbox):
+                    func(item)
+
+            self._start(name if workers == 1 else f"{name}-{x}", run)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def run(self):
+        """ Wait for every stage to finish. Ctrl-C cancels the pipeline. """
+
+        try:
+            for thread in self._threads:
+                while thread.is_alive():
+                    thread.join(self.poll_interval)
+        except KeyboardInterrupt:
+            self.cancel()
+            for thread in self._threads:
+                thread.join()
+            raise
+
+        if self.errors:
+            name, error = self.errors[0]
+            raise error
+
+    def _start(self, name, target):
+
+        def run():
+
+            started = monotonic()
+
+            try:
+                target()
+            except Cancelled:
+                pass
+            except Exception as error:
+                with self._lock:
+                    self.errors.append((name, error))
+                self.cancel()
+            finally:
+                with self._lock:
+                    self.durations[name] = monotonic() - started
+
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        thread.start()
+
+        self._threads.append(thread)
+
+    def _put(self, outbox, item):
+
+        while True:
+            if self.cancelled.is_set():
+                raise Cancelled()
+            try:
+                outbox.put(item, timeout=self.poll_interval)
+                return
+            except queue.Full:
+                continue
+
+    def _iter(self, inbox):
+
+        while True:
+
+            if self.cancelled.is_set():
+                raise Cancelled()
+
+            try:
+                item = inbox.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+
+            if item is _done:
+                self._put(inbox, _done)
+                return
+
+            yield item
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import threading
+from datetime import timedelta
+
+
+class Phase:
+    def __init__(self, name, total):
+
+        self.name = name
+        self.total = total
+        self.items = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def items_per_second(self):
+        return self.items / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def eta(self):
+
+        if not self.total or not self.items_per_second:
+            return None
+
+        return max(0.0, (self.total - self.items) / self.items_per_second)
+
+
+class Progress:
+    """ One status line for the whole sync. Each stage (read, transform,
+    upload) is a phase with its own item and byte counters. Finished phases
+    are shown as done and the active one gets the bar, throughput, ETA and
+    number of in-flight requests.
+
+    All methods are thread-safe. Redraws are throttled to `min_interval`
+    seconds. When `stream` isn't a TTY a plain status line is written every
+    `log_interval` seconds instead so cron logs stay readable. """
+
+    max_bar = 30
+
+    def __init__(self, stream=None, min_interval=0.1, log_interval=10.0):
+
+        self.stream = stream or sys.stdout
+        self.is_tty = hasattr(self.stream, "isatty") and self.stream.isatty()
+        self.interval = min_interval if self.is_tty else log_interval
+
+        self.phases = {}
+        self.in_flight = 0
+
+        self._current = None
+        self._last_draw = 0.0
+        self._lock = threading.RLock()
+
+    def start(self, name, total=None):
+
+        with self._lock:
+            if self._current is not None and self._current.finished is None:
+                self._finish_current()
+            self._current = self.phases[name] = Phase(name, total)
+            self._draw(force=True)
+
+    def set_total(self, total):
+        with self._lock:
+            if self._current is not None:
+                self._current.total = total
+
+    def advance(self, items=1, bytes_=0):
+
+        with self._lock:
+            if self._current is None:
+                return
+            self._current.items += items
+            self._current.bytes += bytes_
+            self._draw()
+
+    def add_bytes(self, bytes_):
+        self.advance(items=0, bytes_=bytes_)
+
+    def request_started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def request_finished(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def finish(self):
+
+        with self._lock:
+            if self._current is not None and self._current.finished is None:
+                self._finish_current()
+
+    def _finish_current(self):
+
+        self._current.finished = time.monotonic()
+        self._draw(force=True)
+
+        if self.is_tty:
+            self.stream.write("\n")
+            self.stream.flush()
+
+    def _draw(self, force=False):
+
+        now = time.monotonic()
+
+        if not force and now - self._last_draw < self.interval:
+            return
+
+        self._last_draw = now
+
+        line = self._render()
+
+        if self.is_tty:
+            self.stream.write(f"\r{line}\033[K")
+        else:
+            self.stream.write(f"{line}\n")
+
+        self.stream.flush()
+
+    def _render(self):
+
+        done = [
+            f"{phase.name} ✓"
+            for phase in self.phases.values()
+            if phase.finished is not None and phase is not self._current
+        ]
+
+        phase = self._current
+
+        if phase.total:
+            ratio = min(1.0, phase.items / phase.total)
+            filled = int(round(self.max_bar * ratio))
+            bar = f"{'▓' * filled}{'░' * (self.max_bar - filled)} {100 * ratio:.1f}% "
+            count = f"{phase.items:,}/{phase.total:,}"
+        else:
+            bar = ""
+            count = f"{phase.items:,}"
+
+        parts = [f"{phase.name} {bar}{count}", f"{phase.items_per_second:,.0f}/s"]
+
+        if phase.bytes:
+            parts.append(f"{self._format_bytes(phase.bytes_per_second)}/s")
+
+        if phase.finished is not None:
+            parts.append(f"in {self._format_seconds(phase.elapsed)}")
+        elif phase.eta is not None:
+            parts.append(f"ETA {self._format_seconds(phase.eta)}")
+
+        if self.in_flight:
+            parts.append(f"{self.in_flight} in-flight")
+
+        return " ".join(done + [" · ".join(parts)])
+
+    @staticmethod
+    def _format_bytes(size):
+
+        for unit in ("B", "KB", "MB", "GB"):
+            if size < 1024:
+                return f"{size:.1f} {unit}"
+            size /= 1024
+
+        return f"{size:.1f} TB"
+
+    @staticmethod
+    def _format_seconds(seconds):
+        return str(timedelta(seconds=int(seconds)))
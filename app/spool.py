@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import pathlib
+import threading
+
+from .defaults import AppDefaults
+from .errors import ApplicationError
+
+
+class Spool:
+    """ Durable on-disk queue of chunks that couldn't be sent because the
+    server was unreachable. Chunks are appended as JSON lines to numbered
+    segment files. A segment is only removed once everything in it has been
+    sent, so nothing is lost if a run dies half way through draining.
+
+    Each line holds one chunk: {"method": "add", "data": [...]}. """
+
+    segment_size = 8 * 1024 * 1024
+
+    def __init__(self, app, directory: pathlib.Path = AppDefaults.spool_dir):
+
+        self.app = app
+        self.directory = directory
+
+        self.app.utils.make_dir(path=self.directory)
+
+        # Segments handed out by `drain`. New chunks never go into these so
+        # `remove` can't delete anything that wasn't drained.
+        self._sealed = set()
+
+        # Upload threads of a pipelined run may spool at the same time.
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.segments)
+
+    @property
+    def segments(self) -> list:
+        return sorted(self.directory.glob("*.log"))
+
+    def append(self, chunk: list, method: str) -> None:
+
+        line = json.dumps({"method": method, "data": chunk}) + "\n"
+
+        try:
+            with self._lock, open(self._current_segment(), "a") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as error:
+            raise ApplicationError(f"{error.filename} - {error.strerror}", self.app)
+
+    def drain(self, batch_size: int):
+        """ Return `(segments, batches)` where `batches` is a list of
+        `(method, chunk)` holding everything currently spooled.
+
+        Items are deduplicated by annotation id, the most recently spooled
+        version wins and takes the position of its last write. Consecutive
+        items with the same method are packed into chunks of up to
+        `batch_size`. Pass `segments` to `remove` once the batches are sent.
+        """
+
+        segments = self.segments
+        self._sealed.update(segments)
+
+        items = {}
+
+        for segment in segments:
+            with open(segment, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn write from a run that died mid-append.
+                        self.app.logger.warning(f"Skipping corrupt line in {segment}.")
+                        continue
+
+                    method = record["method"]
+
+                    for item in record["data"]:
+                        items.pop(item["id"], None)
+                        items[item["id"]] = (method, item)
+
+        batches = []
+
+        for method, item in items.values():
+            if batches and batches[-1][0] == method and len(batches[-1][1]) < batch_size:
+                batches[-1][1].append(item)
+            else:
+                batches.append((method, [item]))
+
+        return segments, batches
+
+    def remove(self, segments: list) -> None:
+        for segment in segments:
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _current_segment(self) -> pathlib.Path:
+
+        segments = self.segments
+
+        if segments:
+            latest = segments[-1]
+            if latest not in self._sealed and latest.stat().st_size < self.segment_size:
+                return latest
+            number = int(latest.stem) + 1
+        else:
+            number = 0
+
+        return self.directory / f"{number:08d}.log"
@@ -1,23 +1,104 @@
 #!/usr/bin/env python3
 
+import json
+import math
+import time
+import random
+import hashlib
+import threading
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-def dummy_annotations(count, id_prefix="", passage=""):
+from .api.defaults import ApiDefaults
+from .merkle import MerkleTree
 
-    data = []
 
-    for num in range(count):
+class DummyReader:
+    """ Load generator for the `dummy` reader. Annotations are generated
+    lazily from `seed` so the same arguments always give the same library
+    and memory stays flat however large `count` is.
 
-        data.append(
-            {
-                "id": f"ID-{id_prefix}-{num}",
-                "passage": f"Testing-{id_prefix}-{num} {passage}!",
+    Passage and notes lengths are drawn from `passage_size` and `notes_size`,
+    both `(low, high)` character ranges, either uniformly or from a
+    log-normal clipped to the range which is closer to real highlights:
+    mostly short with a long tail. Each annotation gets up to `tags` tags
+    and `collections` collections. `refresh_ratio` of them are sent as
+    refreshes, the rest as adds. Ids are unique across both. """
+
+    distributions = ("uniform", "lognormal")
+
+    vocabulary = (
+        "the of and to in that it is was for on with as his be at by had this "
+        "not but from or have an they which one you were her all she there would "
+        "their we him been has when who will more no if out so said what up its "
+        "about into than them can only other new some could time these two may "
+        "then do first any my now such like our over man me even most made after"
+    ).split()
+
+    pool_size = 64 * 1024
+
+    def __init__(
+        self,
+        count=100,
+        refresh_ratio=0.5,
+        passage_size=(20, 400),
+        notes_size=(0, 200),
+        distribution="uniform",
+        tags=3,
+        collections=1,
+        sources=50,
+        seed=0,
+        id_prefix="DUMMY",
+    ):
+
+        if distribution not in self.distributions:
+            raise ValueError(f"Unknown size distribution: {distribution}")
+
+        self.count = count
+        self.refresh_ratio = refresh_ratio
+        self.passage_size = passage_size
+        self.notes_size = notes_size
+        self.distribution = distribution
+        self.tags = tags
+        self.collections = collections
+        self.sources = sources
+        self.seed = seed
+        self.id_prefix = id_prefix
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """ Yield `(method, annotation)` for every annotation. """
+
+        random_ = random.Random(self.seed)
+
+        # Passages and notes are slices of one block of text so generating
+        # them costs a couple of random numbers and a copy.
+        pool = " ".join(
+            random_.choice(self.vocabulary) for _ in range(self.pool_size // 4)
+        )[: self.pool_size]
+
+        tags = [f"tag{x}" for x in range(50)]
+        collections = [f"collection{x}" for x in range(20)]
+
+        for num in range(self.count):
+
+            method = "refresh" if random_.random() < self.refresh_ratio else "add"
+            source = random_.randrange(max(1, self.sources))
+
+            yield method, {
+                "id": f"ID-{self.id_prefix}-{num}",
+                "passage": self._text(random_, pool, self.passage_size),
                 "source": {
-                    "name": "Testing Source",
-                    "author": "Testing Author"
+                    "name": f"Testing Source {source}",
+                    "author": f"Testing Author {source % 10}"
                 },
-                "notes": "",
-                "tags": [],
-                "collections": [],
+                "notes": self._text(random_, pool, self.notes_size),
+                "tags": random_.sample(tags, random_.randint(0, min(self.tags, len(tags)))),
+                "collections": random_.sample(
+                    collections, random_.randint(0, min(self.collections, len(collections)))
+                ),
                 "metadata": {
                     "in_trash": False,
                     "is_protected": False,
@@ -26,6 +107,362 @@ def dummy_annotations(count, id_prefix="", passage=""):
                     "created": ""
                 },
             }
-        )
 
-    return data
+    def chunks(self, chunk_size=100):
+        """ Yield `(method, chunk)` with adds and refreshes packed into
+        separate chunks of up to `chunk_size`. """
+
+        pending = {"add": [], "refresh": []}
+
+        for method, annotation in self:
+
+            chunk = pending[method]
+            chunk.append(annotation)
+
+            if len(chunk) >= chunk_size:
+                yield method, chunk
+                pending[method] = []
+
+        for method, chunk in pending.items():
+            if chunk:
+                yield method, chunk
+
+    def _text(self, random_, pool, size):
+
+        low, high = size
+
+        if high <= 0:
+            return ""
+
+        if self.distribution == "uniform":
+            length = random_.randint(low, high)
+        else:
+            # Median at the geometric mean of the range.
+            median = (max(low, 1) * high) ** 0.5
+            length = int(random_.lognormvariate(math.log(median), 0.75))
+            length = min(high, max(low, length))
+
+        if not length:
+            return ""
+
+        start = random_.randrange(0, len(pool) - length) if length < len(pool) else 0
+
+        return pool[start : start + length].strip()
+
+
+class MockHltsServer:
+    """ Local stand-in for the hlts API. Runs in a background thread and
+    keeps annotations in memory so syncs can be checked end-to-end without a
+    live server.
+
+        with MockHltsServer(latency=(0.01, 0.05), faults={429: 0.05}) as server:
+            config.url_base = server.url_base
+            ...
+            server.annotations["ID-TEST0-0"]["metadata"]["in_trash"]
+
+    `latency` is added to every request, either fixed seconds or a
+    `(low, high)` range. `faults` maps a status code (429, 500, 503, 504...)
+    to the probability a request is answered with it. 429 and 503 carry
+    `retry_after`. `item_faults` is the probability a single added or
+    refreshed annotation is reported in `import_failed` with a transient
+    "try again" error. Imports echo every imported annotation back unless
+    the client asks for `?ack=ids` or `?ack=counts`. POST bodies over
+    `max_payload` bytes get a 413. Imports holding any id in `poisoned` are
+    always answered with a 500. Every request is appended to `requests` as a
+    dict of method, path, size, status and time taken. """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        api_key="",
+        latency=0.0,
+        faults=None,
+        retry_after=1,
+        max_payload=None,
+        item_faults=0.0,
+        poisoned=(),
+        seed=0,
+    ):
+
+        self.api_key = api_key
+        self.annotations = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+        self.latency = latency
+        self.faults = faults or {}
+        self.retry_after = retry_after
+        self.max_payload = max_payload
+        self.item_faults = item_faults
+        self.poisoned = set(poisoned)
+
+        self._random = random.Random(seed)
+
+        self._httpd = ThreadingHTTPServer((host, port), self._handler())
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def url_base(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def add(self, data):
+
+        succeeded = []
+        failed = []
+
+        with self.lock:
+            for annotation in data:
+                if self.item_faults and self._random.random() < self.item_faults:
+                    failed.append(
+                        {"id": annotation["id"], "error": "Database is locked, try again."}
+                    )
+                    continue
+                self.annotations[annotation["id"]] = annotation
+                succeeded.append(annotation)
+
+        return succeeded, failed
+
+    def refresh(self, data):
+        return self.add(data)
+
+    def trash(self, data):
+
+        succeeded = []
+        failed = []
+
+        with self.lock:
+            for item in data:
+                annotation = self.annotations.get(item["id"])
+                if annotation is None:
+                    failed.append({"id": item["id"], "error": "Not found."})
+                    continue
+                annotation["metadata"]["in_trash"] = True
+                succeeded.append({"id": item["id"]})
+
+        return succeeded, failed
+
+    def export(self, page, per_page):
+        """ Return `(body, total_pages)` for one page of the export. """
+
+        with self.lock:
+            annotations = [self.annotations[id_] for id_ in sorted(self.annotations)]
+
+        total_pages = max(1, -(-len(annotations) // per_page))
+        start = (page - 1) * per_page
+
+        body = json.dumps(annotations[start : start + per_page]).encode("utf-8")
+
+        return body, total_pages
+
+    def tree(self, depth):
+
+        with self.lock:
+            annotations = list(self.annotations.values())
+
+        return MerkleTree.from_annotations(annotations, depth=depth)
+
+    def tree_hashes(self, prefixes, depth):
+        tree = self.tree(depth)
+        return {"hashes": {prefix: tree.hash(prefix) for prefix in prefixes}}
+
+    def tree_leaves(self, prefixes, depth):
+        tree = self.tree(depth)
+        return {"entries": {prefix: tree.entries(prefix) for prefix in prefixes}}
+
+    def _delay(self):
+
+        latency = self.latency
+
+        if isinstance(latency, (tuple, list)):
+            with self.lock:
+                latency = self._random.uniform(*latency)
+
+        if latency:
+            time.sleep(latency)
+
+    def _fault(self):
+
+        with self.lock:
+            roll = self._random.random()
+
+        for status, probability in self.faults.items():
+            if roll < probability:
+                return status
+            roll -= probability
+
+        return None
+
+    def _handler(self):
+
+        server = self
+
+        routes = {
+            ApiDefaults.url_add: server.add,
+            ApiDefaults.url_refresh: server.refresh,
+            ApiDefaults.url_trash: server.trash,
+        }
+
+        sync_routes = {
+            ApiDefaults.url_tree: server.tree_hashes,
+            ApiDefaults.url_leaves: server.tree_leaves,
+        }
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send_response(self, code, message=None):
+                self._status = code
+                super().send_response(code, message)
+
+            def _authorized(self):
+                if not server.api_key:
+                    return True
+                return self.headers.get("Authorization") == f"Bearer {server.api_key}"
+
+            def _respond(self, status, body, headers=None):
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _handle(self, handler):
+
+                start = time.perf_counter()
+                size = int(self.headers.get("Content-Length", 0))
+
+                server._delay()
+
+                fault = server._fault()
+
+                if fault is not None:
+                    # Drain the body so the client sees the response.
+                    self.rfile.read(size)
+                    headers = {}
+                    if fault in (429, 503):
+                        headers["Retry-After"] = str(server.retry_after)
+                    self._respond(fault, {"error": "Injected fault."}, headers)
+                elif server.max_payload and size > server.max_payload:
+                    self.rfile.read(size)
+                    self._respond(413, {"error": "Payload too large."})
+                elif not self._authorized():
+                    self.rfile.read(size)
+                    self._respond(401, {"error": "Invalid API key."})
+                else:
+                    handler()
+
+                with server.lock:
+                    server.requests.append(
+                        {
+                            "method": self.command,
+                            "path": self.path,
+                            "size": size,
+                            "status": self._status,
+                            "time": time.perf_counter() - start,
+                        }
+                    )
+
+            def do_GET(self):
+                self._handle(self._get)
+
+            def do_POST(self):
+                self._handle(self._post)
+
+            def _get(self):
+                url = urlsplit(self.path)
+                if url.path == ApiDefaults.url_export:
+                    return self._export(parse_qs(url.query))
+                if self.path != ApiDefaults.url_verify:
+                    return self._respond(404, {"error": "Not found."})
+                self._respond(200, {"data": {}})
+
+            def _export(self, query):
+
+                page = int(query.get("page", ["1"])[0])
+                per_page = int(query.get("per_page", ["1000"])[0])
+
+                body, total_pages = server.export(page, per_page)
+                etag = f'"{hashlib.md5(body).hexdigest()}"'
+
+                status = 200
+
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("X-Total-Pages", str(total_pages))
+                    self.end_headers()
+                    return
+
+                range_ = self.headers.get("Range")
+                if range_ and self.headers.get("If-Range", etag) == etag:
+                    offset = int(range_.split("=")[1].split("-")[0])
+                    body = body[offset:]
+                    status = 206
+
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.send_header("X-Total-Pages", str(total_pages))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _post(self):
+
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+
+                url = urlsplit(self.path)
+
+                sync_route = sync_routes.get(url.path)
+                if sync_route is not None:
+                    data = json.loads(body)
+                    return self._respond(
+                        200, {"data": sync_route(data["prefixes"], data["depth"])}
+                    )
+
+                route = routes.get(url.path)
+                if route is None:
+                    return self._respond(404, {"error": "Not found."})
+
+                data = json.loads(body)
+
+                if any(item["id"] in server.poisoned for item in data):
+                    return self._respond(500, {"error": "Internal server error."})
+
+                succeeded, failed = route(data)
+
+                ack = parse_qs(url.query).get("ack", ["full"])[0]
+
+                if ack == "ids":
+                    succeeded = [item["id"] for item in succeeded]
+                elif ack == "counts":
+                    succeeded = len(succeeded)
+
+                self._respond(
+                    201,
+                    {"data": {"import_succeeded": succeeded, "import_failed": failed}},
+                )
+
+        return Handler
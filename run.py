@@ -4,6 +4,8 @@ import sys
 import argparse
 
 from app import App
+from app.defaults import AppDefaults
+from app.api.defaults import ApiDefaults
 
 """
 README: This works! Although the API response isn't great. It doesn't seem to
@@ -18,20 +20,142 @@ To run with Books:
   This will build folder structure and config files.
 - Set configuration in ~/.hltsync/config.json
 - Run: python3 run.py applebooks
+
+To upload while Books is still being read, without the interactive prompt:
+- Run: python3 run.py applebooks --pipeline --yes
+
+To only send what changed since the last successful sync, including books
+moved between collections:
+- Run: python3 run.py applebooks --changed
+
+If the server is unreachable annotations are spooled to ~/.hltsync/spool and
+sent at the start of the next run. To only send spooled annotations:
+- Run: python3 run.py drain
+
+To download everything on the server to ~/.hltsync/downloads:
+- Run: python3 run.py download
+
+To search what has been synced:
+- Run: python3 run.py search "some words" [--source "Book Title"]
+
+To load test a server with a million generated annotations:
+- Run: python3 run.py dummy --count 1000000 --size-distribution lognormal --yes
+
+Metrics from the last run are written to ~/.hltsync/hltsync.prom, point
+`metrics_textfile` in the config at node_exporter's textfile directory to
+collect them. Pass --metrics-port to also serve them while a sync runs.
 """
 
 
 parser = argparse.ArgumentParser()
+parser.add_argument("-s", "--setup", action="store_true", help="Run initial setup.")
 parser.add_argument(
-    "reader",
-    choices=["dummy", "applebooks", "kindle"],
+    "--if-running",
+    choices=("attach", "wait", "fail"),
+    default="attach",
+    help="What to do if another sync is running. attach: wait for it and report "
+    "its results. wait: wait for it and then run. fail: exit.",
+)
+parser.add_argument(
+    "--metrics-port",
+    type=int,
+    help="Serve Prometheus metrics on 127.0.0.1:PORT/metrics while running.",
+)
+
+subparsers = parser.add_subparsers(dest="reader", help="Which reader to sync.")
+dummy_parser = subparsers.add_parser(
+    "dummy", help="Send generated annotations, for load testing a server."
+)
+dummy_parser.add_argument("--count", type=int, default=100, help="Annotations to send.")
+dummy_parser.add_argument(
+    "--refresh-ratio", type=float, default=0.5, help="Share sent as refreshes."
+)
+dummy_parser.add_argument(
+    "--passage-size",
+    type=int,
+    nargs=2,
+    default=[20, 400],
+    metavar=("LOW", "HIGH"),
+    help="Passage length range in characters.",
+)
+dummy_parser.add_argument(
+    "--notes-size",
+    type=int,
+    nargs=2,
+    default=[0, 200],
+    metavar=("LOW", "HIGH"),
+    help="Notes length range in characters.",
+)
+dummy_parser.add_argument(
+    "--size-distribution",
+    choices=("uniform", "lognormal"),
+    default="uniform",
+    help="How lengths are drawn from their range.",
+)
+dummy_parser.add_argument("--tags", type=int, default=3, help="Max tags per annotation.")
+dummy_parser.add_argument(
+    "--collections", type=int, default=1, help="Max collections per annotation."
+)
+dummy_parser.add_argument("--sources", type=int, default=50, help="Number of sources.")
+dummy_parser.add_argument("--seed", type=int, default=0, help="Same seed, same annotations.")
+dummy_parser.add_argument(
+    "--uploaders", type=int, default=AppDefaults.pipeline_uploaders, help="Upload threads."
+)
+dummy_parser.add_argument(
+    "-y", "--yes", action="store_true", help="Don't ask for confirmation."
+)
+applebooks_parser = subparsers.add_parser(
+    "applebooks", help="Sync Apple Books annotations."
+)
+applebooks_parser.add_argument(
+    "--workers",
+    type=int,
     nargs="?",
-    help="Which reader to sync.",
+    const=0,
+    default=1,
+    help="Transform annotations in a process pool. Defaults to one per CPU.",
+)
+applebooks_mode = applebooks_parser.add_mutually_exclusive_group()
+applebooks_mode.add_argument(
+    "--reconcile",
+    action="store_true",
+    help="Only send annotations that differ from the server.",
+)
+applebooks_mode.add_argument(
+    "--pipeline",
+    action="store_true",
+    help="Upload while reading. Confirmation is asked for up front.",
+)
+applebooks_parser.add_argument(
+    "--changed",
+    action="store_true",
+    help="Only send annotations whose rows, or whose book's collections, changed "
+    "since the last successful sync.",
+)
+applebooks_parser.add_argument(
+    "-y", "--yes", action="store_true", help="Don't ask for confirmation."
+)
+subparsers.add_parser("kindle", help="Sync Kindle annotations.")
+
+subparsers.add_parser("drain", help="Send annotations spooled while offline.")
+
+download_parser = subparsers.add_parser(
+    "download", help="Download all annotations as a .hlts file."
+)
+download_parser.add_argument(
+    "--per-page", type=int, default=ApiDefaults.per_page, help="Annotations per page."
 )
-parser.add_argument("-s", "--setup", action="store_true", help="Run initial setup.")
+
+search_parser = subparsers.add_parser("search", help="Search synced annotations.")
+search_parser.add_argument("query", help="FTS5 query over passages and notes.")
+search_parser.add_argument("--source", help="Limit results to a source name.")
+search_parser.add_argument("--limit", type=int, default=20, help="Max results.")
 
 args = parser.parse_args()
 
+if getattr(args, "changed", False) and args.reconcile:
+    parser.error("--changed can't be combined with --reconcile.")
+
 
 if __name__ == "__main__":
 
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import sqlite3
+import tempfile
+import unittest
+import subprocess
+from pathlib import Path
+
+from app.testing import MockHltsServer
+
+
+"""
+Helpers for running `run.py` end to end against `MockHltsServer`. Every test
+gets its own HOME holding a fake Apple Books library and ~/.hltsync so runs
+never touch the real ones.
+"""
+
+
+root_dir = Path(__file__).resolve().parent.parent
+run_file = root_dir / "run.py"
+
+books_dir = "Library/Containers/com.apple.iBooksX/Data/Documents"
+
+
+class Home:
+    def __init__(self):
+
+        self._tmp = tempfile.TemporaryDirectory()
+
+        self.path = Path(self._tmp.name)
+        self.app_dir = self.path / ".hltsync"
+
+    def cleanup(self):
+        self._tmp.cleanup()
+
+    def write_config(self, url_base, **overrides):
+        """ A config with every color enabled, odd books in "Sync" (add) and
+        even ones in "Refresh", and no rate limit towards `url_base`. """
+
+        config = {
+            "env": "",
+            "url_base": url_base,
+            "api_key": "key",
+            "prefix_tag": "#",
+            "prefix_collection": "@",
+            "applebooks": {
+                "collections": {"add": "Sync", "refresh": "Refresh", "ignore": ""},
+                "colors": dict.fromkeys(
+                    ("underline", "green", "blue", "yellow", "pink", "purple"), True
+                ),
+            },
+            "rate_limits": {url_base: {"requests_per_second": 0}},
+        }
+
+        config.update(overrides)
+
+        self.app_dir.mkdir(parents=True, exist_ok=True)
+
+        with open(self.app_dir / "config.json", "w") as f:
+            json.dump(config, f)
+
+    def write_library(self, count, deleted=(), books=10, uncollected=()):
+        """ Write BKLibrary and AEAnnotation databases with `count`
+        annotations `UUID-<n>` spread over `books` books. Annotations whose
+        number is in `deleted` are marked deleted, as Books does. Books whose
+        number is in `uncollected` are in no user collection. """
+
+        root = self.path / books_dir
+
+        library_file = root / "BKLibrary" / "BKLibrary-1.sqlite"
+        annotation_file = root / "AEAnnotation" / "AEAnnotation_v10.sqlite"
+
+        for path in (library_file, annotation_file):
+            path.parent.mkdir(parents=True, exist_ok=True)
+            if path.exists():
+                path.unlink()
+
+        library = sqlite3.connect(str(library_file))
+
+        library.executescript(
+            """
+            CREATE TABLE ZBKCOLLECTION (Z_PK INTEGER PRIMARY KEY, ZCOLLECTIONID TEXT, ZTITLE TEXT);
+            CREATE TABLE ZBKCOLLECTIONMEMBER (Z_PK INTEGER PRIMARY KEY, ZASSETID TEXT, ZCOLLECTION INTEGER);
+            CREATE TABLE ZBKLIBRARYASSET (Z_PK INTEGER PRIMARY KEY, ZASSETID TEXT, ZTITLE TEXT, ZAUTHOR TEXT);
+            INSERT INTO ZBKCOLLECTION VALUES
+                (1, 'All_Collection_ID', 'All'), (2, 'C-2', 'Sync'), (3, 'C-3', 'Refresh');
+            """
+        )
+
+        for num in range(books):
+            library.execute(
+                "INSERT INTO ZBKLIBRARYASSET (ZASSETID, ZTITLE, ZAUTHOR) VALUES (?, ?, ?)",
+                (f"BOOK-{num}", f"Book {num}", f"Author {num}"),
+            )
+            collections = [1] if num in uncollected else [1, 2 if num % 2 else 3]
+            library.executemany(
+                "INSERT INTO ZBKCOLLECTIONMEMBER (ZASSETID, ZCOLLECTION) VALUES (?, ?)",
+                [(f"BOOK-{num}", collection) for collection in collections],
+            )
+
+        library.commit()
+        library.close()
+
+        annotations = sqlite3.connect(str(annotation_file))
+
+        annotations.execute(
+            """
+            CREATE TABLE ZAEANNOTATION (
+                Z_PK INTEGER PRIMARY KEY,
+                ZANNOTATIONASSETID TEXT,
+                ZANNOTATIONUUID TEXT,
+                ZANNOTATIONSELECTEDTEXT TEXT,
+                ZANNOTATIONNOTE TEXT,
+                ZANNOTATIONSTYLE INTEGER,
+                ZANNOTATIONLOCATION TEXT,
+                ZANNOTATIONCREATIONDATE REAL,
+                ZANNOTATIONMODIFICATIONDATE REAL,
+                ZANNOTATIONDELETED INTEGER
+            )
+            """
+        )
+
+        annotations.executemany(
+            """
+            INSERT INTO ZAEANNOTATION (
+                ZANNOTATIONASSETID, ZANNOTATIONUUID, ZANNOTATIONSELECTEDTEXT,
+                ZANNOTATIONNOTE, ZANNOTATIONSTYLE, ZANNOTATIONLOCATION,
+                ZANNOTATIONCREATIONDATE, ZANNOTATIONMODIFICATIONDATE, ZANNOTATIONDELETED
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    f"BOOK-{num % books}",
+                    f"UUID-{num}",
+                    f"Passage number {num} of the library.",
+                    "A note #tag" if num % 3 == 0 else None,
+                    1 + num % 5,
+                    f"epubcfi(/6/{2 + num % 7 * 2}!/4/2/1:{num})",
+                    500000000.0 + num,
+                    600000000.0 + num + (1000 if num in deleted else 0),
+                    1 if num in deleted else 0,
+                )
+                for num in range(count)
+            ],
+        )
+
+        annotations.commit()
+        annotations.close()
+
+    def start(self, *args, preamble="", stdin=subprocess.DEVNULL):
+        """ Start `run.py *args` with this HOME. `preamble` is Python run
+        first in the same process, e.g. to shorten a timeout. """
+
+        code = (
+            f"{preamble}\n"
+            "import sys, runpy\n"
+            f"sys.argv = [{str(run_file)!r}] + {list(args)!r}\n"
+            f"runpy.run_path({str(run_file)!r}, run_name='__main__')\n"
+        )
+
+        return subprocess.Popen(
+            [sys.executable, "-c", code],
+            cwd=str(root_dir),
+            env={**os.environ, "HOME": str(self.path)},
+            stdin=stdin,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+
+    def run(self, *args, timeout=120, **kwargs) -> str:
+        return output(self.start(*args, **kwargs), timeout=timeout)
+
+    def run_record(self) -> dict:
+
+        with open(self.app_dir / "run.json") as f:
+            return json.load(f)
+
+
+def output(process, timeout=120, stdin=None) -> str:
+    """ Wait for `process` and return everything it printed. """
+
+    out, _ = process.communicate(stdin, timeout=timeout)
+
+    return out
+
+
+class LibraryTestCase(unittest.TestCase):
+    """ A HOME with a library of `count` annotations and `serve()` to point
+    it at a fresh MockHltsServer. """
+
+    count = 60
+
+    def setUp(self):
+
+        self.home = Home()
+        self.addCleanup(self.home.cleanup)
+
+        self.home.write_library(self.count)
+
+    def serve(self, **kwargs) -> MockHltsServer:
+
+        server = MockHltsServer(api_key="key", **kwargs)
+        server.start()
+        self.addCleanup(server.stop)
+
+        self.home.write_config(server.url_base)
+
+        return server
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import unittest
+import contextlib
+from unittest import mock
+
+from app.api import ack
+from app.api.ack import Acknowledgments
+from app.loadtest import LoadTestApp
+from app.testing import DummyReader, MockHltsServer
+
+
+failed = [
+    {"id": "ID-1", "error": "Database is locked, try again."},
+    {
+        "id": "ID-2",
+        "error": "Invalid annotation.",
+        "annotation": {"tags": ["#a", "#b"], "metadata": {"in_trash": False, "rank": 1.5}},
+    },
+    ["ID-3", 422],
+    "ID-4",
+]
+
+responses = {
+    "ids": {"data": {"import_succeeded": ["ID-5", "ID-6"], "import_failed": failed}},
+    "counts": {"data": {"import_succeeded": 2, "import_failed": failed}},
+    "full": {
+        "data": {
+            "import_succeeded": [{"id": "ID-5", "tags": []}, {"id": "ID-6", "tags": []}],
+            "import_failed": failed,
+        }
+    },
+}
+
+
+class AcknowledgmentsTestCase(unittest.TestCase):
+    """ Every `ack` mode parsed whole with the stdlib and, when ijson is
+    installed, as a stream. """
+
+    parsers = ("whole", "stream")
+
+    def parser(self, name):
+        """ Use the parser `name` inside a `with` block. """
+
+        if name == "whole":
+            return mock.patch.object(ack, "ijson", None)
+
+        if ack.ijson is None:
+            self.skipTest("ijson isn't installed.")
+
+        return contextlib.nullcontext()
+
+    def test_every_shape_is_reduced_to_a_count(self):
+
+        for name in self.parsers:
+            for mode, response in responses.items():
+                with self.subTest(parser=name, mode=mode), self.parser(name):
+
+                    acks = Acknowledgments(mode)
+                    body = io.BytesIO(json.dumps(response).encode("utf-8"))
+
+                    self.assertEqual(acks.parse("add", body), failed)
+                    self.assertEqual(acks.summary(), {"add": 2})
+
+    def test_stream_matches_whole(self):
+
+        if ack.ijson is None:
+            self.skipTest("ijson isn't installed.")
+
+        for mode, response in responses.items():
+            with self.subTest(mode=mode):
+
+                body = json.dumps(response).encode("utf-8")
+
+                self.assertEqual(
+                    Acknowledgments._parse_stream(io.BytesIO(body)),
+                    Acknowledgments._parse_whole(response),
+                )
+
+    def test_modes_against_mock_server(self):
+
+        reader = DummyReader(count=500, seed=1)
+        chunks = list(reader.chunks(50))
+
+        for name in self.parsers:
+            for mode in ack.modes:
+                with self.subTest(parser=name, mode=mode), self.parser(name):
+
+                    with MockHltsServer(item_faults=0.1, seed=1) as server:
+
+                        app = LoadTestApp(server.url_base, ack=mode)
+
+                        failures = []
+                        for method, chunk in chunks:
+                            failures += app.api.import_annotations(chunk, method)
+
+                        stored = set(server.annotations)
+
+                    failed_ids = {failure["id"] for failure in failures}
+
+                    self.assertTrue(failed_ids)
+                    self.assertFalse(failed_ids & stored)
+                    self.assertEqual(len(stored) + len(failed_ids), len(reader))
+                    self.assertEqual(sum(app.api.acks.succeeded.values()), len(stored))
+
+
+if __name__ == "__main__":
+    unittest.main()
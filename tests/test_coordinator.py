@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import signal
+import logging
+import tempfile
+import subprocess
+import unittest
+from pathlib import Path
+from types import SimpleNamespace
+
+from app.coordinator import RunCoordinator
+from app.testing import MockHltsServer
+from tests.support import Home, output
+
+
+class CoordinatorTestCase(unittest.TestCase):
+    """ Two `run.py` processes started on top of each other, see
+    `coordinator.py`. The first one is a dummy run slowed down by the mock's
+    latency so it's still running when the second one starts. """
+
+    holder = ("dummy", "--count", "4000", "--seed", "1")
+
+    def setUp(self):
+
+        self.home = Home()
+        self.addCleanup(self.home.cleanup)
+
+        self.server = MockHltsServer(api_key="key", latency=0.1)
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        self.home.write_config(self.server.url_base)
+
+    def start_holder(self, *args, **kwargs) -> subprocess.Popen:
+        """ Start the first run and wait until it holds the lock. """
+
+        process = self.home.start(*args, **kwargs)
+        self.addCleanup(self._kill, process)
+
+        deadline = time.monotonic() + 30
+
+        while time.monotonic() < deadline:
+            try:
+                record = self.home.run_record()
+            except (FileNotFoundError, ValueError):
+                record = {}
+            if record.get("pid") == process.pid and record.get("status") == "running":
+                return process
+            time.sleep(0.05)
+
+        self.fail("The first run never took the lock.")
+
+    @staticmethod
+    def _kill(process):
+        if process.poll() is None:
+            process.kill()
+        if not process.stdout.closed:
+            process.communicate()
+
+    def last_run(self) -> tuple:
+        """ The pid of the run that last held the lock and how many
+        annotations it had acknowledged. """
+
+        record = self.home.run_record()
+        imported = sum(record["results"].get("imported", {}).values())
+
+        return record["pid"], imported
+
+    def test_attach_reports_the_running_sync(self):
+
+        holder = self.start_holder(*self.holder, "--yes")
+        out = self.home.run(*self.holder, "--yes")
+        output(holder)
+
+        self.assertIn("Attached to the dummy run", out)
+        self.assertEqual(self.last_run(), (holder.pid, 4000))
+
+    def test_attach_runs_when_the_work_differs(self):
+
+        holder = self.start_holder(*self.holder, "--yes")
+        second = self.home.start("dummy", "--count", "100", "--seed", "1", "--yes")
+        out = output(second)
+        output(holder)
+
+        self.assertIn("Waiting for it to finish", out)
+        self.assertNotIn("Attached", out)
+        self.assertEqual(self.last_run(), (second.pid, 100))
+
+    def test_attach_runs_when_the_holder_was_not_confirmed(self):
+
+        holder = self.start_holder(*self.holder, stdin=subprocess.PIPE)
+        second = self.home.start(*self.holder, "--yes")
+
+        # Let the second run notice the first before it's declined.
+        time.sleep(1)
+        output(holder, stdin="n\n")
+        out = output(second)
+
+        self.assertNotIn("Attached", out)
+        self.assertEqual(self.last_run(), (second.pid, 4000))
+
+    def test_wait_runs_after_the_holder(self):
+
+        holder = self.start_holder(*self.holder, "--yes")
+        second = self.home.start("--if-running", "wait", *self.holder, "--yes")
+        out = output(second)
+        output(holder)
+
+        self.assertIn("Waiting for it to finish", out)
+        self.assertEqual(self.last_run(), (second.pid, 4000))
+
+    def test_fail_gives_up_straight_away(self):
+
+        holder = self.start_holder(*self.holder, "--yes")
+        second = self.home.start("--if-running", "fail", *self.holder, "--yes")
+        out = output(second, timeout=10)
+
+        self.assertIsNone(holder.poll(), "The second run waited for the first.")
+        self.assertIn("has been running since", out)
+        output(holder)
+        self.assertEqual(self.last_run(), (holder.pid, 4000))
+
+    def test_killed_holder_releases_the_lock(self):
+
+        holder = self.start_holder(*self.holder, "--yes")
+        holder.kill()
+        holder.communicate()
+
+        out = self.home.run(*self.holder, "--yes")
+
+        self.assertNotIn("Waiting", out)
+        self.assertEqual(self.home.run_record()["status"], "finished")
+
+        with open(self.home.app_dir / "app.log") as f:
+            self.assertIn("didn't finish", f.read())
+
+    def test_hung_holder_is_taken_over(self):
+
+        holder = self.start_holder(*self.holder, "--yes")
+        holder.send_signal(signal.SIGSTOP)
+
+        out = self.home.run(
+            *self.holder,
+            "--yes",
+            preamble="from app.coordinator import RunCoordinator\n"
+            "RunCoordinator.stale_after = 2",
+        )
+
+        self.assertIn("looks stuck, taking over", out)
+        record = self.home.run_record()
+        self.assertNotEqual(record["pid"], holder.pid)
+        self.assertEqual(record["status"], "finished")
+
+
+class BreakTestCase(unittest.TestCase):
+    """ Two waiters that both found the same holder stale, interleaved by
+    hand. The flock is per open file so one process can play all three. """
+
+    def setUp(self):
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+
+        self.lock_file = Path(tmp.name) / "run.lock"
+        self.run_file = Path(tmp.name) / "run.json"
+
+        self.app = SimpleNamespace(logger=logging.getLogger(__name__))
+
+    def coordinator(self) -> RunCoordinator:
+
+        coordinator = RunCoordinator(self.app, lock_file=self.lock_file, run_file=self.run_file)
+        self.addCleanup(coordinator.release, "finished")
+
+        return coordinator
+
+    def test_only_one_waiter_breaks_a_stale_lock(self):
+
+        hung = self.coordinator()
+        self.assertTrue(hung.acquire("applebooks"))
+
+        # It stopped beating long ago.
+        hung._stop.set()
+        hung._record["heartbeat"] = 0
+        hung._write(hung._record)
+
+        first = self.coordinator()
+        second = self.coordinator()
+
+        stale = first._read()
+        self.assertTrue(first._is_stale(stale))
+        self.assertTrue(second._is_stale(second._read()))
+
+        first._break(stale)
+        self.assertTrue(first._try_lock())
+        first._start("applebooks", None)
+
+        # The second waiter read the same stale record before any of that.
+        second._break(stale)
+
+        self.assertFalse(second._try_lock())
+        self.assertEqual(os.stat(self.lock_file).st_ino, os.fstat(first._fd).st_ino)
+        self.assertEqual(first._read()["id"], first.run_id)
+        self.assertEqual(first._read()["status"], "running")
+
+
+if __name__ == "__main__":
+    unittest.main()
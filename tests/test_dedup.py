@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from app.applebooks import Annotation
+from app.applebooks.cfi import SourceIndex
+from app.applebooks.dedup import Deduplicator
+
+
+first = (
+    "It was the best of times, it was the worst of times, it was the age of "
+    "wisdom, it was the age of foolishness."
+)
+second = (
+    "We had everything before us, we had nothing before us, we were all going "
+    "direct to Heaven, we were all going direct the other way."
+)
+third = (
+    "In short, the period was so far like the present period, that some of its "
+    "noisiest authorities insisted on its being received."
+)
+
+
+def annotation(num, passage, modified) -> Annotation:
+
+    data = {
+        "id": f"UUID-{num}",
+        "source_id": "BOOK-1",
+        "location": f"epubcfi(/6/2!/4/2/1:{num})",
+        "modified": modified,
+    }
+    serialized = {
+        "id": data["id"],
+        "passage": passage,
+        "notes": f"Note {num}",
+        "tags": [f"#tag{num}"],
+        "collections": [],
+        "metadata": {"modified": modified},
+    }
+
+    return Annotation(None, data, serialized)
+
+
+class DeduplicatorTestCase(unittest.TestCase):
+    def collapse(self, policy, annotations) -> dict:
+        """ {kept id: sorted dropped ids} """
+
+        collapsed = Deduplicator(policy=policy).run(SourceIndex(annotations))
+
+        return {kept.id: sorted(other.id for other in others) for kept, others in collapsed}
+
+    def test_contained_passage_is_collapsed(self):
+
+        annotations = [annotation(0, first, 1.0), annotation(1, first[:60], 2.0)]
+
+        self.assertEqual(self.collapse("longest", annotations), {"UUID-0": ["UUID-1"]})
+        self.assertEqual(self.collapse("newest", annotations), {"UUID-1": ["UUID-0"]})
+
+    def test_near_identical_passages_are_collapsed(self):
+
+        annotations = [annotation(0, first, 1.0), annotation(1, first + " ", 2.0)]
+
+        self.assertEqual(len(self.collapse("longest", annotations)), 1)
+
+    def test_short_fragment_doesnt_join_unrelated_passages(self):
+
+        annotations = [
+            annotation(0, "the ship", 3.0),
+            annotation(1, f"{first} Then the ship sailed.", 1.0),
+            annotation(2, f"{second} And the ship sank.", 2.0),
+        ]
+
+        for policy in ("newest", "longest", "merge"):
+            self.assertEqual(self.collapse(policy, annotations), {}, policy)
+
+    def test_passages_sharing_a_contained_one_stay_apart(self):
+
+        annotations = [
+            annotation(0, f"{first} {second}", 1.0),
+            annotation(1, second, 2.0),
+            annotation(2, f"{second} {third}", 3.0),
+        ]
+
+        collapsed = self.collapse("longest", annotations)
+
+        # p2 joins one of the extensions, neither extension is dropped.
+        self.assertEqual(len(collapsed), 1)
+        self.assertEqual(sum(collapsed.values(), []), ["UUID-1"])
+
+        collapsed = self.collapse("newest", annotations)
+
+        self.assertEqual(sum(collapsed.values(), []), ["UUID-1"])
+
+    def test_merge_keeps_the_notes_of_the_dropped(self):
+
+        kept = annotation(0, first, 1.0)
+
+        Deduplicator(policy="merge").run(SourceIndex([kept, annotation(1, first[:60], 2.0)]))
+
+        self.assertEqual(kept.notes, "Note 0\n\nNote 1")
+        self.assertEqual(kept.tags, ["#tag0", "#tag1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
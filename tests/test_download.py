@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import json
+import unittest
+from urllib.parse import urlsplit, parse_qs
+
+from app.api.defaults import ApiDefaults
+from app.testing import DummyReader, MockHltsServer
+from tests.support import Home
+
+
+class DownloadTestCase(unittest.TestCase):
+    """ `run.py download` of a large library from a local mock of the hlts
+    API, page by page. """
+
+    count = 20000
+    per_page = 250
+
+    def setUp(self):
+
+        self.home = Home()
+        self.addCleanup(self.home.cleanup)
+
+        self.server = MockHltsServer(api_key="key")
+        self.server.start()
+        self.addCleanup(self.server.stop)
+
+        self.server.annotations = {
+            annotation["id"]: annotation for _, annotation in DummyReader(self.count, seed=1)
+        }
+
+        self.home.write_config(self.server.url_base)
+
+        self.download_dir = self.home.app_dir / "downloads"
+
+    def download(self) -> list:
+        """ Download and return the combined .hlts file. """
+
+        self.home.run("download", "--per-page", str(self.per_page))
+
+        with open(self.download_dir / f"{ApiDefaults.export_name}.hlts") as f:
+            return json.load(f)
+
+    def exports(self, since=0) -> dict:
+        """ {page: status} of the export requests made after `since`. """
+
+        pages = {}
+
+        for request in self.server.requests[since:]:
+            url = urlsplit(request["path"])
+            if url.path == ApiDefaults.url_export:
+                pages[int(parse_qs(url.query)["page"][0])] = request["status"]
+
+        return pages
+
+    def test_download_combines_every_page(self):
+
+        downloaded = self.download()
+
+        self.assertEqual(len(self.exports()), self.count // self.per_page)
+        self.assertEqual(
+            [annotation["id"] for annotation in downloaded], sorted(self.server.annotations)
+        )
+
+    def test_unchanged_pages_are_revalidated(self):
+
+        self.download()
+
+        self.server.annotations["ID-DUMMY-0"]["notes"] = "Changed."
+
+        requests = len(self.server.requests)
+        downloaded = self.download()
+        statuses = self.exports(requests)
+
+        # Ids sort as strings, ID-DUMMY-0 is on the first page.
+        self.assertEqual(statuses.pop(1), 200)
+        self.assertEqual(set(statuses.values()), {304})
+        self.assertEqual(downloaded[0]["notes"], "Changed.")
+
+    def test_interrupted_page_is_resumed(self):
+
+        first = self.download()
+
+        # As if the last run was cut off half way through page 7.
+        page_file = self.download_dir / "page-000007.json"
+        body = page_file.read_bytes()
+        page_file.with_suffix(".part").write_bytes(body[: len(body) // 2])
+        page_file.unlink()
+
+        requests = len(self.server.requests)
+        downloaded = self.download()
+
+        self.assertEqual(self.exports(requests)[7], 206)
+        self.assertEqual(page_file.read_bytes(), body)
+        self.assertEqual(downloaded, first)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import json
+import socket
+import sqlite3
+import unittest
+
+from app.defaults import AppDefaults
+from tests.support import LibraryTestCase
+
+
+class SpoolTestCase(LibraryTestCase):
+    """ Annotations spooled while the server was unreachable are sent by
+    `run.py drain`. See `spool.py`. """
+
+    # No waiting between attempts at a batch.
+    preamble = "from app.api.defaults import ApiDefaults\nApiDefaults.retry_backoff = 0"
+
+    def spool(self):
+        """ Sync while nothing listens on `url_base` so everything is
+        spooled. """
+
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+
+        self.home.write_config(f"http://127.0.0.1:{port}")
+
+        out = self.home.run("applebooks", "--yes")
+
+        self.assertIn("is unreachable", out)
+        self.assertTrue(any((self.home.app_dir / "spool").glob("*.log")))
+
+    def mirror_trashed(self) -> set:
+
+        connection = sqlite3.connect(str(self.home.app_dir / "mirror.sqlite"))
+
+        try:
+            rows = connection.execute("SELECT id FROM annotations WHERE in_trash")
+            return {row[0] for row in rows}
+        finally:
+            connection.close()
+
+    def failures(self) -> list:
+
+        try:
+            with open(self.home.app_dir / "failures.jsonl") as f:
+                return [json.loads(line) for line in f]
+        except FileNotFoundError:
+            return []
+
+    def test_drain_sends_everything_spooled(self):
+
+        self.spool()
+
+        server = self.serve()
+        self.home.run("drain", preamble=self.preamble)
+
+        self.assertEqual(len(server.annotations), self.count)
+        self.assertFalse(any((self.home.app_dir / "spool").glob("*.log")))
+
+    def test_batch_the_server_chokes_on_is_given_up(self):
+
+        self.spool()
+
+        server = self.serve(poisoned={"UUID-1"})
+        out = self.home.run("drain", preamble=self.preamble)
+
+        self.assertNotIn("is unreachable", out)
+        self.assertFalse(any((self.home.app_dir / "spool").glob("*.log")))
+
+        failures = self.failures()
+        failed_ids = {failure["id"] for failure in failures}
+
+        self.assertIn("UUID-1", failed_ids)
+        for failure in failures:
+            self.assertTrue(failure["reason"].startswith("Gave up draining"))
+        self.assertEqual(len(server.annotations) + len(failed_ids), self.count)
+
+        poisoned = [request for request in server.requests if request["status"] == 500]
+        self.assertEqual(len(poisoned), AppDefaults.spool_max_attempts)
+
+
+    def test_spooled_trash_of_annotation_missing_upstream_is_done(self):
+
+        server = self.serve()
+        self.home.run("applebooks", "--yes")
+
+        self.home.write_library(self.count, deleted={3})
+        self.spool()
+
+        # Deleted on the web as well while the server was unreachable.
+        del server.annotations["UUID-3"]
+
+        self.home.write_config(server.url_base)
+        self.home.run("drain", preamble=self.preamble)
+
+        self.assertEqual(self.failures(), [])
+        self.assertEqual(self.mirror_trashed(), {"UUID-3"})
+
+
+if __name__ == "__main__":
+    unittest.main()
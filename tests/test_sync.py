@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from tests.support import LibraryTestCase
+
+
+class SyncTestCase(LibraryTestCase):
+    """ `run.py applebooks` against a local mock of the hlts API. """
+
+    def test_sync_sends_every_annotation(self):
+
+        server = self.serve()
+
+        self.home.run("applebooks", "--yes")
+
+        self.assertEqual(set(server.annotations), {f"UUID-{num}" for num in range(self.count)})
+
+    def test_book_in_no_collection_is_left_unsorted(self):
+
+        server = self.serve()
+
+        self.home.write_library(self.count, uncollected={1})
+        self.home.run("applebooks", "--yes")
+
+        self.assertEqual(
+            set(server.annotations),
+            {f"UUID-{num}" for num in range(self.count) if num % 10 != 1},
+        )
+
+    def test_reconcile_after_trashing_sends_nothing(self):
+
+        server = self.serve()
+
+        self.home.run("applebooks", "--yes")
+        self.home.write_library(self.count, deleted={3})
+        self.home.run("applebooks", "--yes")
+
+        requests = len(server.requests)
+        out = self.home.run("applebooks", "--reconcile", "--yes")
+
+        self.assertIn("0 annotations differ from the server, 0 only exist", out)
+        self.assertFalse(
+            any(request["path"].startswith("/api/import") for request in server.requests[requests:])
+        )
+
+    def test_429_and_503_are_retried_after_retry_after(self):
+
+        server = self.serve(faults={429: 0.2, 503: 0.1}, retry_after=0.1, seed=1)
+
+        self.home.run("applebooks", "--yes")
+
+        statuses = {request["status"] for request in server.requests}
+
+        self.assertIn(429, statuses)
+        self.assertIn(503, statuses)
+        self.assertEqual(len(server.annotations), self.count)
+        self.assertFalse(any((self.home.app_dir / "spool").glob("*")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import unittest
+
+from tests.support import LibraryTestCase
+
+
+class TrashTestCase(LibraryTestCase):
+    """ Highlights deleted in Books are trashed upstream, see
+    `AppleBooks._query_deleted`. """
+
+    def test_deleted_highlights_are_trashed(self):
+
+        server = self.serve()
+
+        self.home.run("applebooks", "--yes")
+
+        self.home.write_library(self.count, deleted={3, 7})
+        self.home.run("applebooks", "--yes")
+
+        trashed = {
+            id_
+            for id_, annotation in server.annotations.items()
+            if annotation["metadata"]["in_trash"]
+        }
+        self.assertEqual(trashed, {"UUID-3", "UUID-7"})
+
+        # Trashes already sent aren't sent again.
+        requests = len(server.requests)
+        self.home.run("applebooks", "--yes")
+        trash_requests = [
+            request for request in server.requests[requests:] if "trash" in request["path"]
+        ]
+        self.assertEqual(trash_requests, [])
+
+    def test_trash_of_annotation_missing_upstream_is_done(self):
+
+        server = self.serve()
+
+        self.home.run("applebooks", "--yes")
+
+        # Deleted on the web as well as in Books.
+        del server.annotations["UUID-3"]
+
+        self.home.write_library(self.count, deleted={3})
+        out = self.home.run("applebooks", "--yes")
+
+        self.assertNotIn("could not be imported", out)
+        self.assertFalse((self.home.app_dir / "failures.jsonl").exists())
+
+
+if __name__ == "__main__":
+    unittest.main()